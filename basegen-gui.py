@@ -2,9 +2,7 @@ import os
 import sys
 import json
 import pathlib
-import fnmatch
 import threading
-import datetime
 from typing import List, Optional, Dict, Set, Any
 
 import tkinter as tk
@@ -12,7 +10,11 @@ from tkinter import ttk, filedialog, messagebox, scrolledtext, simpledialog
 import pathspec
 
 # Import functionality from basegen.py
-from basegen import load_config, load_gitignore_specs, should_include_file, generate_markdown, guess_language
+from basegen import (
+    load_config, load_gitignore_specs, should_include_file, generate_markdown, guess_language,
+    generate_enhanced_markdown, RenderOptions, ScanExclusions, WorkspaceIndex,
+    DEFAULT_TREE_EXCLUSIONS, DEFAULT_FILE_EXCLUSIONS, SYMLINK_POLICIES,
+)
 
 class BaseGenGUI:
     def __init__(self, root):
@@ -23,39 +25,19 @@ class BaseGenGUI:
         
         # State variables
         self.workspace_path = None
+        self.workspace_index = None  # Cached scan of the workspace (see WorkspaceIndex)
         self.gitignore_spec = None
         self.config_data = load_config()
         self.selected_files = set()  # Stores paths of files to include
         self.excluded_files = set()  # Stores paths of files to explicitly exclude
+        self.tree_dirs = {}  # Directory path -> tree node
+        self.tree_mirrors = {}  # Symbolic link node -> (directory it mirrors, link path)
         self.output_file = "codebase.md"
         self.is_generating = False
         
         # Tree list exclusions
-        self.tree_exclusions = [
-            "node_modules",
-            ".git",
-            ".svn",
-            ".hg",
-            "__pycache__",
-            ".venv",
-            "venv",
-            "env",
-            "dist",
-            "build",
-            ".cache",
-            ".pytest_cache"
-        ]
-        self.file_exclusions = [
-            "*.lock",
-            "package-lock.json",
-            "yarn.lock",
-            "*.pyc",
-            "*.pyo",
-            "*.pyd",
-            "*.so",
-            "*.dylib",
-            "*.dll"
-        ]
+        self.tree_exclusions = list(DEFAULT_TREE_EXCLUSIONS)
+        self.file_exclusions = list(DEFAULT_FILE_EXCLUSIONS)
         
         # Create the main layout
         self.create_menu()
@@ -148,6 +130,7 @@ class BaseGenGUI:
         self.file_tree.bind("<Double-1>", self.on_tree_double_click)
         self.file_tree.bind("<space>", self.on_tree_space)
         self.file_tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+        self.file_tree.bind("<<TreeviewOpen>>", self.on_tree_open)
         
         # Right panel - Configuration and options
         right_frame = ttk.Frame(main_frame, width=400)
@@ -192,6 +175,27 @@ class BaseGenGUI:
         ttk.Checkbutton(options_frame, text="Add file statistics (lines, size)", 
                         variable=self.add_file_stats_var).pack(anchor=tk.W, padx=10, pady=5)
         
+        self.dedupe_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Deduplicate identical files", 
+                        variable=self.dedupe_var).pack(anchor=tk.W, padx=10, pady=5)
+        
+        self.section_index_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Write byte-offset index (.idx)", 
+                        variable=self.section_index_var).pack(anchor=tk.W, padx=10, pady=5)
+        
+        self.reproducible_var = tk.BooleanVar(value=False)
+        ttk.Checkbutton(options_frame, text="Reproducible output (no timestamp, digest)", 
+                        variable=self.reproducible_var).pack(anchor=tk.W, padx=10, pady=5)
+        
+        symlinks_frame = ttk.Frame(options_frame)
+        symlinks_frame.pack(anchor=tk.W, padx=10, pady=5)
+        ttk.Label(symlinks_frame, text="Symbolic links:").pack(side=tk.LEFT)
+        self.symlinks_var = tk.StringVar(value="files")
+        symlinks_combo = ttk.Combobox(symlinks_frame, textvariable=self.symlinks_var, values=SYMLINK_POLICIES,
+                                      state="readonly", width=8)
+        symlinks_combo.pack(side=tk.LEFT, padx=5)
+        symlinks_combo.bind("<<ComboboxSelected>>", self.change_symlink_policy)
+        
         # Exclusion patterns frame
         exclusion_frame = ttk.LabelFrame(right_frame, text="Exclusion Patterns")
         exclusion_frame.pack(fill=tk.BOTH, expand=True, pady=5)
@@ -245,13 +249,8 @@ class BaseGenGUI:
             # Set default output file path
             self.output_file = os.path.join(directory, "codebase.md")
             
-            # Load gitignore if present and requested
-            if self.respect_gitignore_var.get():
-                self.gitignore_spec = load_gitignore_specs(self.workspace_path)
-            else:
-                self.gitignore_spec = None
-            
-            # Populate the tree
+            # Populate the tree (this also loads gitignore rules from the workspace index)
+            self.workspace_index = None
             self.populate_file_tree()
             
             # Load exclusion patterns from config
@@ -267,12 +266,12 @@ class BaseGenGUI:
     def toggle_gitignore(self):
         """Toggle respecting gitignore rules"""
         if self.workspace_path:
-            if self.respect_gitignore_var.get():
-                self.gitignore_spec = load_gitignore_specs(self.workspace_path)
-            else:
-                self.gitignore_spec = None
-            
-            # Refresh the tree
+            # Refresh the tree; gitignore verdicts are already in the workspace index
+            self.populate_file_tree()
+    
+    def change_symlink_policy(self, event=None):
+        """Rescan with the selected symbolic link policy (the workspace index depends on it)"""
+        if self.workspace_path:
             self.populate_file_tree()
     
     def toggle_hardcoded_excludes(self):
@@ -359,6 +358,10 @@ class BaseGenGUI:
             "combined_toc_dir": self.combined_toc_dir_var.get(),    # New option
             "compact_tree": self.compact_tree_var.get(),
             "add_file_stats": self.add_file_stats_var.get(),
+            "dedupe": self.dedupe_var.get(),
+            "section_index": self.section_index_var.get(),
+            "reproducible": self.reproducible_var.get(),
+            "symlinks": self.symlinks_var.get(),
             "exclusion_patterns": patterns,
             "selected_files": list(self.selected_files),
             "excluded_files": list(self.excluded_files),
@@ -440,6 +443,18 @@ class BaseGenGUI:
                     
                 if "add_file_stats" in config:
                     self.add_file_stats_var.set(config["add_file_stats"])
+                    
+                if "dedupe" in config:
+                    self.dedupe_var.set(config["dedupe"])
+                    
+                if "section_index" in config:
+                    self.section_index_var.set(config["section_index"])
+                    
+                if "reproducible" in config:
+                    self.reproducible_var.set(config["reproducible"])
+                    
+                if "symlinks" in config:
+                    self.symlinks_var.set(config["symlinks"])
                 
                 # Update UI state based on combined option
                 self.update_toc_options()
@@ -459,53 +474,19 @@ class BaseGenGUI:
                 
                 # Load selected and excluded files if we have a workspace
                 if self.workspace_path:
-                    # Load gitignore if needed
-                    if self.respect_gitignore_var.get():
-                        self.gitignore_spec = load_gitignore_specs(self.workspace_path)
-                    else:
-                        self.gitignore_spec = None
-                    
-                    # Populate the tree
-                    self.populate_file_tree()
-                    
-                    # Restore selection state
-                    if "selected_files" in config:
-                        self.selected_files = set(config["selected_files"])
+                    if self.workspace_index and self.workspace_index.root != self.workspace_path:
+                        self.workspace_index = None
                     
-                    if "excluded_files" in config:
-                        self.excluded_files = set(config["excluded_files"])
-                    
-                    # Update UI to reflect selections
-                    self._update_tree_selections()
+                    # Populate the tree, restoring the saved selection state
+                    selection = None
+                    if "selected_files" in config or "excluded_files" in config:
+                        selection = (set(config.get("selected_files", [])), set(config.get("excluded_files", [])))
+                    self.populate_file_tree(selection=selection)
                 
                 self.update_status(f"Configuration loaded from: {file_path}")
             except Exception as e:
                 messagebox.showerror("Error", f"Could not load configuration: {e}")
 
-    # Add method to update tree selections based on loaded configuration
-    def _update_tree_selections(self):
-        """Update tree item selections based on loaded configuration"""
-        def update_item(item_id):
-            values = self.file_tree.item(item_id, "values")
-            if not values:
-                return
-                
-            path = values[1]
-            if path in self.selected_files:
-                self.file_tree.item(item_id, values=(values[0], path, "checked"))
-                self.file_tree.item(item_id, tags=("checked",))
-            elif path in self.excluded_files:
-                self.file_tree.item(item_id, values=(values[0], path, "unchecked"))
-                self.file_tree.item(item_id, tags=("unchecked",))
-            
-            # Process children
-            for child_id in self.file_tree.get_children(item_id):
-                update_item(child_id)
-        
-        # Start with root items
-        for item_id in self.file_tree.get_children():
-            update_item(item_id)
-        
     def generate_markdown_wrapper(self):
         """Wrapper for generate_markdown to run in a thread"""
         if self.is_generating:
@@ -538,9 +519,15 @@ class BaseGenGUI:
             combined_toc_dir = self.combined_toc_dir_var.get()
             compact_tree = self.compact_tree_var.get()
             add_file_stats = self.add_file_stats_var.get()
+            options = RenderOptions(
+                dedupe=self.dedupe_var.get(),
+                section_index=self.section_index_var.get(),
+                reproducible=self.reproducible_var.get(),
+                symlinks=self.symlinks_var.get(),
+            )
             
             # Custom extension to generate_markdown with additional features
-            self._enhanced_generate_markdown(
+            generate_enhanced_markdown(
                 self.workspace_path,
                 self.output_file,
                 selected_paths,  # Pass selected paths directly
@@ -551,7 +538,9 @@ class BaseGenGUI:
                 add_dir_structure,
                 combined_toc_dir,
                 compact_tree,
-                add_file_stats
+                add_file_stats,
+                self.workspace_index,
+                options
             )
             
             # Update UI in the main thread
@@ -590,337 +579,12 @@ class BaseGenGUI:
         except Exception as e:
             messagebox.showerror("Error", f"Could not open file: {e}")
     
-    def _enhanced_generate_markdown(
-        self,
-        root_path: pathlib.Path,
-        output_file: str,
-        selected_paths: Set[str],
-        excluded_paths: Set[str],
-        exclude_patterns: Optional[List[str]] = None,
-        gitignore_spec: Optional[pathspec.PathSpec] = None,
-        add_toc: bool = True,
-        add_dir_structure: bool = True,
-        combined_toc_dir: bool = False,
-        compact_tree: bool = False,
-        add_file_stats: bool = False
-    ) -> None:
-        """
-        Enhanced version of generate_markdown with additional features for AI consumption:
-        - Optional table of contents with anchor links
-        - Optional directory structure representation
-        - Combined TOC and directory structure
-        - Compact tree view (omitting empty directories)
-        - File statistics (lines of code, file size)
-        """
-        base = root_path.parent
-
-        included_files = []
-        try:
-            for file in sorted(root_path.rglob("*")):
-                if file.is_file() and self._should_include_file(
-                    file, 
-                    root_path, 
-                    selected_paths, 
-                    excluded_paths, 
-                    exclude_patterns, 
-                    gitignore_spec
-                ):
-                    try:
-                        rel_file = file.relative_to(base)
-                    except ValueError:
-                        rel_file = file
-                    included_files.append(rel_file)
-        except Exception as e:
-            raise RuntimeError(f"Error scanning directory '{root_path}': {e}")
-
-        if not included_files:
-            raise ValueError("No files found matching the criteria.")
-
-        # Build tree with optional compaction
-        if compact_tree:
-            tree_dict = self._build_compact_tree(included_files)
-        else:
-            tree_dict = self._build_tree(included_files)
-            
-        tree_lines = self._format_tree(tree_dict)
-        tree_str = "\n".join(tree_lines)
-
-        md_lines = []
-        md_lines.append(f"# Codebase: {root_path.name}")
-        md_lines.append("")
-        
-        # Add metadata for AI consumption
-        md_lines.append("## Metadata")
-        md_lines.append("")
-        md_lines.append(f"- **Generated on:** {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        md_lines.append(f"- **Files included:** {len(included_files)}")
-        if add_file_stats:
-            total_loc = 0
-            total_size = 0
-            for rel_path in included_files:
-                file_path = base / rel_path
-                if file_path.exists():
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            lines = f.readlines()
-                            total_loc += len(lines)
-                    except UnicodeDecodeError:
-                        # Skip binary files for LOC counting
-                        pass
-                    except Exception:
-                        # Skip files with errors
-                        pass
-                    total_size += file_path.stat().st_size
-            
-            md_lines.append(f"- **Total lines of code:** {total_loc:,}")
-            md_lines.append(f"- **Total size:** {self._format_size(total_size)}")
-        md_lines.append("")
-
-# Add combined TOC and directory structure
-        if combined_toc_dir:
-            md_lines.append("## Project Structure")
-            md_lines.append("")
-            md_lines.append("```")
-            
-            # Generate a linked version of the tree
-            linked_tree_lines = self._format_linked_tree(tree_dict, "", included_files)
-            md_lines.append("\n".join(linked_tree_lines))
-            
-            md_lines.append("```")
-            md_lines.append("")
-        else:
-            # Add table of contents with anchor links
-            if add_toc:
-                md_lines.append("## Table of Contents")
-                md_lines.append("")
-                
-                if add_dir_structure:
-                    md_lines.append("1. [Directory Structure](#directory-structure)")
-                
-                md_lines.append(f"{1 if not add_dir_structure else 2}. [Files](#files)")
-                
-                for i, rel_path in enumerate(included_files):
-                    # Create an anchor-friendly ID
-                    anchor = f"file-{i+1}"
-                    md_lines.append(f"   - [{rel_path}](#{anchor})")
-                
-                md_lines.append("")
-
-            # Add directory structure as a separate section
-            if add_dir_structure:
-                md_lines.append("## Directory Structure")
-                md_lines.append("")
-                md_lines.append("```")
-                md_lines.append(tree_str)
-                md_lines.append("```")
-                md_lines.append("")
-
-        md_lines.append("## Files")
-        md_lines.append("")
-
-        for i, rel_path in enumerate(included_files):
-            # Create an anchor-friendly ID
-            anchor = f"file-{i+1}"
-            
-            md_lines.append(f"### {rel_path} <a id='{anchor}'></a>")
-            md_lines.append("")
-            
-            if add_file_stats:
-                file_path = base / rel_path
-                if file_path.exists():
-                    file_size = file_path.stat().st_size
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            lines = len(f.readlines())
-                        md_lines.append(f"- Lines: {lines}")
-                    except UnicodeDecodeError:
-                        md_lines.append("- Binary file")
-                    except Exception as e:
-                        md_lines.append(f"- Error reading file: {e}")
-                    
-                    md_lines.append(f"- Size: {self._format_size(file_size)}")
-                    md_lines.append("")
-            
-            file_path = base / rel_path
-            ext = file_path.suffix
-            language = guess_language(ext)
-            md_lines.append(f"```{language}")
-            try:
-                content = file_path.read_text(encoding="utf-8")
-            except Exception as e:
-                content = f"Error reading file: {e}"
-            md_lines.append(content)
-            md_lines.append("```")
-            
-            # Always add navigation links for files
-            md_lines.append("")
-            if combined_toc_dir:
-                md_lines.append("<div style='text-align: right;'><a href='#project-structure'>↑ Back to Project Structure</a></div>")
-            elif add_dir_structure:
-                md_lines.append("<div style='text-align: right;'><a href='#directory-structure'>↑ Back to Directory Structure</a></div>")
-            elif add_toc:
-                md_lines.append("<div style='text-align: right;'><a href='#table-of-contents'>↑ Back to Table of Contents</a></div>")
-            
-            md_lines.append("")
-
-        try:
-            with open(output_file, "w", encoding="utf-8") as f:
-                f.write("\n".join(md_lines))
-        except Exception as e:
-            raise RuntimeError(f"Error writing to output file '{output_file}': {e}")
-
-    def _format_linked_tree(self, tree, indent, included_files):
-        """Format the tree dictionary into a list of strings with linked filenames"""
-        lines = []
-        for key in sorted(tree.keys()):
-            if tree[key]:  # Directory
-                lines.append(f"{indent}{key}/")
-                lines.extend(self._format_linked_tree(tree[key], indent + "    ", included_files))
-            else:  # File
-                # Find the index of this file in included_files
-                file_path = pathlib.Path(key)
-                file_index = None
-                
-                for i, included_file in enumerate(included_files):
-                    if included_file.name == file_path.name:
-                        # Check if paths match (considering directory structure)
-                        if str(included_file).endswith(str(file_path)):
-                            file_index = i + 1
-                            break
-                
-                if file_index is not None:
-                    lines.append(f"{indent}[{key}](#file-{file_index})")
-                else:
-                    lines.append(f"{indent}{key}")
-        
-        return lines
-
-    def _should_include_file(
-        self,
-        file: pathlib.Path,
-        root: pathlib.Path,
-        selected_paths: Set[str],
-        excluded_paths: Set[str],
-        exclude_patterns: Optional[List[str]] = None,
-        gitignore_spec: Optional[pathspec.PathSpec] = None,
-    ) -> bool:
-        """
-        Decide whether a file should be included based on:
-        1. If any parent directory is explicitly excluded
-        2. If the file itself is explicitly excluded
-        3. If the file or any parent directory is not in selected_paths
-        4. Gitignore rules (if provided)
-        5. Exclude glob patterns
-        """
-        file_str = str(file)
-        
-        # Check if this file or any of its parent directories are explicitly excluded
-        current = file
-        while current != root:
-            if str(current) in excluded_paths:
-                return False
-            current = current.parent
-        
-        # Check if this file (or its parent directory) is specifically selected
-        is_selected = False
-        if file_str in selected_paths:
-            is_selected = True
-        else:
-            # Check if any parent directory is selected
-            current = file.parent
-            while current != root:
-                if str(current) in selected_paths:
-                    is_selected = True
-                    break
-                current = current.parent
-        
-        # If nothing in the path is explicitly selected, exclude it
-        if not is_selected and str(root) not in selected_paths:
-            return False
-        
-        # Check gitignore rules
-        try:
-            rel = file.relative_to(root)
-        except ValueError:
-            rel = file
-            
-        rel_str = str(rel).replace(os.sep, "/")
-        if gitignore_spec and gitignore_spec.match_file(rel_str):
-            return False
-        
-        # Check exclude patterns
-        if exclude_patterns:
-            if any(fnmatch.fnmatch(rel_str, pattern) for pattern in exclude_patterns):
-                return False
-        
-        return True
-    
-    def _build_tree(self, paths: List[pathlib.Path]) -> dict:
-        """Build a nested dictionary representing a directory tree"""
-        tree = {}
-        for path in paths:
-            parts = path.parts
-            current = tree
-            for part in parts:
-                if part not in current:
-                    current[part] = {}
-                current = current[part]
-        return tree
-    
-    def _build_compact_tree(self, paths: List[pathlib.Path]) -> dict:
+    def populate_file_tree(self, selection=None, revalidate=False):
         """
-        Build a compact nested dictionary representing a directory tree,
-        collapsing directories with only one child.
+        Populate the file tree with the workspace directory structure.
+        selection is an optional (selected_files, excluded_files) pair to restore;
+        revalidate checks the workspace index against the disk after showing it.
         """
-        # First, build the full tree
-        tree = self._build_tree(paths)
-        
-        # Then compact it
-        return self._compact_tree_node(tree)
-    
-    def _compact_tree_node(self, node: dict) -> dict:
-        """Recursively compact a tree node"""
-        # First, compact all children
-        for key, child in list(node.items()):
-            if child:  # If not a leaf
-                node[key] = self._compact_tree_node(child)
-        
-        # If this node has exactly one child and it's a directory, combine them
-        if len(node) == 1:
-            key = list(node.keys())[0]
-            child = node[key]
-            
-            # Only combine if the child is a directory
-            if child:
-                new_node = {}
-                for child_key, child_value in child.items():
-                    new_key = f"{key}/{child_key}"
-                    new_node[new_key] = child_value
-                return new_node
-        
-        return node
-    
-    def _format_tree(self, tree: dict, indent: str = "") -> List[str]:
-        """Format the tree dictionary into a list of strings"""
-        lines = []
-        for key in sorted(tree.keys()):
-            if tree[key]:
-                lines.append(f"{indent}{key} >")
-                lines.extend(self._format_tree(tree[key], indent + "    "))
-            else:
-                lines.append(f"{indent}{key}")
-        return lines
-    
-    def _format_size(self, size_bytes: int) -> str:
-        """Format file size in a human-readable format"""
-        for unit in ['B', 'KB', 'MB', 'GB']:
-            if size_bytes < 1024.0:
-                return f"{size_bytes:.2f} {unit}"
-            size_bytes /= 1024.0
-        return f"{size_bytes:.2f} TB"
-    
-    def populate_file_tree(self):
-        """Populate the file tree with the workspace directory structure"""
         # Clear the tree
         for item in self.file_tree.get_children():
             self.file_tree.delete(item)
@@ -928,6 +592,7 @@ class BaseGenGUI:
         # Clear selections
         self.selected_files = set()
         self.excluded_files = set()
+        self.tree_mirrors = {}
         
         # Start progress bar
         self.progress.pack(before=self.statusbar)
@@ -935,86 +600,107 @@ class BaseGenGUI:
         self.update_status("Loading file tree...")
         
         # Use a thread to avoid UI freezing
-        threading.Thread(target=self._populate_tree_thread, daemon=True).start()
+        threading.Thread(target=self._populate_tree_thread, args=(selection, revalidate), daemon=True).start()
     
-    def _populate_tree_thread(self):
+    def _populate_tree_thread(self, selection=None, revalidate=False):
         """Thread worker for populating the tree"""
         try:
-            # Create root node
-            root_id = self.file_tree.insert("", "end", text=self.workspace_path.name, open=True, 
-                                        values=("directory", str(self.workspace_path), "checked"))
-            self.file_tree.item(root_id, tags=("checked",))
-            
-            # Track which directories we've added
-            added_dirs = {self.workspace_path: root_id}
+            # Excluded directories and file patterns are pruned while scanning
+            exclusions = ScanExclusions(self.tree_exclusions, self.file_exclusions, self.symlinks_var.get())
             
-            # Add all files to the tree (with performance improvements)
-            for path in sorted(self.workspace_path.rglob("*")):
-                try:
-                    # Skip excluded directories for better performance
-                    if any(excluded_dir in path.parts for excluded_dir in self.tree_exclusions):
-                        continue
-                    
-                    # Skip excluded file patterns for better performance
-                    if path.is_file() and any(fnmatch.fnmatch(path.name, pattern) for pattern in self.file_exclusions):
-                        continue
-                        
-                    # Get relative path for checking against gitignore
-                    rel_path = path.relative_to(self.workspace_path)
-                    rel_path_str = str(rel_path).replace(os.sep, "/")
-                    
-                    # Check if it should be included
-                    is_excluded = False
-                    if self.gitignore_spec and self.respect_gitignore_var.get():
-                        is_excluded = self.gitignore_spec.match_file(rel_path_str)
-                    
-                    # For directories, we need to ensure the parent path exists in the tree
-                    parent_path = path.parent
-                    if parent_path not in added_dirs:
-                        # Need to build the path
-                        self._build_parent_path(parent_path, added_dirs)
-                    
-                    parent_id = added_dirs[parent_path]
-                    
-                    # Determine the item properties
-                    if path.is_dir():
-                        # Create directory item
-                        node_id = self.file_tree.insert(parent_id, "end", text=path.name, 
-                                                    values=("directory", str(path), "checked" if not is_excluded else "unchecked"))
-                        # Track this directory
-                        added_dirs[path] = node_id
-                        # Add tags for styling
-                        if is_excluded:
-                            self.file_tree.item(node_id, tags=("unchecked",))
-                            self.excluded_files.add(str(path))
-                        else:
-                            self.file_tree.item(node_id, tags=("checked",))
-                            self.selected_files.add(str(path))
-                    else:
-                        # Create file item
-                        node_id = self.file_tree.insert(parent_id, "end", text=path.name, 
-                                                    values=("file", str(path), "checked" if not is_excluded else "unchecked"))
-                        # Add tags for styling
-                        if is_excluded:
-                            self.file_tree.item(node_id, tags=("unchecked",))
-                            self.excluded_files.add(str(path))
-                        else:
-                            self.file_tree.item(node_id, tags=("checked",))
-                            self.selected_files.add(str(path))
-                except Exception as e:
-                    print(f"Error adding path to tree: {path} - {e}")
+            # Use the in-memory index, else the on-disk scan cache, else scan the workspace
+            index = self.workspace_index
+            if index is not None and index.exclusions.key() != exclusions.key():
+                index = None
+            if index is None:
+                index = WorkspaceIndex.load(self.workspace_path, exclusions)
+                if index is None:
+                    index = WorkspaceIndex(self.workspace_path, exclusions).scan()
+                    index.save()
+                else:
+                    # Show the cached tree right away, then check it against the disk
+                    revalidate = True
+                self.workspace_index = index
             
-            # Configure tags for styling
-            self.file_tree.tag_configure("checked", foreground="black")
-            self.file_tree.tag_configure("unchecked", foreground="gray")
+            self.gitignore_spec = index.gitignore_spec if self.respect_gitignore_var.get() else None
+            self._fill_tree_from_index(index, selection)
             
             # Update UI in the main thread
             self.root.after(0, self._finish_tree_loading)
+            
+            if revalidate and index.revalidate():
+                index.save()
+                # Redraw with the fresh scan, keeping the user's current selection
+                self.root.after(0, lambda: self.populate_file_tree(
+                    selection=(set(self.selected_files), set(self.excluded_files))))
         except Exception as e:
             self.root.after(0, lambda: self.update_status(f"Error loading file tree: {e}"))
             self.root.after(0, self.progress.stop)
             self.root.after(0, self.progress.pack_forget)
     
+    def _fill_tree_from_index(self, index, selection=None):
+        """Insert the entries of a WorkspaceIndex into the file tree"""
+        # Create root node
+        root_id = self.file_tree.insert("", "end", text=self.workspace_path.name, open=True, 
+                                    values=("directory", str(self.workspace_path), "checked"))
+        self.file_tree.item(root_id, tags=("checked",))
+        
+        # Track which directories we've added
+        added_dirs = {self.workspace_path: root_id}
+        respect_gitignore = self.gitignore_spec is not None
+        
+        # Add all indexed paths to the tree (excluded directories were pruned by the scan)
+        for rel_path_str in index.sorted_paths():
+            meta = index.entries[rel_path_str]
+            kind, ignored = meta[0], meta[3]
+            path = self.workspace_path / rel_path_str
+            try:
+                # Check if it should be included
+                is_excluded = ignored and respect_gitignore
+                if selection is not None:
+                    if str(path) in selection[1]:
+                        is_excluded = True
+                    elif str(path) in selection[0]:
+                        is_excluded = False
+                
+                # For directories, we need to ensure the parent path exists in the tree
+                parent_path = path.parent
+                if parent_path not in added_dirs:
+                    # Need to build the path
+                    self._build_parent_path(parent_path, added_dirs)
+                
+                parent_id = added_dirs[parent_path]
+                
+                # Determine the item properties; a symbolic link to a directory
+                # already in the tree (see --symlinks follow) mirrors it when opened
+                original = meta[5] if kind == "l" else None
+                is_directory = kind == "d" or original is not None or (kind in ("l", "o") and path.is_dir())
+                item_type = "directory" if is_directory else "file"
+                text = path.name if original is None else f"{path.name} \u2192 {original or '.'}"
+                node_id = self.file_tree.insert(parent_id, "end", text=text, 
+                                            values=(item_type, str(path), "checked" if not is_excluded else "unchecked"))
+                if kind == "d":
+                    # Track this directory
+                    added_dirs[path] = node_id
+                elif original is not None:
+                    self.tree_mirrors[node_id] = (self.workspace_path / original, path)
+                    self.file_tree.insert(node_id, "end", text="")
+                # Add tags for styling
+                if is_excluded:
+                    self.file_tree.item(node_id, tags=("unchecked",))
+                    self.excluded_files.add(str(path))
+                else:
+                    self.file_tree.item(node_id, tags=("checked",))
+                    self.selected_files.add(str(path))
+            except Exception as e:
+                print(f"Error adding path to tree: {path} - {e}")
+        
+        self.tree_dirs = added_dirs
+        
+        # Configure tags for styling
+        self.file_tree.tag_configure("checked", foreground="black")
+        self.file_tree.tag_configure("unchecked", foreground="gray")
+    
     def manage_tree_exclusions(self):
         """Manage directory and file exclusions for the file tree"""
         exclusion_dialog = tk.Toplevel(self.root)
@@ -1179,6 +865,32 @@ class BaseGenGUI:
         if item_id:
             self.toggle_item_selection(item_id)
     
+    def on_tree_open(self, event):
+        """Fill a symbolic link's mirror of the directory it points to when it is first opened"""
+        item_id = self.file_tree.focus()
+        mirror = self.tree_mirrors.get(item_id)
+        children = self.file_tree.get_children(item_id)
+        if mirror is None or len(children) != 1 or self.file_tree.item(children[0], "values"):
+            return
+        self.file_tree.delete(*children)
+        original, link_path = mirror
+        state = self.file_tree.item(item_id, "values")[2]
+        source_id = self.tree_dirs.get(original)
+        if source_id is None:
+            return
+        for child_id in self.file_tree.get_children(source_id):
+            values = self.file_tree.item(child_id, "values")
+            if not values:
+                continue
+            path = link_path / pathlib.Path(values[1]).relative_to(original)
+            node_id = self.file_tree.insert(item_id, "end", text=self.file_tree.item(child_id, "text"),
+                                            values=(values[0], str(path), state), tags=(state,))
+            if values[0] == "directory" and (self.file_tree.get_children(child_id) or child_id in self.tree_mirrors):
+                # Mirror nested directories lazily too, so links that loop back stay finite
+                nested = self.tree_mirrors.get(child_id, (pathlib.Path(values[1]), None))[0]
+                self.tree_mirrors[node_id] = (nested, path)
+                self.file_tree.insert(node_id, "end", text="")
+    
     def toggle_item_selection(self, item_id):
         """Toggle selection state of a tree item"""
         values = self.file_tree.item(item_id, "values")
@@ -1341,6 +1053,8 @@ class BaseGenGUI:
     def expand_all(self):
         """Expand all nodes in the tree"""
         def _expand_all(parent_id):
+            if parent_id in self.tree_mirrors:
+                return  # may loop back to one of its parents
             self.file_tree.item(parent_id, open=True)
             for item_id in self.file_tree.get_children(parent_id):
                 _expand_all(item_id)
@@ -1361,7 +1075,7 @@ class BaseGenGUI:
     def refresh_tree(self):
         """Refresh the file tree"""
         if self.workspace_path:
-            self.populate_file_tree()
+            self.populate_file_tree(revalidate=True)
     
     def filter_tree(self, *args):
         """Filter the tree based on search text"""
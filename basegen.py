@@ -1,11 +1,40 @@
 #!/usr/bin/env python3
 import argparse
+import array
+import bisect
+import asyncio
+import codecs
+import collections
+import errno
 import fnmatch
 import pathlib
 import sys
 import os
 import json
-from typing import List, Optional
+import math
+import re
+import shutil
+import signal
+import socket
+import stat
+import struct
+import hashlib
+import heapq
+import datetime
+import http.server
+import io
+import ipaddress
+import socketserver
+import subprocess
+import tarfile
+import tempfile
+import urllib.parse
+import threading
+import concurrent.futures
+import contextlib
+import zipfile
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
 
 import pathspec
 
@@ -49,6 +78,33 @@ def load_config() -> dict:
 # Load configuration from external JSON file.
 config_data = load_config()
 
+# Directory names and file patterns the GUI leaves out of its file tree by default.
+DEFAULT_TREE_EXCLUSIONS = [
+    "node_modules",
+    ".git",
+    ".svn",
+    ".hg",
+    "__pycache__",
+    ".venv",
+    "venv",
+    "env",
+    "dist",
+    "build",
+    ".cache",
+    ".pytest_cache"
+]
+DEFAULT_FILE_EXCLUSIONS = [
+    "*.lock",
+    "package-lock.json",
+    "yarn.lock",
+    "*.pyc",
+    "*.pyo",
+    "*.pyd",
+    "*.so",
+    "*.dylib",
+    "*.dll"
+]
+
 def guess_language(ext: str) -> str:
     """
     Determine the language for a given file extension.
@@ -72,15 +128,23 @@ def guess_language(ext: str) -> str:
     }
     return default_mapping.get(ext, '')
 
-def load_gitignore_specs(root: pathlib.Path) -> Optional[pathspec.PathSpec]:
+def load_gitignore_specs(
+    root: pathlib.Path,
+    gitignore_files: Optional[List[pathlib.Path]] = None,
+) -> Optional[pathspec.PathSpec]:
     """
     Find all .gitignore files in the given root folder (recursively),
     adjust their patterns to be relative to the repository root,
     and compile a single PathSpec.
+
+    If gitignore_files is given (e.g. from a cached workspace scan), those files
+    are used instead of searching the tree again.
     """
     patterns = []
     try:
-        for gitignore in root.rglob(".gitignore"):
+        if gitignore_files is None:
+            gitignore_files = root.rglob(".gitignore")
+        for gitignore in gitignore_files:
             try:
                 lines = gitignore.read_text(encoding="utf-8").splitlines()
             except Exception as e:
@@ -90,18 +154,7 @@ def load_gitignore_specs(root: pathlib.Path) -> Optional[pathspec.PathSpec]:
                 rel_dir = gitignore.parent.relative_to(root)
             except ValueError:
                 rel_dir = pathlib.Path("")
-            for line in lines:
-                line = line.strip()
-                if not line or line.startswith("#"):
-                    continue
-                if rel_dir != pathlib.Path(""):
-                    if line.startswith("/"):
-                        pattern = str(rel_dir / line.lstrip("/"))
-                    else:
-                        pattern = str(rel_dir / line)
-                else:
-                    pattern = line
-                patterns.append(pattern)
+            patterns.extend(_gitignore_patterns(lines, rel_dir))
         # Always ignore any .gitignore file itself.
         patterns.append("**/.gitignore")
         return pathspec.PathSpec.from_lines("gitwildmatch", patterns)
@@ -109,6 +162,469 @@ def load_gitignore_specs(root: pathlib.Path) -> Optional[pathspec.PathSpec]:
         print(f"Error loading .gitignore specifications: {e}", file=sys.stderr)
         return None
 
+def _gitignore_patterns(lines: List[str], rel_dir: pathlib.PurePath) -> List[str]:
+    """The patterns of a .gitignore file in rel_dir, adjusted to be relative to the repository root."""
+    patterns = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if rel_dir != pathlib.Path(""):
+            if line.startswith("/"):
+                pattern = str(rel_dir / line.lstrip("/"))
+            else:
+                pattern = str(rel_dir / line)
+        else:
+            pattern = line
+        patterns.append(pattern)
+    return patterns
+
+def get_cache_dir() -> pathlib.Path:
+    """
+    Return the directory used for persistent caches.
+    BASEGEN_CACHE_DIR takes precedence, then LOCALAPPDATA (Windows) or XDG_CACHE_HOME,
+    falling back to ~/.cache/basegen.
+    """
+    if os.environ.get("BASEGEN_CACHE_DIR"):
+        return pathlib.Path(os.environ["BASEGEN_CACHE_DIR"])
+    if os.name == "nt" and os.environ.get("LOCALAPPDATA"):
+        return pathlib.Path(os.environ["LOCALAPPDATA"]) / "basegen"
+    if os.environ.get("XDG_CACHE_HOME"):
+        return pathlib.Path(os.environ["XDG_CACHE_HOME"]) / "basegen"
+    return pathlib.Path.home() / ".cache" / "basegen"
+
+def _read_link(path: str) -> str:
+    """The target of a symbolic link as stored in it ("" if it cannot be read)."""
+    try:
+        return os.readlink(path)
+    except OSError:
+        return ""
+
+def _parent_rel(rel: str) -> str:
+    """Return the parent of a POSIX-style relative path ('' for top-level entries)."""
+    return rel.rpartition("/")[0]
+
+def _rel_sort_key(rel: str) -> tuple:
+    """Sort key ordering relative paths the same way sorted(pathlib.Path) does."""
+    return tuple(rel.split("/"))
+
+# How symbolic links are treated while walking a tree (see ScanExclusions):
+#   files  - links to files are read like files, linked directories are listed
+#            but not descended into (what rglob does; the default)
+#   skip   - links are left out
+#   list   - links are listed with their target, never read or descended into
+#   follow - links to files and directories are followed; a file or directory
+#            reached through several paths (same st_dev/st_ino) is read or
+#            walked once and the other paths refer to it, so cycles end there
+SYMLINK_POLICIES = ("files", "skip", "list", "follow")
+
+class ScanExclusions:
+    """
+    Directory names and file name patterns compiled for use while walking a tree.
+    Any entry whose name is an excluded directory name is skipped before it is
+    stat'ed or descended into; file name patterns are combined into one regex.
+    symlinks is the symbolic link policy (see SYMLINK_POLICIES).
+    """
+
+    def __init__(
+        self,
+        dir_names: Optional[List[str]] = None,
+        file_patterns: Optional[List[str]] = None,
+        symlinks: str = "files",
+    ):
+        if symlinks not in SYMLINK_POLICIES:
+            raise ValueError(f"Unknown symlink policy '{symlinks}' (expected one of: {', '.join(SYMLINK_POLICIES)})")
+        self.dir_names = sorted(set(dir_names or []))
+        self.file_patterns = sorted(set(file_patterns or []))
+        self.symlinks = symlinks
+        self._names = frozenset(os.path.normcase(name) for name in self.dir_names)
+        self._file_re = None
+        if self.file_patterns:
+            self._file_re = re.compile("|".join(
+                fnmatch.translate(os.path.normcase(pattern)) for pattern in self.file_patterns
+            ))
+
+    def excludes_entry(self, name: str) -> bool:
+        """True if an entry (and everything below it) with this name should be skipped."""
+        return os.path.normcase(name) in self._names
+
+    def excludes_file(self, name: str) -> bool:
+        """True if a file with this name matches one of the file patterns."""
+        return bool(self._file_re and self._file_re.match(os.path.normcase(name)))
+
+    def key(self) -> list:
+        """A JSON-serialisable fingerprint, used to tell whether a cached scan applies."""
+        key = [self.dir_names, self.file_patterns]
+        if self.symlinks != "files":
+            key.append(self.symlinks)
+        return key
+
+class WorkspaceIndex:
+    """
+    Scan result for a workspace directory.
+
+    Every path below the root is stored under its POSIX-style relative path as
+    [kind, size, mtime_ns, ignored], where kind is "d" (directory), "f" (file)
+    or "o" (anything else, e.g. a broken symlink) and ignored is the .gitignore
+    verdict. The index can be saved to the cache directory, loaded again on the
+    next run and revalidated by re-listing only the directories whose mtime changed.
+    Entries matching the given ScanExclusions are pruned while walking.
+
+    Symbolic links are handled by the ScanExclusions' policy (see
+    SYMLINK_POLICIES). Links that are listed instead of read are entries
+    ["l", 0, 0, ignored, link target, original], where original is the path
+    of the directory a followed link leads to if it was already walked (else
+    None). With the follow policy, files carry their "st_dev:st_ino" and
+    whether they are a link as two more items, so that files reached through
+    several paths are found (see references), and a changed directory makes
+    revalidate scan everything again (the set of walked directories depends
+    on the whole tree).
+    """
+
+    CACHE_VERSION = 1
+
+    def __init__(self, root: pathlib.Path, exclusions: Optional[ScanExclusions] = None):
+        self.root = pathlib.Path(root)
+        self.exclusions = exclusions or ScanExclusions()
+        self.entries: Dict[str, list] = {}
+        self.dir_mtimes: Dict[str, int] = {}
+        self.gitignore_mtimes: Dict[str, int] = {}
+        self.gitignore_spec: Optional[pathspec.PathSpec] = None
+        self.lock = threading.RLock()
+        self._pattern_cache: Dict[str, Set[str]] = {}
+        self._walked_dirs: Dict[str, str] = {}  # "st_dev:st_ino" -> first path walked (follow policy)
+
+    @property
+    def cache_path(self) -> pathlib.Path:
+        key = hashlib.sha1(str(self.root.resolve()).encode("utf-8")).hexdigest()[:16]
+        return get_cache_dir() / f"scan-{key}.json"
+
+    def _abs(self, rel: str) -> str:
+        return os.path.join(str(self.root), *rel.split("/")) if rel else str(self.root)
+
+    def _list_dir(self, rel: str) -> Dict[str, list]:
+        """
+        Stat the immediate children of a directory and record its mtime. With
+        the follow policy, linked directories are returned as kind "s" for
+        _walk to resolve.
+        """
+        children = {}
+        path = self._abs(rel)
+        st = os.stat(path)
+        self.dir_mtimes[rel] = st.st_mtime_ns
+        exclusions = self.exclusions
+        symlinks = exclusions.symlinks
+        follow = symlinks == "follow"
+        if follow:
+            self._walked_dirs.setdefault(f"{st.st_dev}:{st.st_ino}", rel)
+        with os.scandir(path) as it:
+            for entry in it:
+                if exclusions.excludes_entry(entry.name):
+                    continue
+                child = f"{rel}/{entry.name}" if rel else entry.name
+                if symlinks in ("skip", "list") and entry.is_symlink():
+                    if symlinks == "list" and not exclusions.excludes_file(entry.name):
+                        children[child] = ["l", 0, 0, False, _read_link(entry.path), None]
+                    continue
+                try:
+                    st = entry.stat()
+                    if entry.is_dir():
+                        children[child] = ["d", 0, st.st_mtime_ns, False]
+                    elif entry.is_file():
+                        if exclusions.excludes_file(entry.name):
+                            continue
+                        children[child] = ["f", st.st_size, st.st_mtime_ns, False]
+                        if follow:
+                            children[child] += [f"{st.st_dev}:{st.st_ino}", entry.is_symlink()]
+                    else:
+                        children[child] = ["o", 0, 0, False]
+                except OSError:
+                    children[child] = ["o", 0, 0, False]
+                # Like rglob, list symlinked directories but never descend into them.
+                if children[child][0] == "d" and entry.is_symlink():
+                    if follow:
+                        children[child] = ["s", 0, st.st_mtime_ns, False, f"{st.st_dev}:{st.st_ino}"]
+                    else:
+                        children[child][0] = "o"
+        return children
+
+    def _walk(self, rel: str) -> List[str]:
+        """
+        Scan a directory and everything below it into the index, returning the
+        paths added. With the follow policy, linked directories are walked
+        after all real ones, in path order, unless the directory they lead to
+        was already walked; they are then listed as links to it instead.
+        """
+        added = []
+        stack = [rel]
+        linked: List[str] = []
+        while stack or linked:
+            if not stack:
+                linked.sort(key=_rel_sort_key, reverse=True)
+                link = linked.pop()
+                meta = self.entries[link]
+                original = self._walked_dirs.get(meta[4])
+                if original is not None:
+                    self.entries[link] = ["l", 0, 0, False, _read_link(self._abs(link)), original]
+                    continue
+                meta[:] = ["d", 0, meta[2], False]
+                stack.append(link)
+            current = stack.pop()
+            try:
+                children = self._list_dir(current)
+            except OSError as e:
+                print(f"Warning: Could not scan {self._abs(current)}: {e}", file=sys.stderr)
+                continue
+            self.entries.update(children)
+            added.extend(children)
+            stack.extend(child for child, meta in children.items() if meta[0] == "d")
+            linked.extend(child for child, meta in children.items() if meta[0] == "s")
+        return added
+
+    def _remove(self, rel: str, children_of: Dict[str, List[str]]) -> None:
+        """Drop an entry and, for directories, its whole subtree."""
+        stack = [rel]
+        while stack:
+            current = stack.pop()
+            self.entries.pop(current, None)
+            self.dir_mtimes.pop(current, None)
+            self.gitignore_mtimes.pop(current, None)
+            stack.extend(children_of.pop(current, []))
+
+    def _gitignore_state(self) -> Dict[str, int]:
+        """Current mtimes of all indexed .gitignore files (stat'ed, since edits need not touch the directory)."""
+        state = {}
+        for rel, meta in self.entries.items():
+            if meta[0] == "f" and (rel == ".gitignore" or rel.endswith("/.gitignore")):
+                try:
+                    state[rel] = os.stat(self._abs(rel)).st_mtime_ns
+                except OSError:
+                    pass
+        return state
+
+    def _compile_gitignore(self) -> None:
+        files = sorted(self.gitignore_mtimes, key=lambda r: (r.count("/"), _rel_sort_key(r)))
+        self.gitignore_spec = load_gitignore_specs(self.root, [self.root / rel for rel in files])
+
+    def _apply_gitignore(self, rels) -> None:
+        spec = self.gitignore_spec
+        for rel in rels:
+            meta = self.entries.get(rel)
+            if meta is not None:
+                meta[3] = bool(spec and spec.match_file(rel))
+
+    def refresh_gitignore(self) -> None:
+        """Recompile the .gitignore rules from the indexed .gitignore files and re-evaluate every entry."""
+        self.gitignore_mtimes = self._gitignore_state()
+        self._compile_gitignore()
+        self._apply_gitignore(self.entries)
+
+    def scan(self) -> "WorkspaceIndex":
+        """Perform a full scan of the workspace."""
+        with self.lock:
+            self.entries = {}
+            self.dir_mtimes = {}
+            self._walked_dirs = {}
+            self._pattern_cache.clear()
+            self._walk("")
+            self.refresh_gitignore()
+        return self
+
+    def revalidate(self) -> bool:
+        """
+        Bring the index up to date with the filesystem. Only directories whose
+        mtime changed are listed again; new subdirectories are scanned fully.
+        Returns True if anything changed.
+        """
+        with self.lock:
+            changed = self._revalidate()
+            if changed:
+                self._pattern_cache.clear()
+            return changed
+
+    def _revalidate(self) -> bool:
+        if self.exclusions.symlinks == "follow":
+            for rel, mtime in self.dir_mtimes.items():
+                try:
+                    unchanged = os.stat(self._abs(rel)).st_mtime_ns == mtime
+                except OSError:
+                    unchanged = False
+                if not unchanged:
+                    self.scan()
+                    return True
+            if self._gitignore_state() != self.gitignore_mtimes:
+                self.refresh_gitignore()
+                return True
+            return False
+
+        children_of: Dict[str, List[str]] = {}
+        for rel in self.entries:
+            children_of.setdefault(_parent_rel(rel), []).append(rel)
+
+        changed = False
+        new_entries = []
+        for rel in sorted(self.dir_mtimes, key=lambda r: r.count("/")):
+            if rel not in self.dir_mtimes:
+                continue  # removed together with its parent
+            try:
+                mtime = os.stat(self._abs(rel)).st_mtime_ns
+            except OSError:
+                self._remove(rel, children_of)
+                changed = True
+                continue
+            if mtime == self.dir_mtimes[rel]:
+                continue
+            changed = True
+            try:
+                listing = self._list_dir(rel)
+            except OSError:
+                self._remove(rel, children_of)
+                continue
+            for child in children_of.get(rel, []):
+                old = self.entries.get(child)
+                new = listing.get(child)
+                if old is not None and (new is None or new[0] != old[0]):
+                    self._remove(child, children_of)
+            for child, meta in listing.items():
+                old = self.entries.get(child)
+                if old is None:
+                    self.entries[child] = meta
+                    new_entries.append(child)
+                    if meta[0] == "d":
+                        new_entries.extend(self._walk(child))
+                else:
+                    old[1], old[2] = meta[1], meta[2]
+
+        if self._gitignore_state() != self.gitignore_mtimes:
+            self.refresh_gitignore()
+            changed = True
+        else:
+            self._apply_gitignore(new_entries)
+        return changed
+
+    def sorted_paths(self) -> List[str]:
+        """Relative paths of all entries, in the order sorted(root.rglob('*')) would give."""
+        with self.lock:
+            return sorted(self.entries, key=_rel_sort_key)
+
+    def files(self, links: bool = False) -> List[str]:
+        """Relative paths of all regular files (and with links, listed links), sorted like sorted_paths()."""
+        kinds = ("f", "l") if links else ("f",)
+        with self.lock:
+            return sorted((rel for rel, meta in self.entries.items() if meta[0] in kinds), key=_rel_sort_key)
+
+    def references(self, rels: List[str]) -> Dict[str, Tuple[str, str]]:
+        """
+        The entries among rels (in output order) that are rendered as a
+        reference instead of being read, as rel -> (kind, target): ("link",
+        link target) for listed links, ("same_directory", path) for links to
+        an already walked directory and ("same_file", path) for files that are
+        the same file (st_dev/st_ino) as another one in rels. Of the paths of
+        one file, the first that is not a link is read (or the first if all are).
+        """
+        references = {}
+        originals: Dict[str, Tuple[bool, str]] = {}  # file id -> (is a link, path)
+        with self.lock:
+            for rel in rels:
+                meta = self.entries.get(rel)
+                if meta is None:
+                    continue
+                if meta[0] == "l":
+                    references[rel] = ("link", meta[4]) if meta[5] is None else ("same_directory", meta[5])
+                elif meta[0] == "f" and len(meta) > 4:
+                    original = originals.get(meta[4])
+                    if original is None or (original[0] and not meta[5]):
+                        originals[meta[4]] = (meta[5], rel)
+            for rel in rels:
+                meta = self.entries.get(rel)
+                if meta is not None and meta[0] == "f" and len(meta) > 4 and originals[meta[4]][1] != rel:
+                    references[rel] = ("same_file", originals[meta[4]][1])
+        return references
+
+    def is_ignored(self, rel: str) -> bool:
+        """The cached .gitignore verdict for an entry."""
+        meta = self.entries.get(rel)
+        return bool(meta and meta[3])
+
+    def size(self, rel: str) -> int:
+        """
+        The current size of a file (0 if unknown). Editing a file in place
+        leaves its directory's mtime alone, so revalidate cannot see it; the
+        file is stat'ed again and its entry updated instead.
+        """
+        with self.lock:
+            meta = self.entries.get(rel)
+            if meta is None or meta[0] != "f":
+                return 0
+            try:
+                st = os.stat(self._abs(rel))
+            except OSError:
+                return meta[1]
+            meta[1], meta[2] = st.st_size, st.st_mtime_ns
+            return meta[1]
+
+    def matching(self, patterns: Optional[List[str]]) -> Set[str]:
+        """
+        Relative paths of the files matching any of the given glob patterns.
+        Verdicts are computed once per pattern and reused until the index
+        changes, so pattern lists sharing patterns (such as the hard-coded
+        excludes) share the work.
+        """
+        if not patterns:
+            return set()
+        with self.lock:
+            files = None
+            matched = set()
+            for pattern in patterns:
+                if pattern not in self._pattern_cache:
+                    if files is None:
+                        files = [rel for rel, meta in self.entries.items() if meta[0] in ("f", "l")]
+                    self._pattern_cache[pattern] = set(fnmatch.filter(files, pattern))
+                matched |= self._pattern_cache[pattern]
+            return matched
+
+    def save(self) -> None:
+        """Persist the index to the cache directory (errors are reported, not raised)."""
+        data = {
+            "version": self.CACHE_VERSION,
+            "root": str(self.root.resolve()),
+            "exclusions": self.exclusions.key(),
+            "dir_mtimes": self.dir_mtimes,
+            "gitignore_mtimes": self.gitignore_mtimes,
+            "entries": self.entries,
+        }
+        try:
+            path = self.cache_path
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Warning: Could not write scan cache: {e}", file=sys.stderr)
+
+    @classmethod
+    def load(cls, root: pathlib.Path, exclusions: Optional[ScanExclusions] = None) -> Optional["WorkspaceIndex"]:
+        """
+        Load a previously saved index for root, or return None if there is no
+        usable cache (including one made with different exclusions).
+        """
+        index = cls(root, exclusions)
+        try:
+            with open(index.cache_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if (data.get("version") != cls.CACHE_VERSION
+                or data.get("root") != str(index.root.resolve())
+                or data.get("exclusions") != index.exclusions.key()):
+            return None
+        index.entries = data["entries"]
+        index.dir_mtimes = data["dir_mtimes"]
+        index.gitignore_mtimes = data["gitignore_mtimes"]
+        index._compile_gitignore()
+        return index
+
 def should_include_file(
     file: pathlib.Path,
     root: pathlib.Path,
@@ -140,167 +656,5786 @@ def should_include_file(
             return False
     return True
 
-def build_tree(paths: List[pathlib.Path]) -> dict:
+class PathTrie:
+    """
+    Directory tree of relative paths, stored as a compact trie: each node is
+    an index into a table of entry names (which references the walker's own
+    strings) and parallel integer arrays (first child, last child, next
+    sibling, position of the path in the input). Node 0 is the unnamed root
+    above the top-level entries; an entry with children is rendered as a
+    directory.
+
+    Paths added in sorted order (as the walkers produce them) extend the
+    previous path without any lookups; otherwise children are found through
+    a map keyed by parent node and name, built on first need.
+    With compact, chains of directories that are the only entry of their
+    parent are rendered as one "a/b/c" entry.
     """
-    Build a nested dictionary representing a directory tree from a list of relative file paths.
-    Each key is a directory or file name; directories map to further dictionaries.
+
+    def __init__(self, compact: bool = False):
+        self.compact = compact
+        self.names: List[str] = [""]
+        self.first_child = array.array("i", [-1])
+        self.last_child = array.array("i", [-1])
+        self.next_sibling = array.array("i", [-1])
+        self.file_index = array.array("i", [-1])
+        self.count = 0
+        self._previous: Tuple[str, ...] = ()
+        self._previous_nodes: List[int] = []
+        self._lookup: Optional[Dict[Tuple[int, str], int]] = None
+
+    def add(self, parts) -> int:
+        """Add a path given as its parts (e.g. pathlib.Path.parts); returns its node."""
+        parts = tuple(parts)
+        previous = self._previous
+        if len(parts) == len(previous) and parts[:-1] == previous[:-1]:
+            common = len(parts) - (parts[-1] != previous[-1])  # siblings: the common case
+        else:
+            common = 0
+            while common < len(parts) and common < len(previous) and parts[common] == previous[common]:
+                common += 1
+        if self._lookup is None and parts < previous:
+            # Out of order: the new path may continue any existing branch.
+            self._lookup = {}
+            for parent in range(len(self.names)):
+                child = self.first_child[parent]
+                while child != -1:
+                    self._lookup[parent, self.names[child]] = child
+                    child = self.next_sibling[child]
+        nodes = self._previous_nodes
+        del nodes[common:]
+        parent = nodes[-1] if nodes else 0
+        lookup = self._lookup
+        names, first_child, last_child = self.names, self.first_child, self.last_child
+        for part in parts[common:]:
+            node = lookup.get((parent, part), -1) if lookup is not None else -1
+            if node == -1:
+                node = len(names)
+                names.append(part)
+                first_child.append(-1)
+                last_child.append(-1)
+                self.next_sibling.append(-1)
+                self.file_index.append(-1)
+                if first_child[parent] == -1:
+                    first_child[parent] = node
+                else:
+                    self.next_sibling[last_child[parent]] = node
+                last_child[parent] = node
+                if lookup is not None:
+                    lookup[parent, part] = node
+            nodes.append(node)
+            parent = node
+        if self.file_index[parent] == -1:
+            self.file_index[parent] = self.count
+        self.count += 1
+        self._previous = parts
+        return parent
+
+    def is_dir(self, node: int) -> bool:
+        return self.first_child[node] != -1
+
+    def children(self, node: int) -> List[int]:
+        result = []
+        child = self.first_child[node]
+        while child != -1:
+            result.append(child)
+            child = self.next_sibling[child]
+        return result
+
+    def entries(self, node: int) -> Tuple[str, List[int]]:
+        """The nodes rendered directly below node, sorted by name, and the prefix of their labels."""
+        prefix = ""
+        children = self.children(node)
+        while self.compact and len(children) == 1 and self.first_child[children[0]] != -1:
+            prefix += self.names[children[0]] + "/"
+            children = self.children(children[0])
+        children.sort(key=self.names.__getitem__)
+        return prefix, children
+
+    def iter_entries(self):
+        """Yield (depth, label, node) for every rendered entry in display order, without recursion."""
+        names = self.names
+        first_child = self.first_child
+        prefix, children = self.entries(0)
+        stack = [(prefix, iter(children))]
+        while stack:
+            prefix, children = stack[-1]
+            node = next(children, None)
+            if node is None:
+                stack.pop()
+                continue
+            yield len(stack) - 1, prefix + names[node], node
+            if first_child[node] != -1:
+                prefix, children = self.entries(node)
+                stack.append((prefix, iter(children)))
+
+def build_tree(paths: List[pathlib.Path], compact: bool = False) -> PathTrie:
     """
-    tree = {}
+    Build the directory tree (a PathTrie) of a list of relative file paths.
+    With compact, single-child directory chains are collapsed when rendered.
+    """
+    tree = PathTrie(compact)
     for path in paths:
-        parts = path.parts  # e.g., ('server', 'src', 'main.rs')
-        current = tree
-        for part in parts:
-            if part not in current:
-                current[part] = {}
-            current = current[part]
+        tree.add(path.parts)  # e.g., ('server', 'src', 'main.rs')
     return tree
 
-def format_tree(tree: dict, indent: str = "") -> List[str]:
+def format_tree(tree: PathTrie) -> List[str]:
     """
-    Recursively format the nested dictionary tree into a list of strings.
+    Format the tree into a list of strings, indenting four spaces per level.
     Directories are suffixed with a " >" symbol.
     """
+    return [f"{'    ' * depth}{label} >" if tree.is_dir(node) else f"{'    ' * depth}{label}"
+            for depth, label, node in tree.iter_entries()]
+
+def build_compact_tree(paths: List[pathlib.Path]) -> PathTrie:
+    """
+    Build a directory tree that collapses directories with only one child.
+    """
+    return build_tree(paths, compact=True)
+
+def format_linked_tree(tree: PathTrie) -> List[str]:
+    """Format the tree into a list of strings with filenames linked to their file sections"""
     lines = []
-    for key in sorted(tree.keys()):
-        if tree[key]:
-            lines.append(f"{indent}{key} >")
-            lines.extend(format_tree(tree[key], indent + "    "))
+    for depth, label, node in tree.iter_entries():
+        indent = "    " * depth
+        if tree.is_dir(node):
+            lines.append(f"{indent}{label}/")
         else:
-            lines.append(f"{indent}{key}")
+            lines.append(f"{indent}[{label}](#file-{tree.file_index[node] + 1})")
     return lines
 
-def generate_markdown(
-    root_path: pathlib.Path,
-    output_file: str,
-    include_patterns: Optional[List[str]] = None,
-    exclude_patterns: Optional[List[str]] = None,
-    gitignore_spec: Optional[pathspec.PathSpec] = None,
-) -> None:
+def format_size(size_bytes: int) -> str:
+    """Format file size in a human-readable format"""
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size_bytes < 1024.0:
+            return f"{size_bytes:.2f} {unit}"
+        size_bytes /= 1024.0
+    return f"{size_bytes:.2f} TB"
+
+def is_path_selected(
+    file: pathlib.Path,
+    root: pathlib.Path,
+    selected_paths: Set[str],
+    excluded_paths: Set[str],
+) -> bool:
     """
-    Generate a Markdown document containing:
-      1. A directory tree (table of contents) showing only the files that match the filters.
-      2. For each included file, a section with the file’s path and its contents inside a fenced code block.
+    Check the tree selection for a file: False if the file or any parent
+    directory is explicitly excluded, or if nothing in its path is selected.
+    """
+    file_str = str(file)
     
-    The include and exclude patterns are applied relative to the codebase root.
+    # Check if this file or any of its parent directories are explicitly excluded
+    current = file
+    while current != root:
+        if str(current) in excluded_paths:
+            return False
+        current = current.parent
+    
+    # Check if this file (or its parent directory) is specifically selected
+    is_selected = False
+    if file_str in selected_paths:
+        is_selected = True
+    else:
+        # Check if any parent directory is selected
+        current = file.parent
+        while current != root:
+            if str(current) in selected_paths:
+                is_selected = True
+                break
+            current = current.parent
+    
+    # If nothing in the path is explicitly selected, exclude it
+    return is_selected or str(root) in selected_paths
+
+_READ_CHUNK = 1 << 20
+
+_BLANK_WHITESPACE = b" \t\f\v"
+_NEWLINE_RUN = re.compile(b"\n\n+")
+
+def _count_blank_lines(data: bytes, at_line_start: bool = True) -> Tuple[int, bool]:
     """
-    base = root_path.parent
+    Count the blank (whitespace-only) lines ended by the newlines in data, a
+    chunk of "\n"-separated text; at_line_start tells whether only whitespace
+    came since the last newline of the previous chunks (or the file start).
+    Returns the count and the at_line_start state for the next chunk. Works on
+    the bytes: with the whitespace deleted, blank lines are repeated newlines.
+    """
+    text = data.translate(None, _BLANK_WHITESPACE)
+    if not text:
+        return 0, at_line_start
+    runs = _NEWLINE_RUN.findall(text)
+    blank = sum(map(len, runs)) - len(runs)
+    if at_line_start and text[:1] == b"\n":
+        blank += 1
+    return blank, text[-1:] == b"\n"
 
-    included_files = []
+def _scan_passthrough(
+    file_path: pathlib.Path,
+    hash_content: bool,
+    count_blank: bool = False,
+) -> Optional[Dict[str, Any]]:
+    """
+    Scan a file in chunks for read_file_info's passthrough mode, validating
+    UTF-8 without keeping the decoded text. Returns None if the file has to be
+    read and decoded instead (invalid UTF-8, carriage returns, read errors).
+    """
+    digest = hashlib.sha256() if hash_content else None
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    size = newlines = blank = 0
+    at_line_start = True
+    last = b""
     try:
-        for file in sorted(root_path.rglob("*")):
-            if file.is_file() and should_include_file(file, root_path, include_patterns, exclude_patterns, gitignore_spec):
-                try:
-                    rel_file = file.relative_to(base)
-                except ValueError:
-                    rel_file = file
-                included_files.append(rel_file)
-    except Exception as e:
-        print(f"Error scanning directory '{root_path}': {e}", file=sys.stderr)
-        sys.exit(1)
+        with open(file_path, "rb") as f:
+            while True:
+                chunk = f.read(_READ_CHUNK)
+                if not chunk:
+                    break
+                if b"\r" in chunk:
+                    return None
+                # ASCII needs no validation unless a multi-byte sequence is pending.
+                if not chunk.isascii() or decoder.getstate()[0]:
+                    decoder.decode(chunk)
+                if digest:
+                    digest.update(chunk)
+                size += len(chunk)
+                newlines += chunk.count(b"\n")
+                if count_blank:
+                    chunk_blank, at_line_start = _count_blank_lines(chunk, at_line_start)
+                    blank += chunk_blank
+                last = chunk[-1:]
+        decoder.decode(b"", final=True)
+    except (OSError, UnicodeDecodeError):
+        return None
+    info = _file_info(lines=newlines + (1 if last and last != b"\n" else 0), size=size,
+                      sha256=digest.hexdigest() if digest else None, passthrough=True)
+    if count_blank:
+        info["blank_lines"] = blank + (1 if last and last != b"\n" and at_line_start else 0)
+    return info
 
-    if not included_files:
-        print("Warning: No files found matching the criteria.", file=sys.stderr)
+def _file_info(**fields) -> Dict[str, Any]:
+    info = {"exists": True, "content": None, "lines": None, "size": 0, "error": None, "sha256": None,
+            "passthrough": False, "blank_lines": None, "redactions": None}
+    info.update(fields)
+    return info
+
+def read_file_info(
+    file_path: pathlib.Path,
+    hash_content: bool = False,
+    passthrough: bool = False,
+    count_blank: bool = False,
+    redactor: Optional["SecretRedactor"] = None,
+) -> Dict[str, Any]:
+    """
+    Read a file once and return its decoded content, line count and size
+    (and the SHA-256 of its bytes as "sha256" if hash_content is set, and the
+    number of whitespace-only lines as "blank_lines" if count_blank is set).
+    On failure "error" holds the exception and "content"/"lines" are None.
+    With a redactor, "content" is scanned by it (see SecretRedactor.scan)
+    and "redactions" holds the secrets found per rule, for the caller to
+    tally if it renders the file.
 
+    With passthrough, a file that is valid UTF-8 without carriage returns (so
+    its bytes are exactly what the decoded content would encode back to) is
+    only scanned: "content" stays None and "passthrough" is True, and the
+    caller copies the file into the output with FileContents.
+    """
+    if passthrough:
+        info = _scan_passthrough(file_path, hash_content, count_blank)
+        if info is not None:
+            return info
     try:
-        tree_dict = build_tree(included_files)
-        tree_lines = format_tree(tree_dict)
-        tree_str = "\n".join(tree_lines)
+        data = file_path.read_bytes()
+    except FileNotFoundError as e:
+        return _file_info(exists=False, error=e)
     except Exception as e:
-        print(f"Error building directory tree: {e}", file=sys.stderr)
-        sys.exit(1)
+        info = _file_info(error=e)
+        try:
+            info["size"] = file_path.stat().st_size
+        except OSError:
+            pass
+        return info
+    return file_info_from_bytes(data, hash_content, count_blank, redactor)
 
-    md_lines = []
-    md_lines.append(f"# Codebase: {root_path.name}")
-    md_lines.append("")
-    md_lines.append("## Directory Tree")
-    md_lines.append("")
-    md_lines.append("```")
-    md_lines.append(tree_str)
-    md_lines.append("```")
-    md_lines.append("")
-    md_lines.append("## Files")
-    md_lines.append("")
+def file_info_from_bytes(data: bytes, hash_content: bool = False, count_blank: bool = False,
+                         redactor: Optional["SecretRedactor"] = None) -> Dict[str, Any]:
+    """The read_file_info result for a file with the given bytes (for sources other than the filesystem)."""
+    info = _file_info(size=len(data))
+    if hash_content:
+        info["sha256"] = hashlib.sha256(data).hexdigest()
+    try:
+        content = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        info["error"] = e
+        return info
+    # Normalise newlines the way text-mode reads do
+    if "\r" in content:
+        content = content.replace("\r\n", "\n").replace("\r", "\n")
+    info["content"] = content
+    info["lines"] = content.count("\n") + (1 if content and not content.endswith("\n") else 0)
+    if redactor:
+        info["content"], info["redactions"] = redactor.scan(content)
+    if count_blank:
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        blank, at_line_start = _count_blank_lines(data)
+        info["blank_lines"] = blank + (1 if data and not data.endswith(b"\n") and at_line_start else 0)
+    return info
 
-    for rel_path in included_files:
-        md_lines.append(f"### {rel_path}")
-        md_lines.append("")
-        file_path = base / rel_path
-        ext = file_path.suffix
-        language = guess_language(ext)
-        md_lines.append(f"```{language}")
+class FileInfoReader(io.RawIOBase):
+    """
+    Wraps a binary stream and works out its read_file_info result (with
+    hash_content and count_blank, but without keeping the content) from the
+    bytes read through it, for consumers that parse a file in one streaming
+    pass (see DataSummaries). Closing it reads the rest of the stream, closes
+    that and makes the result available as info.
+    """
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self.info: Optional[Dict[str, Any]] = None
+        self._digest = hashlib.sha256()
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._error: Optional[Exception] = None
+        self._size = self._newlines = self._blank = 0
+        self._at_line_start = True
+        self._after_cr = False
+        self._last = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = self.raw.readinto(buffer)
+        if count:
+            self._add(bytes(memoryview(buffer)[:count]))
+        return count
+
+    def _add(self, chunk: bytes) -> None:
+        self._digest.update(chunk)
+        self._size += len(chunk)
+        if self._error is not None:
+            return
         try:
-            content = file_path.read_text(encoding="utf-8")
-        except Exception as e:
-            content = f"Error reading file: {e}"
-        md_lines.append(content)
-        md_lines.append("```")
-        md_lines.append("")
+            # ASCII needs no validation unless a multi-byte sequence is pending.
+            if not chunk.isascii() or self._decoder.getstate()[0]:
+                self._decoder.decode(chunk)
+        except UnicodeDecodeError as e:
+            self._error = e
+            return
+        # Newlines are normalised like file_info_from_bytes does, across chunks.
+        data = chunk[1:] if self._after_cr and chunk[:1] == b"\n" else chunk
+        self._after_cr = chunk[-1:] == b"\r"
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        if data:
+            self._newlines += data.count(b"\n")
+            blank, self._at_line_start = _count_blank_lines(data, self._at_line_start)
+            self._blank += blank
+            self._last = data[-1:]
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            while True:
+                chunk = self.raw.read(_READ_CHUNK)
+                if not chunk:
+                    break
+                self._add(chunk)
+            if self._error is None:
+                try:
+                    self._decoder.decode(b"", final=True)
+                except UnicodeDecodeError as e:
+                    self._error = e
+        finally:
+            self.raw.close()
+            super().close()
+        self.info = _file_info(size=self._size, sha256=self._digest.hexdigest(), error=self._error)
+        if self._error is None:
+            partial = self._last and self._last != b"\n"
+            self.info["lines"] = self._newlines + (1 if partial else 0)
+            self.info["blank_lines"] = self._blank + (1 if partial and self._at_line_start else 0)
 
+def unread_file_info(file_path: pathlib.Path, source: Any = None) -> Dict[str, Any]:
+    """
+    The read_file_info result for a file rendered without its content (such
+    as a collapsed file): only its size, from source if given, else stat.
+    """
     try:
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write("\n".join(md_lines))
-        print(f"Markdown file generated: {output_file}")
-    except Exception as e:
-        print(f"Error writing to output file '{output_file}': {e}", file=sys.stderr)
-        sys.exit(1)
+        size = source.size(file_path) if source else file_path.stat().st_size
+    except (FileNotFoundError, KeyError) as e:
+        return _file_info(exists=False, error=e)
+    except OSError as e:
+        return _file_info(error=e)
+    return _file_info(size=size)
 
-def main():
-    parser = argparse.ArgumentParser(
-        description=(
-            "Generate a Markdown document documenting a codebase. "
-            "The document includes a directory tree (as a table of contents) and file contents with syntax highlighting. "
-            "Optionally, you can provide include/exclude glob patterns (relative to the codebase root) to filter files. "
-            "Files matching any .gitignore rules or hardcoded exclusions (from config.json) will be omitted. "
-            "Use --no-gitignore to disable applying .gitignore rules."
-        )
-    )
-    parser.add_argument("input", help="Path to the codebase directory")
-    parser.add_argument(
-        "-o", "--output",
-        default="codebase.md",
-        help="Output Markdown file (default: codebase.md)"
-    )
-    parser.add_argument(
-        "--include",
-        nargs="+",
-        help="Glob pattern(s) for files to include (relative to the codebase root). Only files matching at least one pattern will be included."
-    )
-    parser.add_argument(
-        "--exclude",
-        nargs="+",
-        help="Glob pattern(s) for files to exclude (relative to the codebase root). Files matching any of these patterns will be omitted."
-    )
-    parser.add_argument(
-        "--no-gitignore",
-        action="store_true",
-        help="Disable applying .gitignore file exclusions."
-    )
-    args = parser.parse_args()
+# Asynchronous scan-and-read pipeline, for filesystems where every stat and
+# read is a network round trip (NFS, SSHFS, FUSE). Blocking calls run on a
+# bounded thread pool while the event loop keeps many of them in flight;
+# results come back in the same order as the serial code paths produce them.
 
-    root = pathlib.Path(args.input)
-    if not root.exists() or not root.is_dir():
-        parser.error(f"The input path '{args.input}' is not a valid directory.")
+ASYNC_READ_BUFFER = 64 << 20  # decoded content held ahead of the consumer, in bytes
 
-    if args.no_gitignore:
-        gitignore_spec = None
-    else:
-        gitignore_spec = load_gitignore_specs(root)
+def _list_directory(
+    path: str, exclusions: Optional[ScanExclusions] = None
+) -> Tuple[List[str], List[str], Optional[OSError]]:
+    """
+    The entries of one directory as rglob + is_file sees them: (names of
+    subdirectories to descend into, names of regular files, error). Symlinked
+    directories are not descended into; symlinks to files count as files.
+    Entries excluded by exclusions are skipped before they are stat'ed, as
+    WorkspaceIndex does.
+    """
+    dirs, files = [], []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if exclusions and exclusions.excludes_entry(entry.name):
+                    continue
+                try:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            dirs.append(entry.name)
+                    elif entry.is_file():
+                        if exclusions and exclusions.excludes_file(entry.name):
+                            continue
+                        files.append(entry.name)
+                except OSError:
+                    pass
+    except OSError as e:
+        return dirs, files, e
+    return dirs, files, None
 
-    cli_excludes = args.exclude if args.exclude else []
-    hardcoded_excludes = config_data.get("HARD_CODED_EXCLUDES", [])
-    combined_excludes = cli_excludes + hardcoded_excludes
+def _excluded_directory(rel: str, exclude_patterns: Optional[List[str]]) -> bool:
+    """
+    Whether every file below the directory rel matches one of exclude_patterns
+    (as should_include_file matches them): a pattern ending in "*" that
+    matches "rel/" matches anything below it too.
+    """
+    return bool(exclude_patterns) and any(
+        pattern.endswith("*") and fnmatch.fnmatch(rel + "/", pattern) for pattern in exclude_patterns)
+
+async def scan_tree_async(
+    root: pathlib.Path,
+    concurrency: int = 32,
+    executor: Optional[concurrent.futures.Executor] = None,
+    exclusions: Optional[ScanExclusions] = None,
+    exclude_patterns: Optional[List[str]] = None,
+) -> Tuple[List[pathlib.Path], List[pathlib.Path]]:
+    """
+    Walk root with up to concurrency directory listings in flight. Returns
+    (every regular file below root, sorted like sorted(root.rglob("*")) would
+    be; the .gitignore files among them, ordered for load_gitignore_specs).
+    Directories that cannot be listed are reported and skipped.
+    Entries excluded by exclusions (see ScanExclusions) and directories whose
+    whole contents exclude_patterns would exclude are pruned while walking,
+    without being listed.
+    """
+    root = pathlib.Path(root)
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    limit = asyncio.Semaphore(concurrency)
+    found: List[str] = []
+
+    async def walk(rel: str) -> None:
+        path = os.path.join(str(root), *rel.split("/")) if rel else str(root)
+        async with limit:
+            dirs, files, error = await loop.run_in_executor(executor, _list_directory, path, exclusions)
+        if error is not None:
+            print(f"Warning: Could not scan {path}: {error}", file=sys.stderr)
+        prefix = f"{rel}/" if rel else ""
+        found.extend(prefix + name for name in files)
+        await asyncio.gather(*(walk(prefix + name) for name in dirs
+                               if not _excluded_directory(prefix + name, exclude_patterns)))
+
+    try:
+        await walk("")
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+    files = sorted(root.joinpath(*rel.split("/")) for rel in found)
+    gitignores = sorted((rel for rel in found if rel == ".gitignore" or rel.endswith("/.gitignore")),
+                        key=lambda r: (r.count("/"), _rel_sort_key(r)))
+    return files, [root.joinpath(*rel.split("/")) for rel in gitignores]
+
+def scan_tree(
+    root: pathlib.Path,
+    concurrency: int = 32,
+    exclusions: Optional[ScanExclusions] = None,
+    exclude_patterns: Optional[List[str]] = None,
+) -> Tuple[List[pathlib.Path], List[pathlib.Path]]:
+    """Blocking wrapper around scan_tree_async."""
+    return asyncio.run(scan_tree_async(root, concurrency, exclusions=exclusions, exclude_patterns=exclude_patterns))
+
+def _info_bytes(info: Dict[str, Any]) -> int:
+    # Passthrough files count with their size too, so the read-ahead is bounded in bytes whatever the files are.
+    return max(info["size"] or 0, len(info["content"]) if info["content"] is not None else 0)
+
+async def iter_file_infos_async(
+    requests: List[Tuple[pathlib.Path, bool]],
+    hash_content: bool = False,
+    max_open: int = 32,
+    max_buffered: int = ASYNC_READ_BUFFER,
+    executor: Optional[concurrent.futures.Executor] = None,
+    count_blank: bool = False,
+    redactor: Optional["SecretRedactor"] = None,
+):
+    """
+    Asynchronously yield read_file_info(path, hash_content, passthrough,
+    count_blank, redactor) for each (path, passthrough) in requests, in order. Up to max_open files are
+    read at once; no new read is started while the files already read but
+    not yet consumed (passthrough files included) exceed max_buffered bytes.
+    """
+    loop = asyncio.get_running_loop()
+    own_executor = executor is None
+    if own_executor:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_open)
+    requests = list(requests)
+    pending = collections.deque()  # futures in request order, not yet yielded
+    running: Set[asyncio.Future] = set()
+    buffered = 0
+    next_request = 0
+
+    def finished(future: asyncio.Future) -> None:
+        nonlocal buffered
+        running.discard(future)
+        if not future.cancelled() and future.exception() is None:
+            buffered += _info_bytes(future.result())
+
+    def start_reads() -> None:
+        nonlocal next_request
+        while next_request < len(requests) and len(running) < max_open and buffered < max_buffered:
+            path, passthrough = requests[next_request]
+            future = loop.run_in_executor(executor, read_file_info, path, hash_content, passthrough, count_blank,
+                                          redactor)
+            future.add_done_callback(finished)
+            running.add(future)
+            pending.append(future)
+            next_request += 1
+
+    try:
+        start_reads()
+        while pending:
+            head = pending[0]
+            while not head.done():
+                await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                start_reads()
+            pending.popleft()
+            info = head.result()
+            buffered -= _info_bytes(info)
+            yield info
+            start_reads()
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def iter_file_infos(
+    requests: List[Tuple[pathlib.Path, bool]],
+    hash_content: bool = False,
+    concurrency: Optional[int] = None,
+    count_blank: bool = False,
+    redactor: Optional["SecretRedactor"] = None,
+):
+    """
+    Yield read_file_info(path, hash_content, passthrough, count_blank, redactor)
+    for each (path, passthrough) in requests, in order. With a concurrency above 1 the files
+    are read ahead by iter_file_infos_async on a private event loop (reads,
+    and redaction scans, continue on the thread pool while the caller
+    processes earlier files).
+    """
+    if not concurrency or concurrency <= 1:
+        for path, passthrough in requests:
+            yield read_file_info(path, hash_content, passthrough, count_blank, redactor)
+        return
+    loop = asyncio.new_event_loop()
+    infos = iter_file_infos_async(requests, hash_content, max_open=concurrency, count_blank=count_blank,
+                                  redactor=redactor)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(infos.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(infos.aclose())
+        loop.close()
+
+def _compile_gitignores(rels, read_bytes, root: pathlib.Path) -> pathspec.PathSpec:
+    """
+    Compile the .gitignore files among rels (POSIX-style paths relative to
+    root, read with read_bytes(root / rel)) like load_gitignore_specs does.
+    """
+    patterns = []
+    for rel in sorted((rel for rel in rels if rel == ".gitignore" or rel.endswith("/.gitignore")),
+                      key=lambda r: (r.count("/"), _rel_sort_key(r))):
+        try:
+            lines = read_bytes(root.joinpath(*rel.split("/"))).decode("utf-8", "replace").splitlines()
+        except (OSError, KeyError) as e:
+            print(f"Warning: Could not read {rel}: {e}", file=sys.stderr)
+            continue
+        patterns.extend(_gitignore_patterns(lines, pathlib.Path(_parent_rel(rel))))
+    patterns.append("**/.gitignore")
+    return pathspec.PathSpec.from_lines("gitwildmatch", patterns)
+
+class _SliceReader(io.RawIOBase):
+    """
+    A binary stream over the next size bytes of a file object f, or over
+    size bytes from offset if given (seeking before every read, so f can be
+    shared). On close, on_close (if given) is called with the number of bytes
+    left unread.
+    """
+
+    def __init__(self, f, size: int, offset: Optional[int] = None, on_close=None):
+        super().__init__()
+        self.f = f
+        self.remaining = size
+        self.offset = offset
+        self.on_close = on_close
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = min(len(buffer), self.remaining)
+        if count <= 0:
+            return 0
+        if self.offset is not None:
+            self.f.seek(self.offset)
+        data = self.f.read(count)
+        count = len(data)
+        if not count:
+            raise OSError("Unexpected end of data")
+        buffer[:count] = data
+        self.remaining -= count
+        if self.offset is not None:
+            self.offset += count
+        return count
+
+    def close(self) -> None:
+        if not self.closed and self.on_close is not None:
+            self.on_close(self.remaining)
+        super().close()
+
+class GitRevision:
+    """
+    A directory as of a git revision, read straight from the repository's
+    object store without a checkout. The tree is listed once with git ls-tree;
+    blob contents are streamed through one persistent git cat-file --batch
+    process. Paths are those the directory would have if the revision were
+    checked out at root (root may be a subdirectory of the repository).
+    Symlinks and submodules are skipped. Raises ValueError if root is not in
+    a git repository or rev does not name a commit.
+    """
+
+    def __init__(self, root: pathlib.Path, rev: str):
+        self.root = pathlib.Path(root)
+        self.rev = rev
+        prefix = self._git("rev-parse", "--show-prefix").decode("utf-8").strip()
+        self.commit = self._git("rev-parse", "--verify", "--quiet", "--end-of-options",
+                                f"{rev}^{{commit}}").decode("ascii").strip()
+        # rel (POSIX-style, relative to root) -> blob id, in git's tree order
+        self.blobs: Dict[str, str] = {}
+        self.sizes: Dict[str, int] = {}  # rel -> blob size
+        listing = self._git("ls-tree", "-r", "-z", "-l", "--full-tree", self.commit, "--", prefix or ".")
+        for record in listing.split(b"\0"):
+            if not record:
+                continue
+            meta, _, path = record.partition(b"\t")
+            mode, kind, oid, size = meta.split()
+            if kind != b"blob" or mode == b"120000":
+                continue
+            rel = os.fsdecode(path)[len(prefix):]
+            self.blobs[rel] = oid.decode("ascii")
+            self.sizes[rel] = int(size)
+        self._batch = None
+
+    def _git(self, *args: str) -> bytes:
+        try:
+            result = subprocess.run(["git", *args], cwd=self.root, capture_output=True)
+        except OSError as e:
+            raise ValueError(f"Could not run git: {e}")
+        if result.returncode != 0:
+            message = result.stderr.decode("utf-8", "replace").strip() or f"'{self.rev}' is not a commit"
+            raise ValueError(f"git {args[0]} failed: {message}")
+        return result.stdout
+
+    def files(self) -> List[pathlib.Path]:
+        """Every file of the revision below root, as root / path, sorted like sorted(root.rglob("*"))."""
+        return sorted(self.root.joinpath(*rel.split("/")) for rel in self.blobs)
+
+    def gitignore_spec(self) -> pathspec.PathSpec:
+        """The .gitignore rules of the revision, compiled like load_gitignore_specs."""
+        return _compile_gitignores(self.blobs, self.read_bytes, self.root)
+
+    # Object ids sent to cat-file ahead of reading their contents. Small enough
+    # that the requests always fit into the pipe, so writing them never blocks.
+    BATCH_WINDOW = 64
+
+    def _blob_id(self, path: pathlib.Path) -> str:
+        return self.blobs[pathlib.Path(path).relative_to(self.root).as_posix()]
+
+    def _request(self, oid: str) -> None:
+        if self._batch is None:
+            self._batch = subprocess.Popen(["git", "cat-file", "--batch"], cwd=self.root,
+                                           stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._batch.stdin.write(oid.encode("ascii") + b"\n")
+
+    def _response(self, oid: str) -> bytes:
+        header = self._batch.stdout.readline().split()
+        if len(header) != 3:
+            raise OSError(f"git cat-file could not read object {oid} of {self.rev}")
+        data = self._batch.stdout.read(int(header[2]) + 1)  # contents and a newline
+        return data[:-1]
+
+    def read_bytes(self, path: pathlib.Path) -> bytes:
+        """The contents of a file of the revision, given as root / path."""
+        oid = self._blob_id(path)
+        self._request(oid)
+        self._batch.stdin.flush()
+        return self._response(oid)
+
+    def size(self, path: pathlib.Path) -> int:
+        """The size of a file of the revision, given as root / path, without reading it."""
+        return self.sizes[pathlib.Path(path).relative_to(self.root).as_posix()]
+
+    def version(self, path: pathlib.Path) -> str:
+        """A string that changes with the contents of a file, given as root / path: its blob id."""
+        return self._blob_id(path)
+
+    def open(self, path: pathlib.Path):
+        """
+        A binary stream of a file of the revision, given as root / path, read
+        from cat-file as it is consumed; the rest is skipped on close. Close it
+        before any other read.
+        """
+        oid = self._blob_id(path)
+        self._request(oid)
+        self._batch.stdin.flush()
+        header = self._batch.stdout.readline().split()
+        if len(header) != 3:
+            raise OSError(f"git cat-file could not read object {oid} of {self.rev}")
+        return io.BufferedReader(_SliceReader(self._batch.stdout, int(header[2]), on_close=self._skip), _READ_CHUNK)
+
+    def _skip(self, count: int) -> None:
+        """Discard the unread count bytes of a blob and the newline after it."""
+        count += 1
+        while count > 0:
+            data = self._batch.stdout.read(min(count, _READ_CHUNK))
+            if not data:
+                break
+            count -= len(data)
+
+    def file_infos(self, requests: List[Tuple[pathlib.Path, bool]], hash_content: bool = False,
+                   count_blank: bool = False, redactor: Optional["SecretRedactor"] = None):
+        """
+        Yield the read_file_info result for each (path, passthrough) in requests,
+        in order. Up to BATCH_WINDOW blobs are requested ahead.
+        """
+        oids = []
+        for path, _ in requests:
+            try:
+                oids.append(self._blob_id(path))
+            except (KeyError, ValueError):
+                oids.append(None)
+        sent = 0
+        for i, oid in enumerate(oids):
+            if oid is None:
+                yield _file_info(exists=False, error=FileNotFoundError(f"'{requests[i][0]}' is not in {self.rev}"))
+                continue
+            while sent < len(oids) and sent < i + self.BATCH_WINDOW:
+                if oids[sent] is not None:
+                    self._request(oids[sent])
+                sent += 1
+            self._batch.stdin.flush()
+            try:
+                data = self._response(oid)
+            except OSError as e:
+                yield _file_info(error=e)
+                continue
+            yield file_info_from_bytes(data, hash_content, count_blank, redactor)
+
+    def close(self) -> None:
+        if self._batch is not None:
+            self._batch.stdin.close()
+            self._batch.wait()
+            self._batch = None
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz", ".tar.zst", ".tzst")
+
+def is_archive(path: pathlib.Path) -> bool:
+    """True if path names an archive file that ArchiveSource can read."""
+    return path.is_file() and path.name.lower().endswith(ARCHIVE_SUFFIXES)
+
+class ArchiveSource:
+    """
+    The files of a .zip or tar archive (optionally gzip, bzip2, xz or zstd
+    compressed; zstd requires the zstandard package), read without
+    extracting. If every member lies in one top-level directory, that
+    directory is the root, as if the archive had been extracted and BaseGen
+    run on it; otherwise the root is named after the archive.
+
+    Zip members are listed from the central directory and read on demand;
+    so are the members of an uncompressed tar, whose headers are read
+    without their data and whose contents are read in place. Compressed tar
+    streams cannot be read at an offset, so they are decompressed in a
+    single pass in archive order: members that pass
+    include_patterns/exclude_patterns are appended to one spool (in memory
+    up to SPOOL_MEMORY, then a temporary file), so memory use does not grow
+    with the archive and files can then be rendered in sorted order. Links,
+    devices and members with absolute or ".." paths are skipped.
+    """
+
+    SPOOL_MEMORY = 16 << 20
+
+    def __init__(
+        self,
+        archive: pathlib.Path,
+        include_patterns: Optional[List[str]] = None,
+        exclude_patterns: Optional[List[str]] = None,
+    ):
+        self.archive = pathlib.Path(archive)
+        self._zip = None
+        self._spool = None  # the spool, or the archive itself for an uncompressed tar
+        self._members: Dict[str, Any] = {}  # archive path -> ZipInfo, or (offset, size) in the spool
+        name = self.archive.name.lower()
+        try:
+            if name.endswith(".zip"):
+                self._zip = zipfile.ZipFile(self.archive)
+                for info in self._zip.infolist():
+                    is_link = (info.external_attr >> 16) & 0o170000 == 0o120000
+                    member = self._member_name(info.filename)
+                    if member and not info.is_dir() and not is_link:
+                        self._members.setdefault(member, info)
+            else:
+                self._read_tar(include_patterns, exclude_patterns)
+        except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+            self.close()
+            raise ValueError(f"Could not read archive '{self.archive}': {e}")
+
+        tops = {member.split("/", 1)[0] for member in self._members}
+        if len(tops) == 1 and all("/" in member for member in self._members):
+            self.prefix = f"{tops.pop()}/"
+        else:
+            self.prefix = ""
+        stem = self.archive.name[:-len(next(s for s in ARCHIVE_SUFFIXES if name.endswith(s)))]
+        self.root = pathlib.Path(self.prefix.rstrip("/") or stem)
+        st = self.archive.stat()
+        self._stamp = f"{st.st_size}:{st.st_mtime_ns}"  # for version()
+
+    @staticmethod
+    def _member_name(name: str) -> Optional[str]:
+        parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".")]
+        if not parts or ".." in parts or name.startswith(("/", "\\")):
+            return None
+        return "/".join(parts)
+
+    @staticmethod
+    def _wanted(info: tarfile.TarInfo, member: Optional[str], include_patterns: Optional[List[str]],
+                exclude_patterns: Optional[List[str]]) -> bool:
+        if not member or not info.isfile():
+            return False
+        # Patterns are matched below the (possibly single) top-level directory later on,
+        # so check both forms; .gitignore files are always kept for the spec.
+        candidates = {member, member.split("/", 1)[-1]}
+        return member.rsplit("/", 1)[-1] == ".gitignore" or any(
+            should_include_file(pathlib.Path(candidate), pathlib.Path(""), include_patterns, exclude_patterns)
+            for candidate in candidates
+        )
+
+    def _read_tar(self, include_patterns: Optional[List[str]], exclude_patterns: Optional[List[str]]) -> None:
+        if self.archive.name.lower().endswith(".tar"):
+            self._spool = open(self.archive, "rb")
+            try:
+                with tarfile.open(fileobj=self._spool, mode="r:") as tar:
+                    for info in tar:
+                        if info.issparse():
+                            raise tarfile.ReadError("sparse members have to be read as a stream")
+                        member = self._member_name(info.name)
+                        if member not in self._members and self._wanted(info, member, include_patterns,
+                                                                        exclude_patterns):
+                            self._members[member] = (info.offset_data, info.size)
+                return
+            except tarfile.ReadError:
+                # Not an uncompressed tar after all; read it as a stream.
+                self._spool.close()
+                self._spool = None
+                self._members.clear()
+        stream = open(self.archive, "rb")
+        try:
+            if self.archive.name.lower().endswith((".tar.zst", ".tzst")):
+                try:
+                    import zstandard
+                except ImportError:
+                    raise ValueError("Reading .tar.zst archives requires the zstandard package "
+                                     "(pip install zstandard).")
+                stream = zstandard.ZstdDecompressor().stream_reader(stream, closefd=True)
+            self._spool = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MEMORY)
+            with tarfile.open(fileobj=stream, mode="r|*") as tar:
+                for info in tar:
+                    member = self._member_name(info.name)
+                    if member in self._members or not self._wanted(info, member, include_patterns,
+                                                                   exclude_patterns):
+                        continue
+                    offset = self._spool.tell()
+                    shutil.copyfileobj(tar.extractfile(info), self._spool, _READ_CHUNK)
+                    self._members[member] = (offset, self._spool.tell() - offset)
+        finally:
+            stream.close()
+
+    def files(self) -> List[pathlib.Path]:
+        """Every file of the archive, as root / path, sorted like sorted(root.rglob("*"))."""
+        return sorted(self.root.joinpath(*member[len(self.prefix):].split("/")) for member in self._members)
+
+    def gitignore_spec(self) -> pathspec.PathSpec:
+        """The .gitignore rules found in the archive, compiled like load_gitignore_specs."""
+        return _compile_gitignores([member[len(self.prefix):] for member in self._members],
+                                   self.read_bytes, self.root)
+
+    def _entry(self, path: pathlib.Path) -> Any:
+        return self._members[self.prefix + pathlib.PurePath(path).relative_to(self.root).as_posix()]
+
+    def read_bytes(self, path: pathlib.Path) -> bytes:
+        """The contents of a member, given as root / path."""
+        entry = self._entry(path)
+        if self._zip is not None:
+            return self._zip.read(entry)
+        offset, size = entry
+        self._spool.seek(offset)
+        return self._spool.read(size)
+
+    def size(self, path: pathlib.Path) -> int:
+        """The size of a member, given as root / path, without reading it."""
+        entry = self._entry(path)
+        return entry.file_size if self._zip is not None else entry[1]
+
+    def version(self, path: pathlib.Path) -> str:
+        """
+        A string that changes with the contents of a member, given as root /
+        path: its CRC and size in a zip; in a tar, which has no checksums of
+        the contents, the archive's size and mtime with the member's place.
+        """
+        entry = self._entry(path)
+        if self._zip is not None:
+            return f"{entry.CRC:08x}:{entry.file_size}"
+        return f"{self._stamp}:{entry[0]}:{entry[1]}"
+
+    def open(self, path: pathlib.Path):
+        """A binary stream of a member, given as root / path, decompressed or read from the spool as it is consumed."""
+        entry = self._entry(path)
+        if self._zip is not None:
+            return self._zip.open(entry)
+        offset, size = entry
+        return io.BufferedReader(_SliceReader(self._spool, size, offset), _READ_CHUNK)
+
+    def file_infos(self, requests: List[Tuple[pathlib.Path, bool]], hash_content: bool = False,
+                   count_blank: bool = False, redactor: Optional["SecretRedactor"] = None):
+        """Yield the read_file_info result for each (path, passthrough) in requests, in order."""
+        for path, _ in requests:
+            try:
+                data = self.read_bytes(path)
+            except KeyError:
+                yield _file_info(exists=False, error=FileNotFoundError(f"'{path}' is not in {self.archive}"))
+                continue
+            except (OSError, zipfile.BadZipFile, zlib.error) as e:
+                yield _file_info(error=e)
+                continue
+            yield file_info_from_bytes(data, hash_content, count_blank, redactor)
+
+    def close(self) -> None:
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+class FileContents:
+    """
+    Stands in for a file's contents in a list of Markdown lines; the file's
+    bytes are copied into the output by write_markdown_lines without being
+    decoded. Only use it for files read_file_info() marked as passthrough.
+    sha256 is the file's hash if it was computed while scanning it.
+    """
+
+    def __init__(self, path: pathlib.Path, size: int, sha256: Optional[str] = None):
+        self.path = path
+        self.size = size
+        self.sha256 = sha256
+
+class MarkdownWriter:
+    """
+    Binary output for a Markdown document that keeps track of the byte offset
+    written so far. File contents are copied with copy_file_range/sendfile
+    where the OS supports it, falling back to plain reads and writes.
+    Newlines are translated to newline (default os.linesep) like a text-mode
+    file would.
+    """
+
+    def __init__(self, f, newline: Optional[str] = None):
+        self.f = f
+        self.offset = 0
+        self.newline = (newline or os.linesep).encode("ascii")
+        if hasattr(os, "copy_file_range"):
+            self._copy = "copy_file_range"
+        else:
+            self._copy = "sendfile" if hasattr(os, "sendfile") else None
+
+    def write(self, text: str) -> None:
+        data = text.encode("utf-8")
+        if self.newline != b"\n":
+            data = data.replace(b"\n", self.newline)
+        self.f.write(data)
+        self.offset += len(data)
+
+    def write_file(self, contents: FileContents) -> None:
+        """
+        Copy a passthrough file into the output; if it cannot be opened, write
+        the error instead. Raises RuntimeError if the file has become shorter
+        than its scanned size, since the section index and digest describe
+        the scanned contents.
+        """
+        try:
+            src = open(contents.path, "rb")
+        except OSError as e:
+            self.write(f"Error reading file: {e}")
+            return
+        with src:
+            if self.newline != b"\n":
+                data = src.read(contents.size)
+                if len(data) < contents.size:
+                    raise self._truncated(contents, len(data))
+                self.write(data.decode("utf-8"))
+                return
+            # A framed stream (see ChunkedWriter) sends the copied bytes as one frame.
+            frame = getattr(self.f, "raw_frame", None)
+            with frame(contents.size) if frame else contextlib.nullcontext():
+                self._copy_file(src, contents)
+            self.offset += contents.size
+
+    def _copy_file(self, src, contents: FileContents) -> None:
+        self.f.flush()
+        out_fd = self.f.fileno()
+        copied = 0
+        while copied < contents.size and self._copy:
+            try:
+                if self._copy == "copy_file_range":
+                    n = os.copy_file_range(src.fileno(), out_fd, contents.size - copied, copied)
+                else:
+                    n = os.sendfile(out_fd, src.fileno(), copied, contents.size - copied)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.EBADF):
+                    raise
+                # Not supported for this pair of files: try the next method.
+                self._copy = "sendfile" if self._copy == "copy_file_range" and hasattr(os, "sendfile") else None
+                continue
+            if n == 0:
+                raise self._truncated(contents, copied)
+            copied += n
+        if copied < contents.size:
+            src.seek(copied)
+            while copied < contents.size:
+                chunk = src.read(min(_READ_CHUNK, contents.size - copied))
+                if not chunk:
+                    raise self._truncated(contents, copied)
+                self.f.write(chunk)
+                copied += len(chunk)
+
+    @staticmethod
+    def _truncated(contents: FileContents, copied: int) -> RuntimeError:
+        return RuntimeError(f"'{contents.path}' shrank while it was being copied "
+                            f"({copied} of {contents.size} bytes)")
+
+@contextlib.contextmanager
+def open_output(output_file: Any):
+    """
+    Open output_file (a path) for binary writing. An already open binary
+    stream (anything with a write method, e.g. a socket file) is used as is
+    and left open.
+    """
+    if hasattr(output_file, "write"):
+        yield output_file
+    else:
+        with open(output_file, "wb") as f:
+            yield f
+
+def write_markdown_lines(
+    output_file: Any, md_lines: List[Any], newline: Optional[str] = None
+) -> List[Tuple[int, int]]:
+    """
+    Write md_lines to output_file (a path or binary stream, see open_output)
+    exactly as "\\n".join(md_lines) would be written in text mode, without
+    building the joined string. Items may be str or FileContents. newline
+    overrides the platform's line separator (os.linesep). Returns the
+    (start, end) byte offsets of every item.
+    Raises RuntimeError if the output cannot be written.
+    """
+    spans = []
+    try:
+        with open_output(output_file) as f:
+            writer = MarkdownWriter(f, newline)
+            for i, line in enumerate(md_lines):
+                if i:
+                    writer.write("\n")
+                start = writer.offset
+                if isinstance(line, FileContents):
+                    writer.write_file(line)
+                else:
+                    writer.write(line)
+                spans.append((start, writer.offset))
+    except Exception as e:
+        raise RuntimeError(f"Error writing to output file '{output_file}': {e}")
+    return spans
+
+DIGEST_SUFFIX = ".digest"
+# How far into an existing output its digest is looked for (see output_unchanged).
+_DIGEST_HEAD = 4096
+
+class OutputDigest:
+    """
+    Merkle-style digest of a rendered document for reproducible output:
+    SHA-256 over the SHA-256 of each of its parts in order (Markdown lines or
+    records). The part for a passthrough file's contents is the hash computed
+    while scanning it, so no file is read twice. Documents with the same
+    digest are byte-identical.
+    """
+
+    VERSION = 1
+
+    def __init__(self):
+        self.hash = hashlib.sha256(f"basegen-digest-{self.VERSION}\n".encode("ascii"))
+
+    def add_hash(self, sha256: str) -> None:
+        self.hash.update(sha256.encode("ascii") + b"\n")
+
+    def add(self, data: bytes) -> None:
+        self.add_hash(hashlib.sha256(data).hexdigest())
+
+    def add_lines(self, md_lines: List[Any], skip: Optional[int] = None) -> None:
+        """Add the items of md_lines (see write_markdown_lines) except the one at index skip."""
+        for i, line in enumerate(md_lines):
+            if i == skip:
+                continue
+            if isinstance(line, FileContents):
+                self.add_hash(line.sha256)
+            else:
+                self.add(line.encode("utf-8"))
+
+    def hexdigest(self) -> str:
+        return "sha256:" + self.hash.hexdigest()
+
+def output_unchanged(output_file: Any, digest: str, section_index: bool = False) -> bool:
+    """
+    Whether output_file (a path) already holds the document with this digest:
+    its DIGEST_SUFFIX sidecar names the digest and so does the output's header,
+    the output was not modified after the sidecar was written (and with
+    section_index, the section index exists), so it need not be rewritten.
+    """
+    if hasattr(output_file, "write"):
+        return False
+    digest_file = str(output_file) + DIGEST_SUFFIX
+    try:
+        with open(digest_file, "r", encoding="utf-8") as f:
+            if f.read().strip() != digest:
+                return False
+        with open(output_file, "rb") as f:
+            if os.fstat(f.fileno()).st_mtime_ns > os.stat(digest_file).st_mtime_ns:
+                return False
+            head = f.read(_DIGEST_HEAD)
+    except OSError:
+        return False
+    if section_index and not os.path.exists(str(output_file) + SECTION_INDEX_SUFFIX):
+        return False
+    return digest.encode("ascii") in head
+
+def write_digest(output_file: Any, digest: str) -> Optional[str]:
+    """Write the digest sidecar (output_file + DIGEST_SUFFIX) for a path; returns its path."""
+    if hasattr(output_file, "write"):
+        return None
+    digest_file = str(output_file) + DIGEST_SUFFIX
+    try:
+        with open(digest_file, "w", encoding="utf-8", newline="\n") as f:
+            f.write(digest + "\n")
+    except OSError as e:
+        raise RuntimeError(f"Error writing to output file '{digest_file}': {e}")
+    return digest_file
+
+SECTION_INDEX_SUFFIX = ".idx"
+SECTION_INDEX_VERSION = 1
+
+def write_section_index(output_file: str, sections: List[Dict[str, Any]], spans: List[Tuple[int, int]]) -> str:
+    """
+    Write the sidecar index of a document written by write_markdown_lines to
+    output_file + ".idx" and return its path.
+
+    Each section gives "kind" ("header", "toc", "tree" or "file"), the md_lines
+    range it covers as "start"/"end" (end exclusive) and, for files, "path",
+    "sha256" of the source file and the md_lines index of the file contents as
+    "content" (None if the contents are not in the document). spans are the
+    byte spans returned by write_markdown_lines.
+    """
+    entries = []
+    for section in sections:
+        offset = spans[section["start"]][0]
+        entry = {"kind": section["kind"], "offset": offset, "length": spans[section["end"] - 1][1] - offset}
+        if section["kind"] == "file":
+            entry["path"] = section["path"]
+            entry["sha256"] = section.get("sha256")
+            content = section.get("content")
+            if content is not None:
+                entry["content_offset"] = spans[content][0]
+                entry["content_length"] = spans[content][1] - spans[content][0]
+            if section.get("duplicate_of"):
+                entry["duplicate_of"] = section["duplicate_of"]
+        entries.append(entry)
+    index_file = output_file + SECTION_INDEX_SUFFIX
+    data = {
+        "version": SECTION_INDEX_VERSION,
+        "document": os.path.basename(output_file),
+        "document_size": spans[-1][1] if spans else 0,
+        "sections": entries,
+    }
+    try:
+        with open(index_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+    except Exception as e:
+        raise RuntimeError(f"Error writing to output file '{index_file}': {e}")
+    return index_file
+
+class SectionIndex:
+    """
+    Random access to a generated Markdown document through its .idx sidecar:
+    a file's section or contents are read with one seek, without scanning the
+    document. Raises ValueError if the index does not match the document.
+    """
+
+    def __init__(self, document: str, index_file: Optional[str] = None):
+        self.document = document
+        with open(index_file or document + SECTION_INDEX_SUFFIX, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("version") != SECTION_INDEX_VERSION:
+            raise ValueError(f"Unsupported section index version: {data.get('version')}")
+        if os.path.getsize(document) != data["document_size"]:
+            raise ValueError(f"Section index is out of date for '{document}'.")
+        self.sections: List[Dict[str, Any]] = data["sections"]
+        self.files: Dict[str, Dict[str, Any]] = {s["path"]: s for s in self.sections if s["kind"] == "file"}
+
+    def paths(self) -> List[str]:
+        """Paths of the files in the document, in document order."""
+        return list(self.files)
+
+    def _read(self, offset: int, length: int) -> str:
+        with open(self.document, "rb") as f:
+            f.seek(offset)
+            return f.read(length).decode("utf-8")
+
+    def section(self, path: str) -> str:
+        """The Markdown section (heading, fenced contents) of a file. Raises KeyError for unknown paths."""
+        entry = self.files[path]
+        return self._read(entry["offset"], entry["length"])
+
+    def file_content(self, path: str) -> Optional[str]:
+        """
+        The contents of a file as included in the document (following
+        duplicates to their first copy), or None if they are not included.
+        """
+        entry = self.files[path]
+        if "duplicate_of" in entry:
+            entry = self.files[entry["duplicate_of"]]
+        if "content_offset" not in entry:
+            return None
+        return self._read(entry["content_offset"], entry["content_length"])
+
+    def block(self, kind: str) -> Optional[str]:
+        """The first section of the given kind ("header", "toc" or "tree"), or None if absent."""
+        for entry in self.sections:
+            if entry["kind"] == kind:
+                return self._read(entry["offset"], entry["length"])
+        return None
+
+class ContentDeduplicator:
+    """
+    Remembers the first file seen with each content hash, so that later files
+    with identical contents can be rendered as a reference to it.
+    """
+
+    def __init__(self):
+        self.first_seen: Dict[str, Any] = {}
+        self.duplicates = 0
+        self.bytes_saved = 0
+
+    def original_of(self, digest: str, path: Any, size: int) -> Optional[Any]:
+        """Register a file; return the earlier path with the same contents, or None if it is the first."""
+        if digest not in self.first_seen:
+            self.first_seen[digest] = path
+            return None
+        original = self.first_seen[digest]
+        if original == path:
+            return None
+        self.duplicates += 1
+        self.bytes_saved += size
+        return original
+
+    def summary(self) -> str:
+        return f"{self.duplicates} duplicate file(s), {format_size(self.bytes_saved)} saved"
+
+# Default content classifier rules; the "CONTENT_CLASSIFIER" object in
+# config.json overrides them key by key. Markers are regular expressions
+# searched in the first head_bytes of a file, category by category in order.
+DEFAULT_CLASSIFIER_RULES = {
+    "head_bytes": 4096,
+    "markers": {
+        "lockfile": [
+            r"^# yarn lockfile v1",
+            r"^# This file is automatically @generated by (Cargo|Poetry)",
+            r"^lockfileVersion:",
+            r'^\s*"lockfileVersion":',
+            r'^\s*"_readme": \[\s*"This file locks the dependencies',
+            r"^GEM\r?\n  remote:",
+        ],
+        "generated": [
+            r"Code generated .* DO NOT EDIT",
+            r"Generated by the (protocol buffer compiler|gRPC .* protocol compiler plugin)",
+            r"@generated\b",
+            r"<auto-generated\s*/?>",
+            r"Autogenerated by Thrift Compiler",
+            r"(?i:this file (is|was) (automatically|auto-)generated)",
+        ],
+    },
+    "minified": {
+        "min_bytes": 1024,
+        "max_average_line_length": 300,
+        "min_whitespace_ratio": 0.03,
+    },
+}
+
+CLASSIFY_ACTIONS = ("collapse", "exclude")
+
+class ContentClassifier:
+    """
+    Recognises generated, minified and lock files from their first few KB, for
+    the files path globs cannot catch. A file is matched against the marker
+    categories in order; failing those, a sample of at least min_bytes whose
+    average line is longer than max_average_line_length or whose share of
+    whitespace is below min_whitespace_ratio is "minified". Counts files and
+    bytes per category so they can be reported.
+    """
+
+    _WHITESPACE = b" \t\r\n\f\v"
+
+    def __init__(self, rules: Optional[Dict[str, Any]] = None):
+        rules = dict(DEFAULT_CLASSIFIER_RULES, **(rules or {}))
+        self.head_bytes = int(rules["head_bytes"])
+        # One alternation with a group per category, so the head is searched once.
+        self.categories = [category for category, markers in rules["markers"].items() if markers]
+        alternatives = [f"(?P<c{i}>" + "|".join(f"(?:{marker})" for marker in rules["markers"][category]) + ")"
+                        for i, category in enumerate(self.categories)]
+        self.markers = re.compile("|".join(alternatives).encode("utf-8"), re.MULTILINE) if alternatives else None
+        minified = dict(DEFAULT_CLASSIFIER_RULES["minified"], **rules.get("minified", {}))
+        self.min_bytes = int(minified["min_bytes"])
+        self.max_average_line_length = float(minified["max_average_line_length"])
+        self.min_whitespace_ratio = float(minified["min_whitespace_ratio"])
+        self.counts: Dict[str, List[int]] = {}  # category -> [files, bytes]
+
+    def classify(self, head: bytes) -> Optional[str]:
+        """The category of a file given its first head_bytes, or None for an ordinary file."""
+        if self.markers:
+            match = self.markers.search(head)
+            if match:
+                return self.categories[int(match.lastgroup[1:])]
+        if len(head) >= self.min_bytes and b"\x00" not in head:
+            if len(head) / (head.count(b"\n") + 1) > self.max_average_line_length:
+                return "minified"
+            whitespace = len(head) - len(head.translate(None, self._WHITESPACE))
+            if whitespace < self.min_whitespace_ratio * len(head):
+                return "minified"
+        return None
+
+    def classify_file(self, path: pathlib.Path, source: Any = None) -> Optional[str]:
+        """Read the head of path (from source if given) and classify it, counting the result."""
+        try:
+            if source:
+                size = source.size(path)
+                with source.open(path) as f:
+                    head = f.read(self.head_bytes)
+            else:
+                with open(path, "rb") as f:
+                    head = f.read(self.head_bytes)
+                    size = os.fstat(f.fileno()).st_size
+        except OSError:
+            return None
+        category = self.classify(head)
+        if category:
+            counts = self.counts.setdefault(category, [0, 0])
+            counts[0] += 1
+            counts[1] += size
+        return category
+
+    def select(
+        self, base: pathlib.Path, included_files: List[pathlib.Path], action: str, source: Any = None
+    ) -> Tuple[List[pathlib.Path], Dict[str, str]]:
+        """
+        Classify included_files (relative to base). With action "exclude" the
+        classified files are dropped; with "collapse" they are kept and returned
+        as a map of str(file path) to category, for the renderers to show in
+        place of their content.
+        """
+        kept = []
+        collapsed = {}
+        for rel_path in included_files:
+            category = self.classify_file(base / rel_path, source)
+            if category and action == "exclude":
+                continue
+            if category:
+                collapsed[str(base / rel_path)] = category
+            kept.append(rel_path)
+        return kept, collapsed
+
+    def summary(self, action: str) -> str:
+        if not self.counts:
+            return "Classifier: no generated, minified or lock files found"
+        parts = [f"{files} {category}" for category, (files, _) in sorted(self.counts.items())]
+        total = sum(size for _, size in self.counts.values())
+        verb = "excluded" if action == "exclude" else "collapsed"
+        return f"Classifier: {', '.join(parts)} file(s) {verb} ({format_size(total)})"
+
+# Default secret rules; the "SECRET_REDACTION" object in config.json overrides
+# them. A rule is a regular expression (or a list of alternatives), or an
+# object with "pattern" plus optional conditions: "preceded_by", an expression
+# the text just before the match must end with, and "min_entropy", the Shannon
+# entropy (bits per character) the secret must reach. If an expression has a
+# group named "secret", only that part is redacted. The expressions are
+# combined into one alternation compiled with re.MULTILINE, so inline flags
+# must be scoped ("(?i:...)") and groups referred to by name. As long as every
+# expression starts with a literal character the scan stays fast, since the
+# search can then skip ahead to candidate characters.
+DEFAULT_REDACTION_RULES = {
+    "rules": {
+        "private_key": r"-----BEGIN [A-Z ]*PRIVATE KEY( BLOCK)?-----[\s\S]*?-----END [A-Z ]*PRIVATE KEY( BLOCK)?-----",
+        "aws_access_key": r"A(?<!\wA)(KIA|SIA)[0-9A-Z]{16}(?![0-9A-Za-z])",
+        "github_token": r"gh(?<!\wgh)([pousr]_[A-Za-z0-9]{36,}|ithub_pat_[A-Za-z0-9_]{40,})",
+        "slack_token": r"xox(?<!\wxox)[abposr]-[A-Za-z0-9-]{10,}",
+        "stripe_key": r"sk_(?<!\wsk_)(live|test)_[A-Za-z0-9]{16,}",
+        "google_api_key": r"AIza(?<!\wAIza)[0-9A-Za-z_-]{35}",
+        "api_key": r"sk-(?<!\wsk-)[A-Za-z0-9_-]{20,}",
+        "jwt": r"eyJ(?<!\weyJ)[A-Za-z0-9_-]{8,}\.eyJ[A-Za-z0-9_-]{8,}\.[A-Za-z0-9_-]{8,}",
+        "credential_url": r"""://[^\s:/@"']+:(?P<secret>[^\s:/@"']+)@""",
+        "assigned_secret": {
+            "pattern": [
+                r"""=[ \t]*["'](?P<secret>[^\s"']{8,})["']""",
+                r""":[ \t]*["'](?P<secret>[^\s"']{8,})["']""",
+                r"""=(?P<secret>[^\s"'$#(){}\[\],;<>]{8,})(?=[ \t]*(#|$))""",
+            ],
+            "preceded_by": r"""(?i:api_?key|secret|token|passw(or)?d|pwd|credentials?)(?i:_?\w*key)?["']?[ \t]*""",
+            "min_entropy": 2.5,
+        },
+        "high_entropy": {
+            "pattern": [
+                r'"(?P<secret>[A-Za-z0-9+/_-]{32,}={0,2})"',
+                r"'(?P<secret>[A-Za-z0-9+/_-]{32,}={0,2})'",
+                r"=[ \t]*(?P<secret>[A-Za-z0-9+/_-]{32,}={0,2})(?=[ \t]*(#|$))",
+                r":[ \t]*(?P<secret>[A-Za-z0-9+/_-]{32,}={0,2})(?=[ \t]*(#|$))",
+            ],
+            "min_entropy": 4.3,
+        },
+    },
+}
+
+# Named groups and their backreferences in a rule expression.
+_GROUP_NAME = re.compile(r"\(\?P([<=])(\w+)")
+
+def _shannon_entropy(text: str) -> float:
+    """Bits per character of text."""
+    length = len(text)
+    return -sum(count / length * math.log2(count / length) for count in collections.Counter(text).values())
+
+class SecretRedactor:
+    """
+    Replaces secrets (private key blocks, API keys and tokens, passwords in
+    assignments and URLs, high-entropy strings) with "[REDACTED:<rule>]".
+
+    All rule expressions are searched together as one alternation. Where a
+    candidate's conditions do not hold, the other expressions are tried at
+    the same position and the search goes on one character later, so
+    secrets inside rejected candidates (such as a password in a URL in a
+    quoted string) are still found. Of overlapping candidates the leftmost
+    wins, the earlier rule at the same position. Counts redactions per rule
+    and the files that had any, so they can be reported.
+
+    scan() only reads shared state, so files can be scanned on the
+    read-ahead workers (see read_file_info); tally() counts a scanned file
+    once it is rendered.
+
+    The hashes of contents found to hold no secrets are appended to a log in
+    the cache directory (per rule set, see save()), so unchanged files are
+    not scanned again on later runs.
+    """
+
+    CACHE_VERSION = 2
+    CACHE_LIMIT = 1 << 20  # hashes in the log before it is pruned to those used by a run
+
+    def __init__(self, rules: Optional[Dict[str, Any]] = None):
+        rules = dict(DEFAULT_REDACTION_RULES, **(rules or {}))
+        key = json.dumps([self.CACHE_VERSION, rules], sort_keys=True).encode("utf-8")
+        self.cache_path = get_cache_dir() / f"redaction-{hashlib.sha1(key).hexdigest()[:16]}.clean"
+        self.clean = self._load_clean()
+        self.used: Set[bytes] = set()  # hashes from the log that this run needed
+        self.new_clean: List[bytes] = []
+        self.names: List[str] = []
+        self.preceded_by: List[Optional[re.Pattern]] = []
+        self.min_entropy: List[float] = []
+        self.branches: List[Tuple[int, Any]] = []  # (rule, group to redact in the combined expression)
+        alternatives = []
+        for name, rule in rules["rules"].items():
+            if not rule:
+                continue
+            if not isinstance(rule, dict):
+                rule = {"pattern": rule}
+            patterns = rule["pattern"] if isinstance(rule["pattern"], list) else [rule["pattern"]]
+            i = len(self.names)
+            self.names.append(name)
+            self.preceded_by.append(re.compile(f"(?:{rule['preceded_by']})\\Z", re.MULTILINE)
+                                    if rule.get("preceded_by") else None)
+            self.min_entropy.append(float(rule.get("min_entropy", 0.0)))
+            for pattern in patterns:
+                k = len(self.branches)
+                compiled = re.compile(pattern, re.MULTILINE)
+                self.branches.append((i, f"_{k}_secret" if "secret" in compiled.groupindex else 0))
+                unique = _GROUP_NAME.sub(lambda m: f"(?P{m[1]}_{k}_{m[2]}", pattern)
+                alternatives.append(f"(?:{unique})(?P<_{k}>)")
+        # expressions[k] tries the branches from k on. Each alternative ends in an empty group
+        # "_<branch>", so a match's lastgroup names its branch.
+        self.expressions = [re.compile("|".join(alternatives[k:]), re.MULTILINE) for k in range(len(alternatives))]
+        self.lock = threading.Lock()
+        self.counts: Dict[str, int] = {}
+        self.files = 0
+
+    def _span(self, i: int, match: re.Match, group: Any) -> Optional[Tuple[int, int]]:
+        """The span to redact for a match of rule i, or None if the rule's conditions do not hold."""
+        start, end = match.span(group)
+        content = match.string
+        if self.preceded_by[i] and not self.preceded_by[i].search(content, max(0, match.start() - 64),
+                                                                  match.start()):
+            return None
+        if self.min_entropy[i] and _shannon_entropy(content[start:end]) < self.min_entropy[i]:
+            return None
+        return start, end
+
+    def _load_clean(self) -> Set[bytes]:
+        try:
+            data = self.cache_path.read_bytes()
+        except OSError:
+            return set()
+        return {data[i:i + 16] for i in range(0, len(data) - 15, 16)}
+
+    def save(self) -> None:
+        """
+        Append the hashes of the contents found clean in this run to the log.
+        Once it holds more than CACHE_LIMIT hashes it is rewritten with only
+        those this run used. Errors are ignored, it is only an optimisation.
+        """
+        if not self.new_clean:
+            return
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            if len(self.clean) <= self.CACHE_LIMIT:
+                # One append per run, so concurrent runs do not interleave hashes.
+                with open(self.cache_path, "ab") as f:
+                    f.write(b"".join(self.new_clean))
+            else:
+                tmp_path = self.cache_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+                tmp_path.write_bytes(b"".join(sorted(self.used.union(self.new_clean))))
+                os.replace(tmp_path, self.cache_path)
+            self.new_clean = []
+        except OSError:
+            pass
+
+    def scan(self, content: str) -> Tuple[str, Dict[str, int]]:
+        """Return content with its secrets redacted and the number of secrets per rule, without counting them."""
+        if not self.expressions:
+            return content, {}
+        digest = hashlib.blake2b(content.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        if digest in self.clean:
+            self.used.add(digest)
+            return content, {}
+        pieces = []
+        counts: Dict[str, int] = {}
+        last = pos = 0
+        while True:
+            match = self.expressions[0].search(content, pos)
+            if match is None:
+                break
+            start = match.start()
+            span = None
+            while match is not None:
+                k = int(match.lastgroup[1:])
+                i, group = self.branches[k]
+                span = self._span(i, match, group)
+                if span is not None:
+                    break
+                # Rejected: the later branches may still match here.
+                match = self.expressions[k + 1].match(content, start) if k + 1 < len(self.expressions) else None
+            if span is None:
+                pos = start + 1
+                continue
+            name = self.names[i]
+            pieces.append(content[last:span[0]])
+            pieces.append(f"[REDACTED:{name}]")
+            last = span[1]
+            pos = max(match.end(), start + 1)
+            counts[name] = counts.get(name, 0) + 1
+        if not counts:
+            self.clean.add(digest)
+            self.new_clean.append(digest)
+            return content, counts
+        pieces.append(content[last:])
+        return "".join(pieces), counts
+
+    def tally(self, counts: Dict[str, int]) -> None:
+        """Count the redactions scan() reported for a file."""
+        if not counts:
+            return
+        with self.lock:
+            for name, count in counts.items():
+                self.counts[name] = self.counts.get(name, 0) + count
+            self.files += 1
+
+    def redact(self, content: str) -> str:
+        content, counts = self.scan(content)
+        self.tally(counts)
+        return content
+
+    def summary(self) -> str:
+        if not self.counts:
+            return "Redaction: no secrets found"
+        parts = [f"{count} {name}" for name, count in sorted(self.counts.items(), key=lambda item: -item[1])]
+        return f"Redaction: {sum(self.counts.values())} secret(s) in {self.files} file(s) ({', '.join(parts)})"
+
+# Sentinels used while stripping: where a comment was cut, and newlines that
+# belong to a string literal (those lines must survive blank-line collapsing).
+_STRIP_MARK = "\x00"
+_STRING_NEWLINE = "\x01"
+
+def _tidy_stripped(text: str) -> str:
+    """
+    Finish a stripped text: drop lines left empty by a removed comment, trim the
+    whitespace a trailing comment leaves behind, collapse runs of blank lines
+    into one and restore the newlines protected inside string literals.
+    """
+    lines = []
+    previous_blank = True  # also drops blank lines at the top of the file
+    for line in text.split("\n"):
+        if _STRIP_MARK in line:
+            line = line.replace(_STRIP_MARK, "").rstrip()
+            if not line:
+                continue
+        if not line.strip():
+            if not previous_blank:
+                lines.append("")
+            previous_blank = True
+            continue
+        previous_blank = False
+        lines.append(line)
+    if lines and lines[-1] == "" and not text.endswith("\n"):
+        lines.pop()
+    return "\n".join(lines).replace(_STRING_NEWLINE, "\n")
+
+class _CommentLexer:
+    """
+    Regex driven lexer for languages whose comments and strings can be found
+    without parsing: C-like block/line comments, hash comments, and the string
+    literal forms given by the language. Strings are copied untouched.
+    """
+
+    _REGEX_PRECEDERS = set("(,=:[!&|?{};+-*%<>~^")
+    _REGEX_KEYWORDS = {"return", "typeof", "case", "in", "of", "new", "delete", "void",
+                       "throw", "yield", "await", "else", "do"}
+    _REGEX_LITERAL = re.compile(r"/(?![*/])(?:\\.|\[(?:\\.|[^\]\\\n])*\]|[^/\\\n\[])+/[A-Za-z]*")
+
+    def __init__(
+        self,
+        strings: List[str],
+        line_comment: Optional[str] = "//",
+        block_comments: bool = True,
+        nested_blocks: bool = False,
+        regex_literals: bool = False,
+        templates: bool = False,
+        hash_after_space: bool = False,
+        extra_code: Optional[List[str]] = None,
+    ):
+        self.nested_blocks = nested_blocks
+        self.regex_literals = regex_literals
+        self.templates = templates
+        comments = []
+        if line_comment == "#" and hash_after_space:
+            # Shell: '#' only starts a comment at the start of a word.
+            comments.append(r"(?<![^\s;|&()])#[^\n]*")
+        elif line_comment:
+            comments.append(re.escape(line_comment) + r"[^\n]*")
+        if block_comments:
+            comments.append(r"/\*")
+        special = "\"'`/#@<\\\\$"
+        code = list(extra_code or []) + [r"\\.", r"[A-Za-z_][\w$]*", r"\w+", rf"[^\w{special}]+", r"."]
+        self.pattern = re.compile(
+            "(?P<string>" + "|".join(strings) + ")"
+            + ("|(?P<comment>" + "|".join(comments) + ")" if comments else "")
+            + "|(?P<code>" + "|".join(code) + ")",
+            re.S,
+        )
+
+    def _block_end(self, text: str, pos: int) -> int:
+        """Return the offset just past the block comment starting at pos."""
+        if not self.nested_blocks:
+            end = text.find("*/", pos + 2)
+            return len(text) if end < 0 else end + 2
+        depth = 0
+        for m in re.compile(r"/\*|\*/").finditer(text, pos):
+            depth += 1 if m.group() == "/*" else -1
+            if depth == 0:
+                return m.end()
+        return len(text)
+
+    _TEMPLATE_STOP = re.compile(r"[\\`$]")
+    _SUBSTITUTION_STOP = re.compile(r"[\\'\"`{}]")
+
+    def _template_end(self, text: str, pos: int) -> int:
+        """Return the offset just past the template literal starting at pos; ${...} may nest."""
+        pos += 1
+        while True:
+            m = self._TEMPLATE_STOP.search(text, pos)
+            if not m:
+                return len(text)
+            pos = m.end()
+            if m.group() == "`":
+                return pos
+            if m.group() == "\\":
+                pos += 1
+            elif text.startswith("{", pos):
+                pos = self._substitution_end(text, pos + 1)
+
+    def _substitution_end(self, text: str, pos: int) -> int:
+        """Return the offset just past the "}" closing a ${ substitution whose body starts at pos."""
+        depth = 1
+        while True:
+            m = self._SUBSTITUTION_STOP.search(text, pos)
+            if not m:
+                return len(text)
+            ch = m.group()
+            pos = m.end()
+            if ch == "`":
+                pos = self._template_end(text, m.start())
+            elif ch in "'\"":
+                string = re.compile(_DOUBLE_QUOTED if ch == '"' else _SINGLE_QUOTED).match(text, m.start())
+                if string:
+                    pos = string.end()
+            elif ch == "\\":
+                pos += 1
+            elif ch == "{":
+                depth += 1
+            else:
+                depth -= 1
+                if depth == 0:
+                    return pos
+
+    def __call__(self, text: str, docstrings: bool = False) -> str:
+        pieces = []
+        pos = 0
+        if text.startswith("#!"):
+            pos = text.find("\n") + 1 or len(text)
+            pieces.append(text[:pos])
+        previous = ""  # last significant code token, for regex literal detection
+        match = self.pattern.match
+        while pos < len(text):
+            m = match(text, pos)
+            kind = m.lastgroup
+            token = m.group()
+            end = m.end()
+            if kind == "comment" and token == "/*":
+                end = self._block_end(text, pos)
+                before = text[pos - 1:pos]
+                after = text[end:end + 1]
+                # Keep tokens on either side of an inline comment apart.
+                if before and after and not before.isspace() and not after.isspace():
+                    pieces.append(" ")
+                else:
+                    pieces.append(_STRIP_MARK)
+            elif kind == "comment":
+                pieces.append(_STRIP_MARK)
+            elif kind == "code" and token == "/" and self.regex_literals and (
+                    not previous or previous[-1] in self._REGEX_PRECEDERS or previous in self._REGEX_KEYWORDS):
+                literal = self._REGEX_LITERAL.match(text, pos)
+                if literal:
+                    end = literal.end()
+                    pieces.append(literal.group())
+                    previous = "/"
+                else:
+                    pieces.append(token)
+                    previous = token
+            elif kind == "string" or (token == "`" and self.templates):
+                if kind != "string":
+                    end = self._template_end(text, pos)
+                    token = text[pos:end]
+                pieces.append(token.replace("\n", _STRING_NEWLINE))
+                previous = '"'
+            else:
+                pieces.append(token)
+                if not token.isspace():
+                    previous = token.strip()
+            pos = end
+        return _tidy_stripped("".join(pieces))
+
+def _strip_python(text: str, docstrings: bool = False) -> Optional[str]:
+    """
+    Strip Python comments (keeping a shebang) and, with docstrings, module,
+    class and function docstrings, using the tokenize module so that strings
+    are never mistaken for comments. A docstring that is the only statement
+    of its body is replaced by "..." to keep the code valid.
+    Returns None if the source cannot be tokenized.
+    """
+    import tokenize
+
+    line_offsets = [0]
+    for line in text.splitlines(keepends=True):
+        line_offsets.append(line_offsets[-1] + len(line))
+
+    def offset(position):
+        row, col = position
+        return line_offsets[row - 1] + col
+
+    try:
+        tokens = list(tokenize.generate_tokens(io.StringIO(text).readline))
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+    edits = []  # (start, end, replacement)
+    strings = []  # (start, end) of string literals
+    fstring_start = getattr(tokenize, "FSTRING_START", None)
+    fstring_end = getattr(tokenize, "FSTRING_END", None)
+    fstring_depth = 0
+    skip = {tokenize.NL, tokenize.COMMENT, tokenize.INDENT, tokenize.DEDENT}
+    expect_docstring = True  # at module start, or right after a def/class header
+    in_block = False
+    line_start = True
+    header = None
+    for i, tok in enumerate(tokens):
+        if tok.type == tokenize.COMMENT:
+            if not (tok.start == (1, 0) and tok.string.startswith("#!")):
+                edits.append((offset(tok.start), offset(tok.end), _STRIP_MARK))
+            continue
+        if tok.type == fstring_start:
+            if fstring_depth == 0:
+                fstring_from = offset(tok.start)
+            fstring_depth += 1
+            continue
+        if tok.type == fstring_end:
+            fstring_depth -= 1
+            if fstring_depth == 0:
+                strings.append((fstring_from, offset(tok.end)))
+            continue
+        if tok.type == tokenize.STRING:
+            strings.append((offset(tok.start), offset(tok.end)))
+        if tok.type == tokenize.INDENT and header in ("def", "class"):
+            # An indented body right after a def/class header may open with a docstring.
+            expect_docstring = in_block = True
+            header = None
+            continue
+        if tok.type in skip:
+            continue
+        if tok.type == tokenize.NEWLINE:
+            line_start = True
+            continue
+        if line_start:
+            line_start = False
+            if (docstrings and expect_docstring and tok.type == tokenize.STRING
+                    and tokens[i + 1].type in (tokenize.NEWLINE, tokenize.ENDMARKER)):
+                following = i + 2
+                while following < len(tokens) and tokens[following].type in (tokenize.NL, tokenize.COMMENT):
+                    following += 1
+                only_statement = in_block and tokens[following].type in (tokenize.DEDENT, tokenize.ENDMARKER)
+                edits.append((offset(tok.start), offset(tok.end), "..." if only_statement else _STRIP_MARK))
+                strings.pop()
+            expect_docstring = False
+            header = tok.string
+            if header == "async" and tokens[i + 1].type == tokenize.NAME:
+                header = tokens[i + 1].string
+
+    for start, end in strings:
+        edits.append((start, end, None))
+    edits.sort()
+    pieces = []
+    pos = 0
+    for start, end, replacement in edits:
+        pieces.append(text[pos:start])
+        if replacement is None:
+            pieces.append(text[start:end].replace("\n", _STRING_NEWLINE))
+        else:
+            pieces.append(replacement)
+        pos = end
+    pieces.append(text[pos:])
+    return _tidy_stripped("".join(pieces))
+
+_YAML_BLOCK_SCALAR = re.compile(r"(?:^|[\s:-])[|>][1-9+-]{0,2}$")
+
+def _strip_yaml(text: str, docstrings: bool = False) -> str:
+    """
+    Strip YAML comments. A quote only opens a string at the start of a scalar,
+    and block scalars (| and >) are copied untouched.
+    """
+    pieces = []
+    block_indent = None  # indentation of the line that opened a block scalar
+    quote = None  # quote of a quoted scalar continuing onto the next line
+    for line in text.split("\n"):
+        content = line.lstrip(" ")
+        indent = len(line) - len(content)
+        if block_indent is not None:
+            if not content.strip() or indent > block_indent:
+                pieces.append(_STRING_NEWLINE + line)
+                continue
+            block_indent = None
+        if pieces and quote:
+            pieces.append(_STRING_NEWLINE)
+        elif pieces:
+            pieces.append("\n")
+        cut = len(line)
+        previous = " "
+        i = 0
+        while i < len(line):
+            ch = line[i]
+            if quote:
+                if ch == "\\" and quote == '"':
+                    i += 1
+                elif ch == quote:
+                    if quote == "'" and line[i + 1:i + 2] == "'":
+                        i += 1
+                    else:
+                        quote = None
+            elif ch in "\"'" and (not line[:i].strip() or line[:i].rstrip()[-1] in ":-[{,?"):
+                quote = ch
+            elif ch == "#" and previous.isspace():
+                cut = i
+                break
+            previous = ch
+            i += 1
+        code = line[:cut]
+        if cut < len(line):
+            code += _STRIP_MARK
+        pieces.append(code)
+        if not quote and _YAML_BLOCK_SCALAR.search(line[:cut].rstrip()):
+            block_indent = indent
+    return _tidy_stripped("".join(pieces))
+
+_DOUBLE_QUOTED = r'"(?:\\.|[^"\\\n])*"'
+_SINGLE_QUOTED = r"'(?:\\.|[^'\\\n])*'"
+_TRIPLE_QUOTED = r'"""[\s\S]*?"""'
+_C_STRIPPER = _CommentLexer([_DOUBLE_QUOTED, _SINGLE_QUOTED])
+_JVM_STRIPPER = _CommentLexer([_TRIPLE_QUOTED, _DOUBLE_QUOTED, _SINGLE_QUOTED], nested_blocks=True)
+_CSS_URL = r"url\([^)\"'\n]*\)"
+
+# Comment strippers keyed by the language guess_language() returns.
+STRIPPERS = {
+    "python": _strip_python,
+    "javascript": _CommentLexer(
+        [_DOUBLE_QUOTED, _SINGLE_QUOTED], regex_literals=True, templates=True),
+    "json": _CommentLexer([_DOUBLE_QUOTED]),
+    "rust": _CommentLexer(
+        [r'b?r(?P<hashes>#*)"[\s\S]*?"(?P=hashes)', r'b?"(?:\\.|[^"\\])*"',
+         r"b?'(?:\\(?:u\{[0-9a-fA-F]{1,6}\}|x[0-9a-fA-F]{2}|.)|[^\\'\n])'"],
+        nested_blocks=True),
+    "go": _CommentLexer([_DOUBLE_QUOTED, _SINGLE_QUOTED, r"`[^`]*`"]),
+    "c": _C_STRIPPER,
+    "objectivec": _C_STRIPPER,
+    "cpp": _CommentLexer(
+        [r'(?:u8|[uUL])?R"(?P<delimiter>[^()\\\s]{0,16})\([\s\S]*?\)(?P=delimiter)"',
+         _DOUBLE_QUOTED, _SINGLE_QUOTED]),
+    "csharp": _CommentLexer(
+        [r'(?:\$@|@\$?)"(?:[^"]|"")*"', _TRIPLE_QUOTED, _DOUBLE_QUOTED, _SINGLE_QUOTED]),
+    "java": _CommentLexer([_TRIPLE_QUOTED, _DOUBLE_QUOTED, _SINGLE_QUOTED]),
+    "kotlin": _JVM_STRIPPER,
+    "scala": _JVM_STRIPPER,
+    "swift": _JVM_STRIPPER,
+    "dart": _CommentLexer(
+        [r"r'''[\s\S]*?'''", r'r"""[\s\S]*?"""', r"'''[\s\S]*?'''", _TRIPLE_QUOTED,
+         r"r'[^'\n]*'", r'r"[^"\n]*"', _DOUBLE_QUOTED, _SINGLE_QUOTED],
+        nested_blocks=True),
+    "css": _CommentLexer([_DOUBLE_QUOTED, _SINGLE_QUOTED], line_comment=None),
+    "scss": _CommentLexer([_DOUBLE_QUOTED, _SINGLE_QUOTED], extra_code=[_CSS_URL]),
+    "bash": _CommentLexer(
+        [r"<<-?[ \t]*(?P<quote>['\"]?)(?P<tag>\w+)(?P=quote)[^\n]*\n[\s\S]*?\n[ \t]*(?P=tag)(?=\n|$)",
+         r"\$'(?:\\.|[^'\\])*'", r"'[^']*'", r'"(?:\\.|[^"\\])*"'],
+        line_comment="#", block_comments=False, hash_after_space=True),
+    "yaml": _strip_yaml,
+    "toml": _CommentLexer(
+        [_TRIPLE_QUOTED, r"'''[\s\S]*?'''", _DOUBLE_QUOTED, r"'[^'\n]*'"],
+        line_comment="#", block_comments=False),
+}
+for _alias, _language in (("typescript", "javascript"), ("tsx", "javascript"), ("jsx", "javascript"),
+                          ("less", "scss"), ("shell", "bash"), ("zsh", "bash")):
+    STRIPPERS[_alias] = STRIPPERS[_language]
+
+# Extensions whose language the configured mapping may not name.
+_STRIP_EXTENSIONS = {".toml": "toml", ".jsonc": "json", ".jsx": "javascript", ".cjs": "javascript",
+                     ".mts": "typescript", ".cts": "typescript", ".zsh": "bash"}
+
+class ContentStripper:
+    """
+    Removes comments (and optionally docstrings) and collapses runs of blank
+    lines, language by language; string literals are left untouched. Files in
+    languages without a stripper pass through unchanged. Keeps per-language
+    byte counts so the savings can be reported.
+    """
+
+    def __init__(self, docstrings: bool = False):
+        self.docstrings = docstrings
+        self.savings: Dict[str, List[int]] = {}  # language -> [files, bytes before, bytes after]
+
+    def strip(self, content: str, language: str, ext: str = "") -> str:
+        if language not in STRIPPERS:
+            language = _STRIP_EXTENSIONS.get(ext.lower(), "")
+        stripper = STRIPPERS.get(language)
+        if stripper is None or _STRIP_MARK in content or _STRING_NEWLINE in content:
+            return content
+        stripped = stripper(content, self.docstrings)
+        if stripped is None:
+            stripped = content
+        counts = self.savings.setdefault(language, [0, 0, 0])
+        counts[0] += 1
+        counts[1] += len(content.encode("utf-8"))
+        counts[2] += len(stripped.encode("utf-8"))
+        return stripped
+
+    def summary_lines(self) -> List[str]:
+        """Per-language savings, largest first, followed by the total."""
+        if not self.savings:
+            return ["Stripping: no files in a supported language"]
+        lines = ["Stripping savings:"]
+        rows = sorted(self.savings.items(), key=lambda item: item[1][2] - item[1][1])
+        total = [sum(counts[i] for _, counts in rows) for i in range(3)]
+        for language, (files, before, after) in rows + [("total", total)]:
+            percent = 100.0 * (before - after) / before if before else 0.0
+            lines.append(f"  {language}: {files} file(s), {format_size(before)} -> {format_size(after)} "
+                         f"({percent:.1f}% saved)")
+        return lines
+
+SKELETON_VERSION = 2
+
+def _is_docstring(node) -> bool:
+    import ast
+    return (isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant)
+            and isinstance(node.value.value, str))
+
+def _summary_docstring(node):
+    """Reduce a docstring statement to its summary (first non-blank) line."""
+    import ast
+    lines = [line.strip() for line in node.value.value.strip().splitlines()]
+    return ast.Expr(ast.Constant(lines[0] if lines else ""))
+
+def _skeleton_body(body: list, module: bool = False) -> list:
+    """Filter a statement list down to what python_skeleton keeps (see there)."""
+    import ast
+    ellipsis = ast.Expr(ast.Constant(Ellipsis))
+    kept = []
+    for i, node in enumerate(body):
+        if i == 0 and _is_docstring(node):
+            kept.append(node if module else _summary_docstring(node))
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            node.body = ([_summary_docstring(node.body[0])] if _is_docstring(node.body[0]) else []) + [ellipsis]
+            kept.append(node)
+        elif isinstance(node, ast.ClassDef):
+            node.body = _skeleton_body(node.body) or [ellipsis]
+            kept.append(node)
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            kept.append(node)
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            value = node.value
+            # Keep constants and fields, but not the bulk of long literals.
+            if value is not None and (value.end_lineno != value.lineno or value.end_col_offset - value.col_offset > 80):
+                node.value = ast.Constant(Ellipsis)
+            kept.append(node)
+        elif isinstance(node, ast.If):
+            test = node.test
+            if (isinstance(test, ast.Compare) and isinstance(test.left, ast.Name) and test.left.id == "__name__"):
+                continue
+            node.body = _skeleton_body(node.body)
+            node.orelse = _skeleton_body(node.orelse)
+            if node.body or node.orelse:
+                node.body = node.body or [ellipsis]
+                kept.append(node)
+        elif isinstance(node, ast.Try):
+            node.body = _skeleton_body(node.body)
+            if node.body:
+                for handler in node.handlers:
+                    handler.body = _skeleton_body(handler.body) or [ellipsis]
+                node.orelse = _skeleton_body(node.orelse)
+                node.finalbody = _skeleton_body(node.finalbody)
+                if not node.handlers:
+                    node.finalbody = node.finalbody or [ellipsis]
+                kept.append(node)
+    return kept
+
+def python_skeleton(source: str) -> Optional[str]:
+    """
+    Outline of a Python module: its docstring, imports, module and class level
+    assignments, and class and function signatures with decorators and type
+    hints. Function bodies are replaced by "..." and class and function
+    docstrings are cut to their summary line. Returns None if the source
+    cannot be parsed (or ast.unparse is unavailable, before Python 3.9).
+    """
+    import ast
+    if not hasattr(ast, "unparse"):
+        return None
+    try:
+        tree = ast.parse(source)
+        tree.body = _skeleton_body(tree.body, module=True)
+        return ast.unparse(tree) + "\n"
+    except (SyntaxError, ValueError, RecursionError):
+        return None
+
+def _skeleton_of_bytes(data: bytes) -> Optional[str]:
+    """Process pool worker for PythonSkeletons."""
+    try:
+        return python_skeleton(data.decode("utf-8"))
+    except UnicodeDecodeError:
+        return None
+
+class PythonSkeletons:
+    """
+    Builds python_skeleton() outlines for a set of Python files, in parallel
+    across a process pool. Outlines are cached under the cache directory by
+    content hash, so unchanged files are not parsed again. Files that cannot
+    be parsed get no outline and are rendered with their full content.
+    """
+
+    def __init__(self, jobs: Optional[int] = None):
+        self.jobs = jobs
+        self.cache_dir = get_cache_dir() / "skeletons"
+        self.outlines: Dict[str, str] = {}  # str(file path) -> outline
+        self.cached = 0
+        self.parsed = 0
+        self.failed = 0
+        self.bytes_before = 0
+        self.bytes_after = 0
+
+    def _cache_file(self, digest: str, failed: bool = False) -> pathlib.Path:
+        return self.cache_dir / digest[:2] / (digest + (".fail" if failed else ".py"))
+
+    def build(self, paths: List[pathlib.Path], source: Any = None) -> "PythonSkeletons":
+        """Outline the given files, read from the filesystem or from source (e.g. a GitRevision)."""
+        tag = f"skeleton-{SKELETON_VERSION}-{sys.version_info[0]}.{sys.version_info[1]}\0".encode("utf-8")
+        misses = []
+        for path in paths:
+            try:
+                data = source.read_bytes(path) if source else path.read_bytes()
+            except (OSError, KeyError):
+                continue
+            digest = hashlib.sha256(tag + data).hexdigest()
+            try:
+                outline = self._cache_file(digest).read_text(encoding="utf-8")
+            except OSError:
+                if self._cache_file(digest, failed=True).exists():
+                    self.failed += 1
+                else:
+                    misses.append((path, digest, data))
+                continue
+            self.cached += 1
+            self._add(path, data, outline)
+
+        if len(misses) > 1 and (self.jobs or os.cpu_count() or 1) > 1:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs) as pool:
+                results = list(pool.map(_skeleton_of_bytes, [data for _, _, data in misses], chunksize=16))
+        else:
+            results = [_skeleton_of_bytes(data) for _, _, data in misses]
+
+        for (path, digest, data), outline in zip(misses, results):
+            cache_file = self._cache_file(digest, failed=outline is None)
+            try:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                tmp.write_text(outline or "", encoding="utf-8")
+                os.replace(tmp, cache_file)
+            except OSError:
+                pass  # The cache is only an optimisation
+            if outline is None:
+                self.failed += 1
+            else:
+                self.parsed += 1
+                self._add(path, data, outline)
+        return self
+
+    def _add(self, path: pathlib.Path, data: bytes, outline: str) -> None:
+        self.outlines[str(path)] = outline
+        self.bytes_before += len(data)
+        self.bytes_after += len(outline.encode("utf-8"))
+
+    def summary(self) -> str:
+        ratio = f", {self.bytes_before / self.bytes_after:.1f}x smaller" if self.bytes_after else ""
+        return (f"{len(self.outlines)} Python file(s) outlined ({self.cached} from cache), "
+                f"{format_size(self.bytes_before)} -> {format_size(self.bytes_after)}{ratio}; "
+                f"{self.failed} could not be parsed and are included in full")
+
+# Data file formats summarized instead of inlined, by extension.
+DATA_FORMATS = {".csv": "csv", ".tsv": "tsv", ".json": "json", ".ndjson": "ndjson", ".jsonl": "ndjson",
+                ".yaml": "yaml", ".yml": "yaml"}
+
+# Defaults for the "DATA_SUMMARY" object in config.json: files of at least
+# min_bytes are summarized, with sample_records records shown and the schema
+# inferred from the first schema_records records.
+DEFAULT_DATA_SUMMARY = {"min_bytes": 1 << 20, "sample_records": 5, "schema_records": 1000}
+
+_READ_TEXT_CHUNK = 1 << 16
+# A single JSON value larger than this is not decoded (see _JsonStream.read).
+_MAX_JSON_VALUE = 16 << 20
+# At most this many top-level keys are listed.
+_MAX_LISTED_KEYS = 50
+# Longer lines of a sample (e.g. a huge string value) are cut short.
+_MAX_SAMPLE_LINE = 1000
+
+def _json_type(value: Any) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "integer"
+    if isinstance(value, float):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    return "array" if isinstance(value, list) else "object"
+
+_CSV_INTEGER = re.compile(r"[+-]?\d+")
+_CSV_NUMBER = re.compile(r"[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?")
+
+def _csv_type(cell: str) -> str:
+    cell = cell.strip()
+    if not cell:
+        return "null"
+    if _CSV_INTEGER.fullmatch(cell):
+        return "integer"
+    if _CSV_NUMBER.fullmatch(cell):
+        return "number"
+    if cell.lower() in ("true", "false"):
+        return "boolean"
+    return "string"
+
+class _Schema:
+    """Field name -> the types seen for it, in order of first appearance."""
+
+    def __init__(self):
+        self.fields: Dict[str, List[str]] = {}
+        self.records = 0
+
+    def add(self, field: str, kind: str) -> None:
+        kinds = self.fields.setdefault(field, [])
+        if kind not in kinds:
+            kinds.append(kind)
+
+    def add_record(self, record: Any) -> None:
+        self.records += 1
+        if isinstance(record, dict):
+            for key, value in record.items():
+                self.add(key, _json_type(value))
+        else:
+            self.add("", _json_type(record))
+
+    def add_value(self, value: "_JsonValue") -> None:
+        """add_record for a _JsonValue read with fields, whether or not it was decoded."""
+        if value.decoded:
+            self.add_record(value.value)
+            return
+        self.records += 1
+        if value.kind == "object":
+            for key, kind in value.fields:
+                self.add(key, kind)
+        else:
+            self.add("", value.kind)
+
+    def rows(self) -> List[Tuple[str, str]]:
+        return [(field, ", ".join(kinds)) for field, kinds in self.fields.items()]
+
+class _JsonValue:
+    """
+    A JSON value read by _JsonStream.read: its type (see _json_type), its
+    number of members (arrays and objects), the keys of an object with the
+    type of each value (if asked for) and the value itself if it was decoded.
+    length is the size of its text in characters.
+    """
+
+    __slots__ = ("kind", "members", "fields", "value", "decoded", "length")
+
+    def __init__(self, kind: str = "", members: int = 0, fields: Optional[List[Tuple[str, str]]] = None,
+                 value: Any = None, decoded: bool = False, length: int = 0):
+        self.kind = kind
+        self.members = members
+        self.fields = fields
+        self.value = value
+        self.decoded = decoded
+        self.length = length
+
+    @classmethod
+    def of(cls, value: Any, length: int) -> "_JsonValue":
+        """A decoded value (fields stay None; _Schema.add_value uses the value itself)."""
+        kind = _json_type(value)
+        return cls(kind, len(value) if kind in ("array", "object") else 0, None, value, True, length)
+
+    def sample(self) -> Any:
+        """The value, or for one too large to decode, a note saying what it is."""
+        if self.decoded:
+            return self.value
+        members = f" with {self.members:,} members" if self.kind in ("array", "object") else ""
+        return f"... ({self.kind}{members}, {format_size(self.length)}, too large to show)"
+
+_JSON_WHITESPACE = re.compile(r"[ \t\r\n]*")
+_JSON_STRING_STOP = re.compile(r'["\\]')
+_JSON_LITERAL_END = re.compile(r'[ \t\r\n,:\[\]{}"]')
+# Below the first level of a value only brackets and strings matter.
+_JSON_NESTED_STOP = re.compile(r'["\[\]{}]')
+_JSON_NUMBER = re.compile(r"-?(0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?")
+
+def _json_literal_type(token: str) -> str:
+    if token in ("true", "false"):
+        return "boolean"
+    if token == "null":
+        return "null"
+    match = _JSON_NUMBER.fullmatch(token)
+    if match is None:
+        raise ValueError(f"invalid JSON: unexpected '{token[:20]}'")
+    return "integer" if match.group(2) is None and match.group(3) is None else "number"
+
+class _JsonStream:
+    """
+    Reads JSON values one at a time from a text stream, so that the elements
+    of a large array (or the members of a large object) can be visited
+    without loading the whole document. A value that fits in the buffer is
+    decoded with json's raw_decode; a longer one is tokenized as it is read
+    (see read), so its text is never buffered or decoded whole.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self._decoded: Any = None
+        # Text of the value being tokenized, kept while it is at most _capture_limit characters.
+        self._capture: Optional[List[str]] = None
+        self._capture_from = 0
+        self._capture_limit = 0
+        self._scanned = 0
+
+    def _fill(self, size: int = _READ_TEXT_CHUNK) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """The next non-whitespace character ("" at the end)."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self._fill():
+                return self.buffer[self.pos:self.pos + 1]
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"invalid JSON: expected '{char}'")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """Decode the next value, which must be at most _MAX_JSON_VALUE characters long."""
+        result = self.read(_MAX_JSON_VALUE)
+        if not result.decoded:
+            raise ValueError(f"a value is larger than {format_size(_MAX_JSON_VALUE)}")
+        return result.value
+
+    def read(self, capture: int = 0, fields: bool = False) -> _JsonValue:
+        """
+        Read the next value. One that ends inside the buffer is decoded;
+        otherwise it is tokenized as it streams past, tracking only its first
+        level (members and, with fields, an object's keys and value types),
+        and decoded only if its text is at most capture characters long.
+        """
+        start = self.pos
+        if self._decode():
+            return _JsonValue.of(self._decoded, self.pos - start)
+        return self._scan(capture, fields)
+
+    def skip(self) -> None:
+        """Consume the next value, like read without keeping anything."""
+        if not self._decode():
+            self._scan(0, False)
+
+    def _decode(self) -> bool:
+        """Decode the next value into _decoded if it ends inside the buffer."""
+        self.peek()
+        try:
+            self._decoded, end = self.decoder.raw_decode(self.buffer, self.pos)
+        except json.JSONDecodeError:
+            return False
+        # A number may continue in the next chunk ("2." then "5").
+        if (end < len(self.buffer) and self.buffer[end] not in ".eE+-" or self.eof
+                or isinstance(self._decoded, bool) or not isinstance(self._decoded, (int, float))):
+            self.pos = end
+            return True
+        return False
+
+    def _keep(self) -> None:
+        """Add the text consumed since the last call to the capture."""
+        text = self.buffer[self._capture_from:self.pos]
+        self._scanned += len(text)
+        if self._capture is not None:
+            if self._scanned > self._capture_limit:
+                self._capture = None
+            else:
+                self._capture.append(text)
+        self._capture_from = self.pos
+
+    def _refill(self) -> bool:
+        self._keep()
+        filled = self._fill()
+        self._capture_from = self.pos
+        return filled
+
+    def _need(self) -> None:
+        """Make sure there is input at pos, or raise at the end of the stream."""
+        if self.pos >= len(self.buffer) and not self._refill():
+            raise ValueError("invalid or truncated JSON")
+
+    def _string(self, keep: bool) -> Optional[str]:
+        """Consume the string whose opening quote is at pos; returns its decoded text if keep."""
+        pieces = []
+        start = self.pos
+        self.pos += 1
+        while True:
+            if self.pos >= len(self.buffer):
+                if keep:
+                    pieces.append(self.buffer[start:])
+                self._need()
+                start = self.pos
+            match = _JSON_STRING_STOP.search(self.buffer, self.pos)
+            if match is None:
+                self.pos = len(self.buffer)
+                continue
+            self.pos = match.end()
+            if match.group() == '"':
+                if not keep:
+                    return None
+                pieces.append(self.buffer[start:self.pos])
+                return json.loads("".join(pieces))
+            # A backslash escapes the next character, which may be in the next chunk.
+            if self.pos >= len(self.buffer):
+                if keep:
+                    pieces.append(self.buffer[start:])
+                self._need()
+                start = self.pos
+            self.pos += 1
+
+    def _literal(self) -> str:
+        """Consume the number, true, false or null at pos."""
+        pieces = []
+        while True:
+            match = _JSON_LITERAL_END.search(self.buffer, self.pos)
+            end = match.start() if match else len(self.buffer)
+            pieces.append(self.buffer[self.pos:end])
+            self.pos = end
+            if match or not self._refill():
+                return "".join(pieces)
+
+    def _scan(self, capture: int, fields: bool) -> _JsonValue:
+        result = _JsonValue(fields=[] if fields else None)
+        self._capture = [] if capture else None
+        self._capture_from = self.pos
+        self._capture_limit = capture
+        self._scanned = 0
+        closing: List[str] = []  # closing brackets of the open containers
+        key: Optional[str] = None  # the key of the next first-level value of an object
+        expect_key = False
+        while True:
+            if len(closing) >= 2:
+                match = _JSON_NESTED_STOP.search(self.buffer, self.pos)
+                if match is None:
+                    self.pos = len(self.buffer)
+                    self._need()
+                    continue
+                self.pos = match.start()
+            else:
+                self.pos = _JSON_WHITESPACE.match(self.buffer, self.pos).end()
+                if self.pos >= len(self.buffer):
+                    self._need()
+                    continue
+            char = self.buffer[self.pos]
+            depth = len(closing)
+            if char in "]}":
+                if not closing or closing.pop() != char:
+                    raise ValueError(f"invalid JSON: unexpected '{char}'")
+                self.pos += 1
+                if not closing:
+                    break
+                continue
+            if char in ",:":
+                if depth == 0:
+                    raise ValueError(f"invalid JSON: unexpected '{char}'")
+                self.pos += 1
+                expect_key = char == "," and closing[-1] == "}"
+                continue
+            if depth == 1 and expect_key:
+                if char != '"':
+                    raise ValueError("invalid JSON: expected a key")
+                key = self._string(fields)
+                expect_key = False
+                continue
+            # The start of a value.
+            if char == "{":
+                kind = "object"
+            elif char == "[":
+                kind = "array"
+            elif char == '"':
+                kind = "string"
+            else:
+                kind = None
+            if depth >= 2:
+                if char == '"':
+                    self._string(False)
+                else:
+                    closing.append("}" if char == "{" else "]")
+                    self.pos += 1
+                continue
+            if kind is None:
+                kind = _json_literal_type(self._literal())
+            elif kind == "string":
+                self._string(False)
+            else:
+                closing.append("}" if kind == "object" else "]")
+                expect_key = kind == "object" and depth == 0
+                self.pos += 1
+            if depth == 0:
+                result.kind = kind
+                if not closing:
+                    break
+            else:
+                result.members += 1
+                if result.fields is not None and closing[0] == "}":
+                    result.fields.append((key, kind))
+        self._keep()
+        result.length = self._scanned
+        if self._capture is not None:
+            result.value = json.loads("".join(self._capture))
+            result.decoded = True
+        self._capture = None
+        return result
+
+    def items(self, closing: str):
+        """Yield the positions of the members of the container just opened, until closing."""
+        if self.peek() == closing:
+            self.pos += 1
+            return
+        while True:
+            yield
+            char = self.peek()
+            self.pos += 1
+            if char == closing:
+                return
+            if char != ",":
+                raise ValueError("invalid JSON: expected ',' or '" + closing + "'")
+
+def _json_sample(value: Any, indent: str = "", members: bool = True) -> str:
+    """value as JSON with one array element (and at the top, one object member) per line."""
+    if isinstance(value, list) and value:
+        inner = ",\n".join(f"{indent}  {json.dumps(item, ensure_ascii=False)}" for item in value)
+        return f"[\n{inner}\n{indent}]"
+    if isinstance(value, dict) and value and members:
+        inner = ",\n".join(f"{indent}  {json.dumps(key, ensure_ascii=False)}: "
+                           f"{_json_sample(item, indent + '  ', False)}" for key, item in value.items())
+        return f"{{\n{inner}\n{indent}}}"
+    return json.dumps(value, ensure_ascii=False)
+
+def _summarize_json_array(stream: _JsonStream, sample_records: int, schema_records: int) -> Dict[str, Any]:
+    """Count and sample the elements of the array whose '[' was just read."""
+    schema = _Schema()
+    sample = []
+    count = 0
+    for _ in stream.items("]"):
+        if count < sample_records or count < schema_records:
+            value = stream.read(_MAX_JSON_VALUE if count < sample_records else 0, fields=count < schema_records)
+            if count < sample_records:
+                sample.append(value.sample())
+            if count < schema_records:
+                schema.add_value(value)
+        else:
+            stream.skip()
+        count += 1
+    return {"count": count, "schema": schema, "sample": sample}
+
+def _summarize_json_object(stream: _JsonStream, sample_records: int) -> Tuple[int, Dict[str, Any]]:
+    """Count the members of the object whose '{' was just read and decode the first sample_records."""
+    sample = {}
+    count = 0
+    for _ in stream.items("}"):
+        key = str(stream.value())
+        stream.expect(":")
+        if count < sample_records:
+            sample[key] = stream.read(_MAX_JSON_VALUE).sample()
+        else:
+            stream.skip()
+        count += 1
+    return count, sample
+
+def _summarize_json(f, sample_records: int, schema_records: int) -> Dict[str, Any]:
+    """
+    Only the first level of the document is walked member by member (and
+    the elements of arrays one level below); any deeper value is tokenized
+    without being decoded unless it is part of the sample.
+    """
+    stream = _JsonStream(f)
+    first = stream.peek()
+    if first == "[":
+        stream.pos += 1
+        array = _summarize_json_array(stream, sample_records, schema_records)
+        return {"records": array["count"], "record_label": "records", "schema": array["schema"],
+                "sample": _json_sample(array["sample"])}
+    if first != "{":
+        value = stream.read(_MAX_JSON_VALUE)
+        return {"description": f"a single {value.kind}", "sample": json.dumps(value.sample(), ensure_ascii=False)}
+    stream.pos += 1
+    keys = []
+    sample = {}
+    records = None
+    count = 0
+    for _ in stream.items("}"):
+        key = str(stream.value())
+        stream.expect(":")
+        count += 1
+        sampled = len(sample) < sample_records
+        first = stream.peek()
+        if first == "[":
+            stream.pos += 1
+            array = _summarize_json_array(stream, sample_records if sampled else 0, schema_records)
+            kind, value = f"array of {array['count']:,} items", array["sample"]
+            if records is None or array["count"] > records[1]["count"]:
+                records = (key, array)
+        elif first == "{":
+            stream.pos += 1
+            members, value = _summarize_json_object(stream, sample_records if sampled else 0)
+            kind = f"object with {members:,} keys"
+        else:
+            read = stream.read(_MAX_JSON_VALUE if sampled else 0)
+            kind, value = read.kind, read.sample()
+        # Objects keyed by id can have any number of keys; only the first are kept.
+        if len(keys) < _MAX_LISTED_KEYS:
+            keys.append((key, kind))
+        if sampled:
+            sample[key] = value
+    summary = {"description": f"an object with {count:,} top-level keys", "keys": keys,
+               "sample": _json_sample(sample)}
+    if records:
+        summary.update(records=records[1]["count"], record_label=f"items in \"{records[0]}\"",
+                       schema=records[1]["schema"])
+    return summary
+
+def _summarize_ndjson(f, sample_records: int, schema_records: int) -> Dict[str, Any]:
+    schema = _Schema()
+    sample = []
+    count = 0
+    for line in f:
+        if not line.strip():
+            continue
+        if count < schema_records:
+            schema.add_record(json.loads(line))
+        if count < sample_records:
+            sample.append(line.rstrip("\r\n"))
+        count += 1
+    return {"records": count, "record_label": "records", "schema": schema, "sample": "\n".join(sample)}
+
+def _summarize_csv(f, delimiter: str, sample_records: int, schema_records: int) -> Dict[str, Any]:
+    import csv
+
+    reader = csv.reader(f, delimiter=delimiter)
+    header = next(reader, None)
+    if header is None:
+        return {"records": 0, "record_label": "rows"}
+    kinds: List[List[str]] = [[] for _ in header]
+    sample = io.StringIO()
+    writer = csv.writer(sample, delimiter=delimiter, lineterminator="\n")
+    writer.writerow(header)
+    count = 0
+    for row in reader:
+        if count < schema_records:
+            for i, cell in enumerate(row[:len(header)]):
+                kind = _csv_type(cell)
+                if kind not in kinds[i]:
+                    kinds[i].append(kind)
+        if count < sample_records:
+            writer.writerow(row)
+        count += 1
+    schema = _Schema()
+    schema.records = min(count, schema_records)
+    for name, column_kinds in zip(header, kinds):
+        # A column that is only ever empty is still listed.
+        schema.fields[name] = column_kinds or ["null"]
+    return {"records": count, "record_label": "rows", "columns": len(header), "schema": schema,
+            "sample": sample.getvalue().rstrip("\n")}
+
+# The YAML sample stops here even if the first top-level items are longer.
+_YAML_SAMPLE_LINES = 40
+
+_YAML_KEY = re.compile(r"""([^\s#'"-][^:#]*|"[^"]*"|'[^']*'):(\s|$)""")
+
+def _summarize_yaml(f, sample_records: int) -> Dict[str, Any]:
+    """
+    Line-based: top-level keys (or top-level sequence items) of each document
+    are counted without parsing the values, and the first sample_records of
+    them are kept as the sample.
+    """
+    documents = 0
+    lines = 0
+    entries = 0
+    keys: List[str] = []
+    sequence = False
+    sample = []
+    for line in f:
+        lines += 1
+        if line.startswith("---"):
+            documents += 1
+            continue
+        if documents == 0 and line.strip() and not line.startswith("#"):
+            documents = 1
+        top_level = line[:1] not in ("", " ", "\t", "\n", "\r", "#")
+        if top_level and (line.startswith("- ") or line.rstrip("\r\n") == "-"):
+            sequence = True
+            entries += 1
+        elif top_level:
+            match = _YAML_KEY.match(line)
+            if match:
+                entries += 1
+                if len(keys) < _MAX_LISTED_KEYS:
+                    keys.append(match.group(1).strip("\"'"))
+        if entries <= sample_records and len(sample) < _YAML_SAMPLE_LINES:
+            sample.append(line.rstrip("\r\n"))
+    summary = {"description": f"{documents:,} document(s), {lines:,} lines", "records": entries,
+               "record_label": "top-level items" if sequence else "top-level keys",
+               "sample": "\n".join(sample).rstrip(), "sample_label": f"First {len(sample)} lines"}
+    if keys and not sequence:
+        summary["key_names"] = keys
+    return summary
+
+def summarize_data(raw, data_format: str, sample_records: int = 5, schema_records: int = 1000) -> Dict[str, Any]:
+    """
+    Summarize a data file in the given format (a DATA_FORMATS value), read
+    from the binary file object raw in one streaming pass: the record count,
+    the inferred schema (field -> types seen in the first schema_records
+    records) or top-level keys, and the first sample_records records.
+    Returns a dict for format_data_summary(); raises ValueError if the data
+    cannot be parsed.
+    """
+    import csv
+
+    with io.TextIOWrapper(raw, encoding="utf-8", errors="replace", newline="") as f:
+        try:
+            if data_format in ("csv", "tsv"):
+                summary = _summarize_csv(f, "\t" if data_format == "tsv" else ",", sample_records, schema_records)
+            elif data_format == "json":
+                summary = _summarize_json(f, sample_records, schema_records)
+            elif data_format == "ndjson":
+                summary = _summarize_ndjson(f, sample_records, schema_records)
+            else:
+                summary = _summarize_yaml(f, sample_records)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"invalid JSON: {e}")
+        except csv.Error as e:
+            raise ValueError(f"invalid {data_format.upper()}: {e}")
+    if summary.get("sample"):
+        summary["sample"] = "\n".join(line if len(line) <= _MAX_SAMPLE_LINE else line[:_MAX_SAMPLE_LINE] + " ..."
+                                      for line in summary["sample"].split("\n"))
+    summary["format"] = data_format
+    summary["sample_records"] = sample_records
+    return summary
+
+def format_data_summary(summary: Dict[str, Any], size: int) -> List[str]:
+    """Markdown lines for a summarize_data() result, up to (not including) the sample block."""
+    kind = f"{summary['format'].upper()}, {format_size(size)}"
+    if "error" in summary:
+        return [f"*Large data file ({kind}) omitted: it could not be summarized ({summary['error']}).*"]
+    facts = []
+    if "description" in summary:
+        facts.append(summary["description"])
+    if "records" in summary:
+        facts.append(f"{summary['records']:,} {summary['record_label']}")
+    if "columns" in summary:
+        facts.append(f"{summary['columns']:,} columns")
+    lines = [f"*Large data file ({kind}) summarized: {', '.join(facts)}.*", ""]
+    if summary.get("keys"):
+        lines.append("Top-level keys:")
+        lines.append("")
+        lines.extend(f"- `{key}`: {value}" for key, value in summary["keys"])
+        lines.append("")
+    elif summary.get("key_names"):
+        lines.append("Top-level keys: " + ", ".join(f"`{key}`" for key in summary["key_names"]))
+        lines.append("")
+    schema = summary.get("schema")
+    if schema and schema.fields:
+        lines.append(f"Schema (from the first {schema.records:,} records):" if schema.fields.keys() != {""}
+                     else f"Element types (from the first {schema.records:,} records):")
+        lines.append("")
+        lines.extend(f"- `{field}`: {kinds}" if field else f"- {kinds}" for field, kinds in schema.rows())
+        lines.append("")
+    if summary.get("sample"):
+        if "sample_label" in summary:
+            lines.append(summary["sample_label"] + ":")
+        elif "records" in summary and "keys" not in summary:
+            lines.append(f"First {min(summary['records'], summary['sample_records']):,} {summary['record_label']}:")
+        else:
+            lines.append("Sample:")
+        lines.append("")
+    return lines
+
+def data_summary_record(summary: Dict[str, Any]) -> Dict[str, Any]:
+    """The JSON-serializable form of a summarize_data() result (without the sample), for render_records."""
+    record = {key: value for key, value in summary.items()
+              if key not in ("sample", "schema", "sample_records", "sample_label", "file_info")}
+    if summary.get("schema"):
+        record["schema"] = dict(summary["schema"].fields)
+    if "keys" in summary:
+        record["keys"] = dict(summary["keys"])
+    return record
+
+class DataSummaries:
+    """
+    Chooses the data files (by extension, see DATA_FORMATS) of at least the
+    configured size and summarizes them with summarize_data(). Files that
+    cannot be summarized (e.g. invalid JSON) get an error note instead of
+    their content, so large files are never inlined.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = dict(DEFAULT_DATA_SUMMARY, **(settings or {}))
+        self.min_bytes = int(settings["min_bytes"])
+        self.sample_records = int(settings["sample_records"])
+        self.schema_records = int(settings["schema_records"])
+        self.summaries: Dict[str, Dict[str, Any]] = {}  # str(file path) -> summary
+        self.bytes_before = 0
+        self.failed = 0
+
+    def build(self, paths: List[pathlib.Path], source: Any = None) -> "DataSummaries":
+        """
+        Summarize the data files among paths (streamed from source if given)
+        that are large enough. The same pass works out each file's
+        read_file_info result, kept as the summary's "file_info", so the
+        renderers need not read the file again.
+        """
+        for path in paths:
+            data_format = DATA_FORMATS.get(path.suffix.lower())
+            if data_format is None:
+                continue
+            try:
+                size = source.size(path) if source else path.stat().st_size
+                if size < self.min_bytes:
+                    continue
+                reader = FileInfoReader(source.open(path) if source else open(path, "rb"))
+            except (OSError, KeyError):
+                continue
+            try:
+                with io.BufferedReader(reader, _READ_CHUNK) as raw:
+                    summary = summarize_data(raw, data_format, self.sample_records, self.schema_records)
+            except (OSError, ValueError) as e:
+                summary = {"format": data_format, "error": str(e)}
+                self.failed += 1
+                try:
+                    reader.close()
+                except OSError:
+                    pass
+            if reader.info is None:
+                continue
+            summary["size"] = size
+            summary["file_info"] = reader.info
+            self.summaries[str(path)] = summary
+            self.bytes_before += size
+        return self
+
+    def summary(self) -> str:
+        failed = f"; {self.failed} could not be parsed and were omitted" if self.failed else ""
+        return (f"{len(self.summaries)} data file(s) summarized instead of inlined "
+                f"({format_size(self.bytes_before)}){failed}")
+
+STATS_SUFFIX = ".stats.json"
+DEFAULT_CODEBASE_STATS = {"largest_files": 10, "table_rows": 10, "directory_depth": 1}
+
+class CodebaseStats:
+    """
+    Rollups of the files of a document by language (see guess_language; by
+    extension for unmapped files) and by directory: file count, bytes, lines and blank lines, plus the largest
+    files. It is fed the read_file_info results (read with count_blank) of
+    the rendering pass, so no file is read twice. A directory's rollup
+    includes its subdirectories; the table shows the directories up to
+    directory_depth levels below the codebase root, the JSON export all of them.
+    """
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None):
+        settings = dict(DEFAULT_CODEBASE_STATS, **(settings or {}))
+        self.largest_files = int(settings["largest_files"])
+        self.table_rows = int(settings["table_rows"])
+        self.directory_depth = int(settings["directory_depth"])
+        self.totals = self._rollup()
+        self.languages: Dict[str, Dict[str, int]] = {}
+        self.directories: Dict[str, Dict[str, int]] = {}  # POSIX path (as in the headings) -> rollup
+        self.largest: List[Tuple[int, str, int]] = []  # min-heap of (bytes, path, lines)
+        self._ancestors: Dict[str, List[Dict[str, int]]] = {}
+        self._by_suffix: Dict[str, Dict[str, int]] = {}
+
+    @staticmethod
+    def _rollup() -> Dict[str, int]:
+        return {"files": 0, "bytes": 0, "lines": 0, "blank_lines": 0}
+
+    def add(self, rel_path: pathlib.Path, info: Dict[str, Any]) -> None:
+        """Count a file (relative to the codebase root's parent) read into info."""
+        if not info["exists"]:
+            return
+        size, lines, blank = info["size"], info["lines"] or 0, info["blank_lines"] or 0
+        path = rel_path.as_posix()
+        parent = path.rpartition("/")[0]
+        # The rollups of a directory and its ancestors, and those of an
+        # extension, are looked up once and then reused.
+        rollups = self._ancestors.get(parent)
+        if rollups is None:
+            rollups = self._ancestors[parent] = [self.totals]
+            while parent:
+                rollups.append(self.directories.setdefault(parent, self._rollup()))
+                parent = parent.rpartition("/")[0]
+        suffix = rel_path.suffix
+        language_rollup = self._by_suffix.get(suffix)
+        if language_rollup is None:
+            language = guess_language(suffix) or suffix.lower() or "(no extension)"
+            language_rollup = self._by_suffix[suffix] = self.languages.setdefault(language, self._rollup())
+        for rollup in rollups + [language_rollup]:
+            rollup["files"] += 1
+            rollup["bytes"] += size
+            rollup["lines"] += lines
+            rollup["blank_lines"] += blank
+        entry = (size, path, lines)
+        if len(self.largest) < self.largest_files:
+            heapq.heappush(self.largest, entry)
+        elif self.largest and entry > self.largest[0]:
+            heapq.heapreplace(self.largest, entry)
+
+    @staticmethod
+    def _by_size(rollups: Dict[str, Dict[str, int]]) -> List[Tuple[str, Dict[str, int]]]:
+        return sorted(rollups.items(), key=lambda item: (-item[1]["bytes"], item[0]))
+
+    def _largest(self) -> List[Tuple[int, str, int]]:
+        return sorted(self.largest, key=lambda entry: (-entry[0], entry[1]))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """The JSON-serializable statistics (rollups largest first, directories by path)."""
+        return {
+            "totals": self.totals,
+            "languages": dict(self._by_size(self.languages)),
+            "directories": {path: self.directories[path]
+                            for path in sorted(self.directories, key=_rel_sort_key)},
+            "largest_files": [{"path": path, "bytes": size, "lines": lines}
+                              for size, path, lines in self._largest()],
+        }
+
+    def write(self, output_file: Any) -> Optional[str]:
+        """Write the statistics as JSON to output_file + STATS_SUFFIX for a path; returns its path."""
+        if hasattr(output_file, "write"):
+            return None
+        stats_file = str(output_file) + STATS_SUFFIX
+        try:
+            with open(stats_file, "w", encoding="utf-8", newline="\n") as f:
+                json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+                f.write("\n")
+        except OSError as e:
+            raise RuntimeError(f"Error writing to output file '{stats_file}': {e}")
+        return stats_file
+
+    def _table(self, title: str, rows: List[Tuple[str, Dict[str, int]]]) -> List[str]:
+        lines = [f"| {title} | Files | Lines | Blank | Size |", "|---|--:|--:|--:|--:|"]
+
+        def row(name: str, rollup: Dict[str, int]) -> str:
+            return (f"| {name} | {rollup['files']:,} | {rollup['lines']:,} | {rollup['blank_lines']:,} "
+                    f"| {format_size(rollup['bytes'])} |")
+
+        for name, rollup in rows[:self.table_rows]:
+            lines.append(row(name, rollup))
+        if len(rows) > self.table_rows:
+            rest = self._rollup()
+            for _, rollup in rows[self.table_rows:]:
+                for key in rest:
+                    rest[key] += rollup[key]
+            lines.append(row(f"({len(rows) - self.table_rows} more)", rest))
+        lines.append(row("Total", self.totals))
+        return lines
+
+    def table_lines(self) -> List[str]:
+        """The statistics as compact Markdown tables: by language, by directory and the largest files."""
+        lines = self._table("Language", self._by_size(self.languages))
+        directories = [(path, rollup) for path, rollup in self._by_size(self.directories)
+                       if 0 < path.count("/") <= self.directory_depth]
+        if directories:
+            lines.append("")
+            lines.extend(self._table("Directory", directories))
+        if self.largest:
+            lines.append("")
+            lines.append("| Largest files | Lines | Size |")
+            lines.append("|---|--:|--:|")
+            lines.extend(f"| {path} | {count:,} | {format_size(size)} |" for size, path, count in self._largest())
+        return lines
+
+DEFAULT_CHUNKING = {"max_tokens": 512, "overlap_lines": 3}
+
+# Boundary strengths for CodeChunker, strongest (lowest) first: syntax levels
+# (nesting depth, or indentation rank) come before these two.
+_CHUNK_AFTER_BLANK = 100
+_CHUNK_ANY_LINE = 101
+# Lines that do not start a construct of their own but continue the previous one.
+_CONTINUATION = re.compile(r"[{}()[\]]|(else|elif|elsif|except|catch|finally|end|until|rescue|ensure)\b|[.?:+&|]")
+# Comment and annotation lines, kept together with the construct they precede.
+_LEADING_COMMENT = ("#", "//", "/*", "*", "--", ";", "<!--", "@")
+_MARKDOWN_HEADING = re.compile(r"(#{1,6})\s")
+
+def _python_boundaries(content: str, levels: List[int]) -> bool:
+    """
+    Set the boundary level of the first line of every Python statement to its
+    nesting depth (decorators included). Returns False if content cannot be parsed.
+    """
+    import ast
+    try:
+        tree = ast.parse(content)
+    except (SyntaxError, ValueError, RecursionError):
+        return False
+
+    def visit(body: list, depth: int) -> None:
+        for node in body:
+            decorators = getattr(node, "decorator_list", None) or []
+            start = min([node.lineno] + [decorator.lineno for decorator in decorators]) - 1
+            if start < len(levels):
+                levels[start] = min(levels[start], depth)
+            for field in ("body", "orelse", "finalbody"):
+                block = getattr(node, field, None)
+                if isinstance(block, list) and block and isinstance(block[0], ast.stmt):
+                    visit(block, depth + 1)
+            for handler in getattr(node, "handlers", None) or []:
+                visit(handler.body, depth + 1)
+
+    visit(tree.body, 0)
+    return True
+
+def _layout_boundaries(lines: List[str], levels: List[int], language: str) -> None:
+    """
+    Set boundary levels from the layout of lines: Markdown headings by their
+    level; otherwise a line that is indented no deeper than the previous
+    non-blank line and does not continue it (closing brackets, "else" and the
+    like) starts a construct, ranked by its indentation.
+    """
+    if language == "markdown":
+        for i, line in enumerate(lines):
+            heading = _MARKDOWN_HEADING.match(line)
+            if heading:
+                levels[i] = min(levels[i], len(heading.group(1)) - 1)
+        return
+    indents = []
+    previous = None
+    for i, line in enumerate(lines):
+        text = line.lstrip(" \t")
+        if not text.strip():
+            continue
+        indent = len(line[:len(line) - len(text)].expandtabs(4))
+        if previous is not None and indent <= previous and not _CONTINUATION.match(text):
+            indents.append((i, indent))
+        previous = indent
+    ranks = {indent: rank for rank, indent in enumerate(sorted({indent for _, indent in indents}))}
+    for i, indent in indents:
+        levels[i] = min(levels[i], min(ranks[indent], _CHUNK_AFTER_BLANK - 1))
+
+def split_lines(content: str) -> List[str]:
+    """
+    The lines of content with their line endings, split at "\n" only (like
+    ast, editors and read_file_info's line count; str.splitlines also splits
+    at form feeds and other separators).
+    """
+    lines = content.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def chunk_boundaries(lines: List[str], language: str) -> List[int]:
+    """
+    The boundary level of every line of a file (see split_lines): how good
+    a place it is for a chunk to start, lower is better. Python files (that
+    parse) get their statement structure from ast, other languages of
+    LANGUAGE_MAPPING a brace/indentation heuristic, and other files only
+    blank lines. A comment or annotation block directly above a
+    boundary moves the boundary to its first line.
+    """
+    levels = [_CHUNK_ANY_LINE] * len(lines)
+    for i in range(1, len(lines)):
+        if not lines[i - 1].strip() and lines[i].strip():
+            levels[i] = _CHUNK_AFTER_BLANK
+    if not (language == "python" and _python_boundaries("".join(lines), levels)) and language:
+        _layout_boundaries(lines, levels, language)
+    if language != "markdown":
+        comments = ("#",) if language == "python" else _LEADING_COMMENT
+        for i in range(1, len(lines)):
+            if levels[i] >= _CHUNK_AFTER_BLANK:
+                continue
+            j = i
+            while j > 0 and lines[j - 1].strip() and lines[j - 1].lstrip().startswith(comments):
+                j -= 1
+            if j < i:
+                levels[j] = min(levels[j], levels[i])
+                for k in range(j + 1, i + 1):
+                    levels[k] = _CHUNK_ANY_LINE
+    return levels
+
+def pack_chunks(lines: List[str], levels: List[int], max_bytes: int, overlap_lines: int = 0) -> List[List[int]]:
+    """
+    Split lines (with their boundary levels, see chunk_boundaries) into chunks
+    of at most max_bytes of UTF-8 each; only a single line longer than that
+    makes a larger chunk. Every chunk after the first repeats up to
+    overlap_lines lines from the end of the previous one (at most half of
+    max_bytes). A chunk ends at the strongest boundary within its budget, the
+    latest of equally strong ones. Returns [start, end, overlap]
+    line index triples, end exclusive; start includes the overlap.
+    """
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + (len(line) if line.isascii() else len(line.encode("utf-8", "surrogatepass"))))
+    count = len(lines)
+    chunks = []
+    start = previous = 0
+    while start < count:
+        overlap = min(overlap_lines, start - previous)
+        while overlap and offsets[start] - offsets[start - overlap] > max_bytes // 2:
+            overlap -= 1
+        while overlap and offsets[start + 1] - offsets[start - overlap] > max_bytes:
+            overlap -= 1  # the overlap must leave room for at least one line of the chunk's own
+        first = start - overlap
+        limit = offsets[first] + max_bytes
+        if offsets[count] <= limit:
+            end = count
+        else:
+            end = max(bisect.bisect_right(offsets, limit) - 1, start + 1)
+            best = end
+            for cut in range(end - 1, start, -1):
+                if levels[cut] < levels[best]:
+                    best = cut
+            end = best
+        chunks.append([first, end, overlap])
+        previous, start = start, end
+    return chunks
+
+def _chunk_ranges(content: str, language: str, max_bytes: int, overlap_lines: int) -> List[List[int]]:
+    """Process pool worker for CodeChunker."""
+    lines = split_lines(content)
+    return pack_chunks(lines, chunk_boundaries(lines, language), max_bytes, overlap_lines)
+
+class CodeChunker:
+    """
+    Splits file contents into chunks for retrieval (see render_records with
+    the "chunks" format): at most max_tokens estimated tokens each (see
+    estimate_tokens), ending at syntax-aware boundaries where possible (see
+    chunk_boundaries and pack_chunks), overlapping by overlap_lines.
+
+    Files that need more than one chunk are split in a process pool (up to
+    jobs processes) while the caller goes on reading. Chunk line ranges are
+    cached under the cache directory by content hash (one file per content
+    and setting), so unchanged files are not parsed again on later runs.
+    """
+
+    CACHE_VERSION = 1
+    WINDOW = 256  # files submitted ahead of the one being written
+
+    def __init__(self, settings: Optional[Dict[str, Any]] = None, jobs: Optional[int] = None):
+        settings = dict(DEFAULT_CHUNKING, **(settings or {}))
+        self.max_tokens = int(settings["max_tokens"])
+        self.overlap_lines = int(settings["overlap_lines"])
+        if self.max_tokens < 1 or self.overlap_lines < 0:
+            raise ValueError("max_tokens must be positive and overlap_lines must not be negative.")
+        self.max_bytes = self.max_tokens * 4  # the inverse of estimate_tokens
+        self.settings = {"max_tokens": self.max_tokens, "overlap_lines": self.overlap_lines}
+        self.jobs = jobs
+        self.pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+        key = json.dumps([self.CACHE_VERSION, self.settings], sort_keys=True).encode("utf-8")
+        self.cache_dir = get_cache_dir() / "chunks" / hashlib.sha1(key).hexdigest()[:16]
+        self.files = 0
+        self.chunk_count = 0
+        self.cached = 0
+
+    def _cache_file(self, digest: str) -> pathlib.Path:
+        return self.cache_dir / digest[:2] / (digest + ".json")
+
+    def _store(self, digest: str, ranges: List[List[int]]) -> None:
+        cache_file = self._cache_file(digest)
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_text(json.dumps(ranges, separators=(",", ":")), encoding="utf-8")
+            os.replace(tmp, cache_file)
+        except OSError:
+            pass  # The cache is only an optimisation
+
+    def submit(self, content: str, language: str) -> Tuple[List[str], concurrent.futures.Future]:
+        """
+        Start chunking a file's content. Returns its lines and a future of the
+        chunk ranges (see pack_chunks), for chunks().
+        """
+        lines = split_lines(content)
+        ranges: concurrent.futures.Future = concurrent.futures.Future()
+        self.files += 1
+        size = len(content) if content.isascii() else len(content.encode("utf-8", "surrogatepass"))
+        if size <= self.max_bytes:
+            ranges.set_result([[0, len(lines), 0]] if lines else [])
+            return lines, ranges
+        data = f"{language}\0{content}".encode("utf-8", "surrogatepass")
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+        try:
+            ranges.set_result(json.loads(self._cache_file(digest).read_text(encoding="utf-8")))
+            self.cached += 1
+            return lines, ranges
+        except (OSError, ValueError):
+            pass
+        if self.pool is None and (self.jobs or os.cpu_count() or 1) > 1:
+            self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.jobs)
+        if self.pool is not None:
+            ranges = self.pool.submit(_chunk_ranges, content, language, self.max_bytes, self.overlap_lines)
+        else:
+            ranges.set_result(pack_chunks(lines, chunk_boundaries(lines, language), self.max_bytes,
+                                          self.overlap_lines))
+
+        def remember(future: concurrent.futures.Future) -> None:
+            if not future.cancelled() and future.exception() is None:
+                self._store(digest, future.result())
+        ranges.add_done_callback(remember)
+        return lines, ranges
+
+    def chunks(self, lines: List[str], ranges: concurrent.futures.Future) -> List[Dict[str, Any]]:
+        """
+        The chunks of a file from submit(): dicts with the 1-based
+        "start_line" and "end_line" (inclusive, overlap included), the number
+        of leading "overlap" lines repeated from the previous chunk, and the
+        "content".
+        """
+        chunks = [{"start_line": start + 1, "end_line": end, "overlap": overlap, "content": "".join(lines[start:end])}
+                  for start, end, overlap in ranges.result()]
+        self.chunk_count += len(chunks)
+        return chunks
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def summary(self) -> str:
+        return (f"Chunks: {self.chunk_count} chunk(s) of up to ~{self.max_tokens} tokens from {self.files} file(s) "
+                f"({self.cached} from cache), overlapping by up to {self.overlap_lines} line(s)")
+
+_IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+")
+_SUBWORD = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+")
+
+def search_terms(text: str, weight: int = 1) -> Dict[str, int]:
+    """
+    Term frequencies of a text for SearchIndex: lower-cased identifiers plus
+    their camelCase/snake_case parts (single characters are skipped).
+    """
+    terms: Dict[str, int] = collections.Counter()
+    for word, count in collections.Counter(_IDENTIFIER.findall(text)).items():
+        count *= weight
+        if len(word) > 1:
+            terms[word.lower()] += count
+        parts = _SUBWORD.findall(word)
+        if len(parts) > 1:
+            for part in parts:
+                if len(part) > 1:
+                    terms[part.lower()] += count
+    return terms
+
+def estimate_tokens(size: int) -> int:
+    """Rough LLM token count of a text file of the given size in bytes."""
+    return (size + 3) // 4
+
+class SearchIndex:
+    """
+    Persistent BM25 index over the identifiers and path tokens of a
+    workspace's files, stored in an SQLite database in the cache directory:
+    files (by POSIX-style path relative to the root) with their size,
+    version and length, and the postings (term, file, frequency). A query
+    only reads the postings of its own terms, and updates are incremental:
+    only files whose version changed are read and re-indexed.
+
+    With a source (a GitRevision or an ArchiveSource), files are read from it
+    and its versions are used (blob ids, or see ArchiveSource.version);
+    otherwise a file's version is its size and mtime. The working tree, the
+    revisions of its repository and each archive have an index of their own.
+    """
+
+    SCHEMA_VERSION = 2
+    PATH_WEIGHT = 3  # path terms count as if they occurred this often
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, root: pathlib.Path, source: Any = None):
+        import sqlite3
+        self.root = pathlib.Path(root)
+        self.source = source
+        self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.cache_path))
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            self.db.executescript("""
+                DROP TABLE IF EXISTS docs;
+                DROP TABLE IF EXISTS postings;
+                CREATE TABLE docs (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER,
+                                   version TEXT, length INTEGER);
+                CREATE TABLE postings (term TEXT, doc INTEGER, tf INTEGER, PRIMARY KEY (term, doc)) WITHOUT ROWID;
+                CREATE INDEX postings_doc ON postings (doc);
+            """)
+            self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self.db.commit()
+        # path -> [id, size, version, length]
+        self.docs: Dict[str, list] = {row[0]: list(row[1:]) for row in
+                                      self.db.execute("SELECT path, id, size, version, length FROM docs")}
+
+    @property
+    def cache_path(self) -> pathlib.Path:
+        if isinstance(self.source, ArchiveSource):
+            where = f"archive:{self.source.archive.resolve()}"
+        elif self.source is not None:
+            where = f"git:{self.root.resolve()}"
+        else:
+            where = str(self.root.resolve())
+        key = hashlib.sha1(where.encode("utf-8")).hexdigest()[:16]
+        return get_cache_dir() / f"search-{key}.sqlite3"
+
+    def close(self) -> None:
+        self.db.close()
+
+    def _remove(self, rel: str) -> None:
+        doc_id = self.docs.pop(rel)[0]
+        self.db.execute("DELETE FROM postings WHERE doc = ?", (doc_id,))
+        self.db.execute("DELETE FROM docs WHERE id = ?", (doc_id,))
+
+    def _version(self, rel: str) -> Optional[Tuple[int, str]]:
+        """The size and version of a file, or None if it does not exist."""
+        path = self.root / rel
+        try:
+            if self.source is not None:
+                return self.source.size(path), self.source.version(path)
+            st = path.stat()
+        except (OSError, KeyError):
+            return None
+        return st.st_size, f"{st.st_size}:{st.st_mtime_ns}"
+
+    def update(self, rels: List[str], concurrency: Optional[int] = None) -> int:
+        """
+        Bring the entries for the given files up to date and drop all other
+        entries. Changed files are read like the renderers read them: from
+        the source, or with iter_file_infos (up to concurrency at once).
+        Returns the number of files (re)indexed or dropped.
+        """
+        updated = 0
+        stale = []
+        with self.db:
+            wanted = set(rels)
+            for rel in [rel for rel in self.docs if rel not in wanted]:
+                self._remove(rel)
+                updated += 1
+            for rel in rels:
+                current = self._version(rel)
+                doc = self.docs.get(rel)
+                if doc and (doc[1], doc[2]) == current:
+                    continue
+                if doc:
+                    self._remove(rel)
+                if current is not None:
+                    stale.append((rel, current))
+                elif doc:
+                    updated += 1
+            requests = [(self.root / rel, False) for rel, _ in stale]
+            if self.source is not None:
+                infos = self.source.file_infos(requests)
+            else:
+                infos = iter_file_infos(requests, concurrency=concurrency)
+            for (rel, (size, version)), info in zip(stale, infos):
+                terms = search_terms(rel.replace("/", " ").replace(".", " ").replace("-", " "), self.PATH_WEIGHT)
+                if info["content"] is not None:
+                    terms.update(search_terms(info["content"]))
+                length = sum(terms.values())
+                doc_id = self.db.execute("INSERT INTO docs (path, size, version, length) VALUES (?, ?, ?, ?)",
+                                         (rel, size, version, length)).lastrowid
+                self.db.executemany("INSERT INTO postings (term, doc, tf) VALUES (?, ?, ?)",
+                                    ((term, doc_id, tf) for term, tf in terms.items()))
+                self.docs[rel] = [doc_id, size, version, length]
+                updated += 1
+        return updated
+
+    def rank(self, query: str, rels: List[str]) -> List[Tuple[str, float]]:
+        """BM25 scores of the given (indexed) files for query, best first; files scoring 0 are left out."""
+        docs = {self.docs[rel][0]: (rel, self.docs[rel][3]) for rel in rels if rel in self.docs}
+        query_terms = list(search_terms(query))
+        if not docs or not query_terms:
+            return []
+        average_length = sum(length for _, length in docs.values()) / len(docs) or 1
+        scores: Dict[int, float] = {}
+        for term in query_terms:
+            postings = [(doc_id, tf) for doc_id, tf in
+                        self.db.execute("SELECT doc, tf FROM postings WHERE term = ?", (term,)) if doc_id in docs]
+            idf = math.log(1 + (len(docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, tf in postings:
+                norm = self.K1 * (1 - self.B + self.B * docs[doc_id][1] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.K1 + 1) / (tf + norm)
+        ranked = [(docs[doc_id][0], score) for doc_id, score in scores.items() if score > 0]
+        ranked.sort(key=lambda item: (-item[1], item[0]))
+        return ranked
+
+def select_by_query(
+    root_path: pathlib.Path,
+    included_files: List[pathlib.Path],
+    query: str,
+    top_k: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    source: Any = None,
+    concurrency: Optional[int] = None,
+) -> Tuple[List[pathlib.Path], str]:
+    """
+    Keep the files most relevant to query among included_files (relative to
+    root_path.parent), ranked with the workspace's SearchIndex (which is
+    brought up to date first, reading from source if given, see
+    SearchIndex): the top_k best, and/or as many as fit into max_tokens
+    estimated tokens. Without either limit, the 20 best are kept.
+    Returns the selection in its original order and a summary line.
+    """
+    base = root_path.parent
+    rels = {}
+    for rel in included_files:
+        key = "/".join(rel.parts[1:]) if not rel.is_absolute() else rel.relative_to(root_path).as_posix()
+        rels[key] = rel
+    try:
+        index = SearchIndex(root_path, source)
+    except Exception as e:
+        raise RuntimeError(f"Error opening search index: {e}")
+    try:
+        index.update(list(rels), concurrency)
+        ranked = index.rank(query, list(rels))
+        sizes = {rel: index.docs[rel][1] for rel, _ in ranked}
+    finally:
+        index.close()
+    relevant = len(ranked)
+    if top_k is None and max_tokens is None:
+        top_k = 20
+    if top_k is not None:
+        ranked = ranked[:top_k]
+    selected = set()
+    tokens = 0
+    for rel, _ in ranked:
+        file_tokens = estimate_tokens(sizes[rel])
+        if max_tokens is not None and tokens + file_tokens > max_tokens:
+            continue
+        selected.add(rel)
+        tokens += file_tokens
+    summary = (f"Query: {len(selected)} of {len(rels)} file(s) selected "
+               f"({relevant} relevant, ~{tokens:,} tokens)")
+    return [included for rel, included in rels.items() if rel in selected], summary
+
+# Output formats: name -> (label for messages, default file extension)
+OUTPUT_FORMATS = {
+    "markdown": ("Markdown", ".md"),
+    "jsonl": ("JSONL", ".jsonl"),
+    "msgpack": ("MessagePack", ".msgpack"),
+    "chunks": ("Chunked JSONL", ".chunks.jsonl"),
+}
+
+class RenderOptions:
+    """
+    How the selected files are rendered: the options every generation path
+    shares (generate_markdown, render_output, generate_packages,
+    generate_profiles, SnapshotService and generate_enhanced_markdown), with
+    the defaults in DEFAULTS. output_format is one of OUTPUT_FORMATS, classify
+    None or one of CLASSIFY_ACTIONS, symlinks one of SYMLINK_POLICIES; jobs
+    and io_concurrency are None (the default) or at least 1.
+
+    A path that supports only some of the options calls require(), so that an
+    option it cannot apply is rejected instead of being silently dropped.
+    Raises ValueError for unknown options and invalid values.
+    """
+
+    DEFAULTS = {
+        "output_format": "markdown",
+        "dedupe": False,
+        "strip": False,
+        "strip_docstrings": False,
+        "section_index": False,
+        "skeleton": False,
+        "classify": None,
+        "redact": False,
+        "summarize_data": False,
+        "reproducible": False,
+        "stats": False,
+        "symlinks": "files",
+        "io_concurrency": None,
+        "jobs": None,
+    }
+
+    def __init__(self, **options: Any):
+        unknown = set(options) - set(self.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown render option(s): {', '.join(sorted(unknown))}")
+        for name, default in self.DEFAULTS.items():
+            setattr(self, name, options.get(name, default))
+        if self.output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format '{self.output_format}' "
+                             f"(expected one of: {', '.join(OUTPUT_FORMATS)})")
+        if self.classify is not None and self.classify not in CLASSIFY_ACTIONS:
+            raise ValueError(f"Unknown classify action '{self.classify}' "
+                             f"(expected one of: {', '.join(CLASSIFY_ACTIONS)})")
+        if self.symlinks not in SYMLINK_POLICIES:
+            raise ValueError(f"Unknown symlink policy '{self.symlinks}' "
+                             f"(expected one of: {', '.join(SYMLINK_POLICIES)})")
+        for name in ("io_concurrency", "jobs"):
+            value = getattr(self, name)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                raise ValueError(f"{name} must be a positive integer.")
+
+    def __repr__(self) -> str:
+        return f"RenderOptions({', '.join(f'{name}={value!r}' for name, value in self.changed().items())})"
+
+    def changed(self) -> Dict[str, Any]:
+        """The options that differ from their defaults, by name."""
+        return {name: getattr(self, name) for name, default in self.DEFAULTS.items()
+                if getattr(self, name) != default}
+
+    def replace(self, **options: Any) -> "RenderOptions":
+        """A copy with the given options changed."""
+        return RenderOptions(**dict(self.changed(), **options))
+
+    def require(self, supported: Iterable[str], where: str) -> None:
+        """Raise ValueError naming the options set to other than their default that where does not support."""
+        unsupported = sorted(set(self.changed()) - set(supported))
+        if unsupported:
+            raise ValueError(f"{where} does not support the option(s): {', '.join(unsupported)}")
+
+def generate_markdown(
+    root_path: pathlib.Path,
+    output_file: str,
+    include_patterns: Optional[List[str]] = None,
+    exclude_patterns: Optional[List[str]] = None,
+    gitignore_spec: Optional[pathspec.PathSpec] = None,
+    options: Optional[RenderOptions] = None,
+    query: Optional[str] = None,
+    top_k: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+    scanned_files: Optional[List[pathlib.Path]] = None,
+    source: Any = None,
+) -> None:
+    """
+    Generate a Markdown document containing:
+      1. A directory tree (table of contents) showing only the files that match the filters.
+      2. For each included file, a section with the file’s path and its contents inside a fenced code block.
+    
+    The include and exclude patterns are applied relative to the codebase root.
+    options (a RenderOptions, all of which are supported here) control the rendering:
+    With dedupe, files identical to an earlier one are emitted as a reference only.
+    With strip, comments (and with strip_docstrings also docstrings) and runs of
+    blank lines are removed from files in supported languages.
+    output_format selects another format from OUTPUT_FORMATS (see render_records).
+    With section_index, a byte-offset sidecar index (output_file + ".idx") is written.
+    With skeleton, Python files are rendered as outlines (see PythonSkeletons,
+    which parses with up to jobs processes; so does chunking, see render_records).
+    With an io_concurrency above 1, files are read ahead concurrently.
+    With classify ("exclude" or "collapse", see CLASSIFY_ACTIONS), generated,
+    minified and lock files found by a ContentClassifier are left out or
+    rendered as a note only. With redact, secrets are replaced in the output
+    (see SecretRedactor). With summarize_data, large CSV, JSON and YAML files
+    are rendered as a schema and a sample of records (see DataSummaries).
+    With reproducible, files are ordered by their POSIX paths on every
+    platform and the output carries a digest (see render_markdown). With
+    stats, rollups by language and directory are computed in the same pass
+    (see CodebaseStats). symlinks is the symbolic link policy used to walk
+    root_path (see SYMLINK_POLICIES); links that are not read are rendered as
+    references (see WorkspaceIndex.references).
+    With query, only the files most relevant to it are kept (see select_by_query).
+    scanned_files are the regular files below root_path from an earlier scan
+    (e.g. scan_tree), sorted; without them root_path is walked here. With a source
+    (e.g. a GitRevision, together with its files() as scanned_files), file
+    contents are read from it instead of the filesystem.
+    """
+    options = options or RenderOptions()
+    base = root_path.parent
+
+    included_files = []
+    index = None
+    try:
+        if scanned_files is None and options.symlinks != "files":
+            index = WorkspaceIndex(root_path, ScanExclusions(symlinks=options.symlinks)).scan()
+            scanned_files = [root_path / rel for rel in index.files(links=True)]
+        if scanned_files is None:
+            scanned_files = [file for file in sorted(root_path.rglob("*")) if file.is_file()]
+        for file in scanned_files:
+            if should_include_file(file, root_path, include_patterns, exclude_patterns, gitignore_spec):
+                try:
+                    rel_file = file.relative_to(base)
+                except ValueError:
+                    rel_file = file
+                included_files.append(rel_file)
+    except Exception as e:
+        print(f"Error scanning directory '{root_path}': {e}", file=sys.stderr)
+        sys.exit(1)
+    if options.reproducible:
+        included_files.sort(key=lambda rel: _rel_sort_key(rel.as_posix()))
+
+    references = None
+    if index is not None:
+        references = {}
+        rels = {pathlib.PurePath(*rel.parts[1:]).as_posix(): rel for rel in included_files}
+        for rel, (kind, target) in index.references(list(rels)).items():
+            if kind != "link":
+                target = pathlib.PurePosixPath(root_path.name, target).as_posix()
+            references[str(base / rels[rel])] = (kind, target)
+
+    classifier = collapsed = None
+    if options.classify:
+        classifier = ContentClassifier(config_data.get("CONTENT_CLASSIFIER"))
+        included_files, collapsed = classifier.select(base, included_files, options.classify, source)
+
+    query_summary = None
+    if query:
+        included_files, query_summary = select_by_query(root_path, included_files, query, top_k, max_tokens,
+                                                        source, options.io_concurrency)
+
+    if not included_files:
+        print("Warning: No files found matching the criteria.", file=sys.stderr)
+
+    # Collapsed files and references are rendered without their content.
+    noncontent = set(collapsed or {}) | set(references or {})
+    skeletons = None
+    if options.skeleton:
+        skeletons = PythonSkeletons(options.jobs).build([base / rel for rel in included_files
+                                                 if rel.suffix == ".py" and str(base / rel) not in noncontent],
+                                                source)
+
+    data_summaries = None
+    if options.summarize_data:
+        data_summaries = DataSummaries(config_data.get("DATA_SUMMARY")).build(
+            [base / rel for rel in included_files if str(base / rel) not in noncontent], source)
+
+    try:
+        summary = render_output(root_path, included_files, output_file, options,
+                                skeletons=skeletons.outlines if skeletons else None, source=source,
+                                collapsed=collapsed,
+                                data_summaries=data_summaries.summaries if data_summaries else None,
+                                references=references)
+        print(f"{OUTPUT_FORMATS[options.output_format][0]} file generated: {output_file}")
+        if classifier:
+            print(classifier.summary(options.classify))
+        if query_summary:
+            print(query_summary)
+        if skeletons:
+            print(f"Skeletons: {skeletons.summary()}")
+        if data_summaries:
+            print(f"Data summaries: {data_summaries.summary()}")
+        for line in summary:
+            print(line)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+def format_reference(kind: str, target: str) -> str:
+    """The note rendered for a path in a renderer's references (see WorkspaceIndex.references)."""
+    if kind == "link":
+        return f"*Symbolic link to `{target}`*"
+    if kind == "same_directory":
+        return f"*Symbolic link to the directory already included as `{target}`*"
+    return f"*Same file as `{target}`*"
+
+def render_markdown(
+    root_path: pathlib.Path,
+    included_files: List[pathlib.Path],
+    output_file: str,
+    options: Optional[RenderOptions] = None,
+    skeletons: Optional[Dict[str, str]] = None,
+    source: Any = None,
+    collapsed: Optional[Dict[str, str]] = None,
+    data_summaries: Optional[Dict[str, Dict[str, Any]]] = None,
+    references: Optional[Dict[str, Tuple[str, str]]] = None,
+) -> List[str]:
+    """
+    Write the Markdown document for root_path given the already filtered list of
+    files (relative to root_path.parent, in output order), rendered as the
+    RenderOptions options ask. Their skeleton, classify, summarize_data and
+    symlinks steps are the caller's: it passes their results as skeletons,
+    collapsed, data_summaries and references.
+    With an io_concurrency above 1, files are read ahead concurrently (see iter_file_infos).
+    With a source (e.g. a GitRevision), file contents are read from it instead of the filesystem.
+    With dedupe, files whose contents were already emitted are rendered as a
+    reference to the first copy. With strip, file contents go through a
+    ContentStripper. skeletons maps str(file path) to an outline rendered in
+    place of the file's content (see PythonSkeletons); collapsed maps str(file
+    path) to the category of a file rendered as a note only (see
+    ContentClassifier); such files are not read, so they have no hash and
+    count no lines. data_summaries maps str(file path) to the summary of a
+    large data file rendered in place of its content (see DataSummaries).
+    With redact, secrets in the rendered contents are
+    replaced by a SecretRedactor. With section_index, the
+    byte-offset sidecar index (output_file + ".idx", see SectionIndex) is
+    written as well. With reproducible, lines always end in "\\n", and the
+    document's digest (see OutputDigest) goes into its header and a sidecar
+    (output_file + ".digest"); an existing output with the same digest is
+    left as it is. With stats, the files are also counted by a CodebaseStats
+    as they are read, its JSON goes to output_file + STATS_SUFFIX and its
+    tables are appended to the summary. references maps str(file path) to a
+    (kind, target) pair for paths rendered as a note without being read,
+    such as symbolic links (see format_reference).
+    Returns the summary lines (savings) for the caller to print.
+    Raises RuntimeError if the tree cannot be built or the output cannot be written,
+    and ValueError for an output_format other than "markdown".
+    """
+    options = options or RenderOptions()
+    options.require(set(RenderOptions.DEFAULTS) - {"output_format"}, "Markdown rendering")
+    base = root_path.parent
+    deduplicator = ContentDeduplicator() if options.dedupe else None
+    stripper = None
+    if options.strip or options.strip_docstrings:
+        stripper = ContentStripper(docstrings=options.strip_docstrings)
+    redactor = SecretRedactor(config_data.get("SECRET_REDACTION")) if options.redact else None
+    codebase_stats = CodebaseStats(config_data.get("CODEBASE_STATS")) if options.stats else None
+
+    try:
+        tree = build_tree(included_files)
+        tree_lines = format_tree(tree)
+        tree_str = "\n".join(tree_lines)
+    except Exception as e:
+        raise RuntimeError(f"Error building directory tree: {e}")
+
+    md_lines = []
+    sections = []
+    md_lines.append(f"# Codebase: {root_path.name}")
+    md_lines.append("")
+    digest_at = None
+    if options.reproducible:
+        digest_at = len(md_lines)
+        md_lines.append("Digest: `{digest}`")
+        md_lines.append("")
+    sections.append({"kind": "tree", "start": len(md_lines)})
+    md_lines.append("## Directory Tree")
+    md_lines.append("")
+    md_lines.append("```")
+    md_lines.append(tree_str)
+    md_lines.append("```")
+    sections[-1]["end"] = len(md_lines)
+    md_lines.append("")
+    md_lines.append("## Files")
+    md_lines.append("")
+
+    collapsed = collapsed or {}
+    data_summaries = data_summaries or {}
+    references = references or {}
+    outlines = [skeletons.get(str(base / rel_path)) if skeletons else None for rel_path in included_files]
+    unread = set(references) | set(collapsed) | set(data_summaries)
+    requests = [(base / rel_path, stripper is None and redactor is None and outline is None)
+                for rel_path, outline in zip(included_files, outlines) if str(base / rel_path) not in unread]
+    hash_content = options.dedupe or options.section_index or options.reproducible
+    if source:
+        infos = source.file_infos(requests, hash_content=hash_content, count_blank=options.stats, redactor=redactor)
+    else:
+        infos = iter_file_infos(requests, hash_content=hash_content, concurrency=options.io_concurrency,
+                                count_blank=options.stats, redactor=redactor)
+    for rel_path, outline in zip(included_files, outlines):
+        section = {"kind": "file", "path": rel_path.as_posix(), "start": len(md_lines)}
+        sections.append(section)
+        md_lines.append(f"### {rel_path}")
+        md_lines.append("")
+        file_path = base / rel_path
+        reference = references.get(str(file_path))
+        if reference:
+            if reference[0] == "same_file":
+                section["duplicate_of"] = reference[1]
+            md_lines.append(format_reference(*reference))
+            section["end"] = len(md_lines)
+            md_lines.append("")
+            continue
+        category = collapsed.get(str(file_path))
+        data_summary = data_summaries.get(str(file_path))
+        if category:
+            info = unread_file_info(file_path, source)
+        else:
+            info = data_summary["file_info"] if data_summary else next(infos)
+        if codebase_stats:
+            codebase_stats.add(rel_path, info)
+        section["sha256"] = info["sha256"]
+        if category and info["error"] is None:
+            md_lines.append(f"*Content omitted ({category}, {format_size(info['size'])})*")
+            section["end"] = len(md_lines)
+            md_lines.append("")
+            continue
+        if deduplicator and info["error"] is None:
+            original = deduplicator.original_of(info["sha256"], rel_path, info["size"])
+            if original is not None:
+                section["duplicate_of"] = original.as_posix()
+                md_lines.append(f"*Identical to `{original}`*")
+                section["end"] = len(md_lines)
+                md_lines.append("")
+                continue
+        ext = file_path.suffix
+        language = guess_language(ext)
+        if data_summary and info["error"] is None:
+            md_lines.extend(format_data_summary(data_summary, info["size"]))
+            if data_summary.get("sample"):
+                sample = data_summary["sample"]
+                md_lines.append(f"```{language}")
+                section["content"] = len(md_lines)
+                md_lines.append(redactor.redact(sample) if redactor else sample)
+                md_lines.append("```")
+            section["end"] = len(md_lines)
+            md_lines.append("")
+            continue
+        md_lines.append(f"```{language}")
+        if info["passthrough"]:
+            content = FileContents(file_path, info["size"], info["sha256"])
+        elif info["error"] is None:
+            if outline is None:
+                content = info["content"]
+                if redactor:
+                    redactor.tally(info["redactions"])
+            else:
+                content = redactor.redact(outline) if redactor else outline
+            if stripper:
+                content = stripper.strip(content, language, ext)
+        else:
+            content = f"Error reading file: {info['error']}"
+        if info["error"] is None:
+            section["content"] = len(md_lines)
+        md_lines.append(content)
+        md_lines.append("```")
+        section["end"] = len(md_lines)
+        md_lines.append("")
+
+    summary = []
+    digest = None
+    if options.reproducible:
+        output_digest = OutputDigest()
+        output_digest.add_lines(md_lines, skip=digest_at)
+        digest = output_digest.hexdigest()
+        md_lines[digest_at] = md_lines[digest_at].format(digest=digest)
+    if digest and output_unchanged(output_file, digest, options.section_index):
+        summary.append(f"Output unchanged ({digest}), not rewritten")
+    else:
+        spans = write_markdown_lines(output_file, md_lines, "\n" if options.reproducible else None)
+        if options.section_index:
+            summary.append(f"Section index generated: {write_section_index(output_file, sections, spans)}")
+        if digest:
+            digest_file = write_digest(output_file, digest)
+            summary.append(f"Digest: {digest}" + (f" ({digest_file})" if digest_file else ""))
+    if deduplicator:
+        summary.append(f"Deduplication: {deduplicator.summary()}")
+    if stripper:
+        summary.extend(stripper.summary_lines())
+    if redactor:
+        redactor.save()
+        summary.append(redactor.summary())
+    if codebase_stats:
+        stats_file = codebase_stats.write(output_file)
+        if stats_file:
+            summary.append(f"Statistics generated: {stats_file}")
+        summary.extend(codebase_stats.table_lines())
+    return summary
+
+def render_records(
+    root_path: pathlib.Path,
+    included_files: List[pathlib.Path],
+    output_file: str,
+    options: Optional[RenderOptions] = None,
+    skeletons: Optional[Dict[str, str]] = None,
+    source: Any = None,
+    collapsed: Optional[Dict[str, str]] = None,
+    data_summaries: Optional[Dict[str, Dict[str, Any]]] = None,
+    references: Optional[Dict[str, Tuple[str, str]]] = None,
+) -> List[str]:
+    """
+    Write the codebase as a stream of records instead of Markdown, in the
+    output_format of options (a RenderOptions, used as in render_markdown):
+    one JSON object per line ("jsonl") or a sequence of MessagePack maps
+    ("msgpack", requires the msgpack package). The first record ("type": "tree") holds the
+    directory tree; then there is one "file" record per included file with its
+    path, language, size, line count, SHA-256 and content. content is None if
+    the file could not be read as text (see "error") or, with dedupe, if it is
+    identical to the earlier file named by "duplicate_of". With skeletons,
+    content is the file's outline where there is one (see render_markdown).
+    Files in collapsed are not read: they have no content, lines or SHA-256
+    and name their category in "collapsed".
+    For files in data_summaries, content is the sample of records and
+    "data_summary" holds the rest of the summary (see data_summary_record).
+    redact is applied as in render_markdown.
+    io_concurrency and source are used as in render_markdown. With
+    reproducible, the file records are spooled while the digest (see
+    OutputDigest) is computed, and the tree record carries it as "digest";
+    it is also written to a sidecar, and an unchanged output is not rewritten.
+    stats is applied as in render_markdown. Paths in references have no
+    content and give their (kind, target) pair as "reference" (a same file
+    also as "duplicate_of").
+    The "chunks" format is JSONL for retrieval: the content of every file
+    record (after the steps above) is split by a CodeChunker, and there is
+    one "chunk" record per chunk instead, with its path, language, position
+    ("chunk" of "chunks"), line range, overlap, SHA-256 and content, plus
+    the file's SHA-256. Files without content have no chunks; the tree
+    record holds the settings as "chunking". Chunking uses up to jobs
+    processes.
+    Returns the summary lines, like render_markdown. Raises ValueError for
+    the Markdown format and for section_index, which is Markdown only.
+    """
+    options = options or RenderOptions(output_format="jsonl")
+    if options.output_format == "markdown":
+        raise ValueError("render_records writes the record formats; Markdown is written by render_markdown.")
+    options.require(set(RenderOptions.DEFAULTS) - {"section_index"}, "Record output")
+    base = root_path.parent
+    deduplicator = ContentDeduplicator() if options.dedupe else None
+    stripper = None
+    if options.strip or options.strip_docstrings:
+        stripper = ContentStripper(docstrings=options.strip_docstrings)
+    redactor = SecretRedactor(config_data.get("SECRET_REDACTION")) if options.redact else None
+    codebase_stats = CodebaseStats(config_data.get("CODEBASE_STATS")) if options.stats else None
+    chunker = None
+    if options.output_format == "chunks":
+        try:
+            chunker = CodeChunker(config_data.get("CHUNKING"), options.jobs)
+        except (TypeError, ValueError) as e:
+            raise RuntimeError(f"Invalid CHUNKING settings: {e}")
+    if options.output_format == "msgpack":
+        try:
+            import msgpack
+        except ImportError:
+            raise RuntimeError("The msgpack format requires the msgpack package (pip install msgpack).")
+        packer = msgpack.Packer(use_bin_type=True)
+        encode = packer.pack
+    else:
+        def encode(record):
+            return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+    try:
+        tree_str = "\n".join(format_tree(build_tree(included_files)))
+    except Exception as e:
+        raise RuntimeError(f"Error building directory tree: {e}")
+
+    header = {"type": "tree", "codebase": root_path.name, "files": len(included_files), "tree": tree_str}
+    if chunker:
+        header["chunking"] = chunker.settings
+    output_digest = OutputDigest() if options.reproducible else None
+    digest = digest_file = None
+    try:
+        with contextlib.ExitStack() as stack:
+            if options.reproducible:
+                output_digest.add(encode(header))
+                f = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=64 << 20))
+            else:
+                f = stack.enter_context(open_output(output_file))
+                f.write(encode(header))
+            references = references or {}
+            pending: collections.deque = collections.deque()
+            if chunker:
+                stack.callback(chunker.close)
+
+            def write_chunks(record: Dict[str, Any], lines: List[str], ranges: concurrent.futures.Future) -> None:
+                chunks = chunker.chunks(lines, ranges)
+                data = b"".join(encode({
+                    "type": "chunk",
+                    "path": record["path"],
+                    "language": record["language"],
+                    "chunk": i,
+                    "chunks": len(chunks),
+                    "start_line": chunk["start_line"],
+                    "end_line": chunk["end_line"],
+                    "overlap": chunk["overlap"],
+                    "sha256": hashlib.sha256(chunk["content"].encode("utf-8", "surrogatepass")).hexdigest(),
+                    "file_sha256": record["sha256"],
+                    "content": chunk["content"],
+                }) for i, chunk in enumerate(chunks))
+                if output_digest:
+                    output_digest.add(data)
+                f.write(data)
+
+            collapsed = collapsed or {}
+            data_summaries = data_summaries or {}
+            unread = set(references) | set(collapsed) | set(data_summaries)
+            requests = [(base / rel_path, False) for rel_path in included_files if str(base / rel_path) not in unread]
+            if source:
+                infos = source.file_infos(requests, hash_content=True, count_blank=options.stats, redactor=redactor)
+            else:
+                infos = iter_file_infos(requests, hash_content=True, concurrency=options.io_concurrency,
+                                        count_blank=options.stats, redactor=redactor)
+            for rel_path in included_files:
+                file_path = base / rel_path
+                ext = file_path.suffix
+                language = guess_language(ext)
+                reference = references.get(str(file_path))
+                if reference and chunker:
+                    continue
+                if reference:
+                    data = encode({
+                        "type": "file",
+                        "path": rel_path.as_posix(),
+                        "language": language,
+                        "size": None,
+                        "lines": None,
+                        "sha256": None,
+                        "content": None,
+                        "error": None,
+                        "duplicate_of": reference[1] if reference[0] == "same_file" else None,
+                        "collapsed": None,
+                        "data_summary": None,
+                        "reference": {"kind": reference[0], "target": reference[1]},
+                    })
+                    if output_digest:
+                        output_digest.add(data)
+                    f.write(data)
+                    continue
+                if str(file_path) in collapsed:
+                    info = unread_file_info(file_path, source)
+                elif str(file_path) in data_summaries:
+                    info = data_summaries[str(file_path)]["file_info"]
+                else:
+                    info = next(infos)
+                if codebase_stats:
+                    codebase_stats.add(rel_path, info)
+                redactions = info["redactions"]
+                record = {
+                    "type": "file",
+                    "path": rel_path.as_posix(),
+                    "language": language,
+                    "size": info["size"],
+                    "lines": info["lines"],
+                    "sha256": info["sha256"],
+                    "content": info["content"],
+                    "error": None if info["error"] is None else str(info["error"]),
+                    "duplicate_of": None,
+                    "collapsed": None,
+                    "data_summary": None,
+                    "reference": None,
+                }
+                if str(file_path) in collapsed and info["error"] is None:
+                    record["content"] = None
+                    record["collapsed"] = collapsed[str(file_path)]
+                elif str(file_path) in data_summaries and info["error"] is None:
+                    record["content"] = data_summaries[str(file_path)].get("sample")
+                    record["data_summary"] = data_summary_record(data_summaries[str(file_path)])
+                if skeletons and record["content"] is not None and str(file_path) in skeletons:
+                    record["content"] = skeletons[str(file_path)]
+                    redactions = None
+                if deduplicator and info["error"] is None:
+                    original = deduplicator.original_of(info["sha256"], rel_path, info["size"])
+                    if original is not None:
+                        record["content"] = None
+                        record["duplicate_of"] = original.as_posix()
+                if redactor and record["content"] is not None:
+                    # Contents read from the file were scanned as they were read.
+                    if redactions is None:
+                        record["content"] = redactor.redact(record["content"])
+                    else:
+                        redactor.tally(redactions)
+                if stripper and record["content"] is not None:
+                    record["content"] = stripper.strip(record["content"], language, ext)
+                if chunker:
+                    # Chunks are written in file order as their ranges become ready.
+                    if record["content"] is not None:
+                        pending.append((record, *chunker.submit(record["content"], language)))
+                    while pending and (len(pending) > chunker.WINDOW or pending[0][2].done()):
+                        write_chunks(*pending.popleft())
+                    continue
+                data = encode(record)
+                if output_digest:
+                    output_digest.add(data)
+                f.write(data)
+            while pending:
+                write_chunks(*pending.popleft())
+            if options.reproducible:
+                digest = output_digest.hexdigest()
+                unchanged = output_unchanged(output_file, digest)
+                if not unchanged:
+                    f.seek(0)
+                    with open_output(output_file) as out:
+                        # The digest goes first, so output_unchanged finds it in the head.
+                        out.write(encode({"type": "tree", "digest": digest, **header}))
+                        shutil.copyfileobj(f, out, _READ_CHUNK)
+                    digest_file = write_digest(output_file, digest)
+    except Exception as e:
+        raise RuntimeError(f"Error writing to output file '{output_file}': {e}")
+    summary = []
+    if digest and unchanged:
+        summary.append(f"Output unchanged ({digest}), not rewritten")
+    elif digest:
+        summary.append(f"Digest: {digest}" + (f" ({digest_file})" if digest_file else ""))
+    if deduplicator:
+        summary.append(f"Deduplication: {deduplicator.summary()}")
+    if stripper:
+        summary.extend(stripper.summary_lines())
+    if redactor:
+        redactor.save()
+        summary.append(redactor.summary())
+    if chunker:
+        summary.append(chunker.summary())
+    if codebase_stats:
+        stats_file = codebase_stats.write(output_file)
+        if stats_file:
+            summary.append(f"Statistics generated: {stats_file}")
+        summary.extend(codebase_stats.table_lines())
+    return summary
+
+def render_output(
+    root_path: pathlib.Path,
+    included_files: List[pathlib.Path],
+    output_file: str,
+    options: Optional[RenderOptions] = None,
+    skeletons: Optional[Dict[str, str]] = None,
+    source: Any = None,
+    collapsed: Optional[Dict[str, str]] = None,
+    data_summaries: Optional[Dict[str, Dict[str, Any]]] = None,
+    references: Optional[Dict[str, Tuple[str, str]]] = None,
+) -> List[str]:
+    """
+    Render the filtered files in the output format of options (see
+    OUTPUT_FORMATS): Markdown with render_markdown, anything else with
+    render_records, which reject the options they do not support.
+    """
+    options = options or RenderOptions()
+    render = render_markdown if options.output_format == "markdown" else render_records
+    return render(root_path, included_files, output_file, options, skeletons=skeletons, source=source,
+                  collapsed=collapsed, data_summaries=data_summaries, references=references)
+
+def select_enhanced_files(
+    root_path: pathlib.Path,
+    index: WorkspaceIndex,
+    selected_paths: Optional[Set[str]],
+    excluded_paths: Set[str],
+    exclude_patterns: Optional[List[str]] = None,
+    gitignore_spec: Optional[pathspec.PathSpec] = None,
+    include_patterns: Optional[List[str]] = None,
+) -> List[pathlib.Path]:
+    """
+    The files generate_enhanced_markdown renders, relative to root_path.parent,
+    in output order: the files of index that are selected (see
+    is_path_selected; with selected_paths None, all are), match
+    include_patterns if any are given, and are not excluded by
+    exclude_patterns or gitignore_spec.
+    """
+    base = root_path.parent
+    included_files = []
+    try:
+        pattern_included = index.matching(include_patterns) if include_patterns else None
+        pattern_excluded = index.matching(exclude_patterns)
+        for rel in index.files(links=True):
+            if rel in pattern_excluded or (pattern_included is not None and rel not in pattern_included):
+                continue
+            if gitignore_spec is not None:
+                if gitignore_spec is index.gitignore_spec:
+                    ignored = index.is_ignored(rel)
+                else:
+                    ignored = gitignore_spec.match_file(rel)
+                if ignored:
+                    continue
+            if selected_paths is None:
+                included_files.append(pathlib.Path(root_path.name, rel))
+                continue
+            file = root_path / rel
+            if is_path_selected(file, root_path, selected_paths, excluded_paths):
+                included_files.append(file.relative_to(base))
+    except Exception as e:
+        raise RuntimeError(f"Error scanning directory '{root_path}': {e}")
+    return included_files
+
+def _enhanced_header(
+    root_path: pathlib.Path,
+    included_files: List[pathlib.Path],
+    tree: PathTrie,
+    totals: Dict[str, int],
+    add_toc: bool,
+    add_dir_structure: bool,
+    combined_toc_dir: bool,
+    add_file_stats: bool,
+    dedupe: bool,
+    reproducible: bool,
+) -> Tuple[List[str], List[Dict[str, Any]], Optional[int]]:
+    """
+    The lines of an enhanced document up to its "## Files" heading, their
+    sections (see write_section_index) and, with reproducible, the index of the
+    digest line to fill in. totals holds the "lines" and "size" of the included
+    files and, with dedupe, the "duplicates" found and the "bytes_saved".
+    """
+    md_lines = []
+    sections = [{"kind": "header", "start": 0}]
+    md_lines.append(f"# Codebase: {root_path.name}")
+    md_lines.append("")
+
+    # Add metadata for AI consumption
+    md_lines.append("## Metadata")
+    md_lines.append("")
+    digest_at = None
+    if not reproducible:
+        md_lines.append(f"- **Generated on:** {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    else:
+        if os.environ.get("SOURCE_DATE_EPOCH"):
+            pinned = datetime.datetime.fromtimestamp(int(os.environ["SOURCE_DATE_EPOCH"]), datetime.timezone.utc)
+            md_lines.append(f"- **Generated on:** {pinned.strftime('%Y-%m-%d %H:%M:%S')} UTC")
+        digest_at = len(md_lines)
+        md_lines.append("- **Digest:** `{digest}`")
+    md_lines.append(f"- **Files included:** {len(included_files)}")
+
+    if add_file_stats:
+        md_lines.append(f"- **Total lines of code:** {totals['lines']:,}")
+        md_lines.append(f"- **Total size:** {format_size(totals['size'])}")
+    if dedupe:
+        md_lines.append(f"- **Deduplicated files:** {totals['duplicates']} ({format_size(totals['bytes_saved'])} saved)")
+    sections[-1]["end"] = len(md_lines)
+    md_lines.append("")
+
+    # Add combined TOC and directory structure
+    if combined_toc_dir:
+        sections.append({"kind": "tree", "start": len(md_lines)})
+        md_lines.append("## Project Structure")
+        md_lines.append("")
+        md_lines.append("```")
+
+        # Generate a linked version of the tree
+        linked_tree_lines = format_linked_tree(tree)
+        md_lines.append("\n".join(linked_tree_lines))
+
+        md_lines.append("```")
+        sections[-1]["end"] = len(md_lines)
+        md_lines.append("")
+    else:
+        # Add table of contents with anchor links
+        if add_toc:
+            sections.append({"kind": "toc", "start": len(md_lines)})
+            md_lines.append("## Table of Contents")
+            md_lines.append("")
+
+            if add_dir_structure:
+                md_lines.append("1. [Directory Structure](#directory-structure)")
+
+            md_lines.append(f"{1 if not add_dir_structure else 2}. [Files](#files)")
+
+            for i, rel_path in enumerate(included_files):
+                # Create an anchor-friendly ID
+                anchor = f"file-{i+1}"
+                md_lines.append(f"   - [{rel_path}](#{anchor})")
+
+            sections[-1]["end"] = len(md_lines)
+            md_lines.append("")
+
+        # Add directory structure as a separate section
+        if add_dir_structure:
+            sections.append({"kind": "tree", "start": len(md_lines)})
+            md_lines.append("## Directory Structure")
+            md_lines.append("")
+            md_lines.append("```")
+            md_lines.append("\n".join(format_tree(tree)))
+            md_lines.append("```")
+            sections[-1]["end"] = len(md_lines)
+            md_lines.append("")
+
+    md_lines.append("## Files")
+    md_lines.append("")
+    return md_lines, sections, digest_at
+
+def _enhanced_file_section(
+    md_lines: List[Any],
+    i: int,
+    included_files: List[pathlib.Path],
+    info: Dict[str, Any],
+    original: Optional[int],
+    base: pathlib.Path,
+    add_toc: bool,
+    add_dir_structure: bool,
+    combined_toc_dir: bool,
+    add_file_stats: bool,
+    add_file_contents: bool,
+    reference: Optional[Tuple[str, str]] = None,
+) -> Dict[str, Any]:
+    """
+    Append the section of the i-th included file (read into info, see
+    read_file_info) to md_lines and return it (see write_section_index).
+    original is the index of an earlier file with the same contents, if any.
+    A path rendered as a reference (see format_reference) is not read and
+    has no info.
+    """
+    rel_path = included_files[i]
+    # Create an anchor-friendly ID
+    anchor = f"file-{i+1}"
+
+    section = {"kind": "file", "path": rel_path.as_posix(), "start": len(md_lines),
+               "sha256": info["sha256"] if info else None}
+    md_lines.append(f"### {rel_path} <a id='{anchor}'></a>")
+    md_lines.append("")
+
+    if reference is not None:
+        if reference[0] == "same_file":
+            section["duplicate_of"] = reference[1]
+        md_lines.append(format_reference(*reference))
+    elif add_file_stats:
+        if info["exists"]:
+            if info["lines"] is not None:
+                md_lines.append(f"- Lines: {info['lines']}")
+            elif isinstance(info["error"], UnicodeDecodeError):
+                md_lines.append("- Binary file")
+            else:
+                md_lines.append(f"- Error reading file: {info['error']}")
+
+            md_lines.append(f"- Size: {format_size(info['size'])}")
+            md_lines.append("")
+
+    if not add_file_contents or reference is not None:
+        pass
+    elif original is not None:
+        section["duplicate_of"] = included_files[original].as_posix()
+        md_lines.append(f"*Identical to [{included_files[original]}](#file-{original + 1})*")
+    else:
+        file_path = base / rel_path
+        ext = file_path.suffix
+        language = guess_language(ext)
+        md_lines.append(f"```{language}")
+        if info["passthrough"]:
+            content = FileContents(file_path, info["size"], info["sha256"])
+        elif info["error"] is None:
+            content = info["content"]
+        else:
+            content = f"Error reading file: {info['error']}"
+        if info["error"] is None:
+            section["content"] = len(md_lines)
+        md_lines.append(content)
+        md_lines.append("```")
+
+    # Always add navigation links for files
+    md_lines.append("")
+    if combined_toc_dir:
+        md_lines.append("<div style='text-align: right;'><a href='#project-structure'>↑ Back to Project Structure</a></div>")
+    elif add_dir_structure:
+        md_lines.append("<div style='text-align: right;'><a href='#directory-structure'>↑ Back to Directory Structure</a></div>")
+    elif add_toc:
+        md_lines.append("<div style='text-align: right;'><a href='#table-of-contents'>↑ Back to Table of Contents</a></div>")
+
+    section["end"] = len(md_lines)
+    md_lines.append("")
+    return section
+
+class _EnhancedWriter:
+    """
+    Streams an enhanced document (see generate_enhanced_markdown) as its files
+    are read: each file section is written to a spooled temporary file as it
+    comes, and the header, which needs the totals, is written in front of
+    them by finish(). profile holds the document's settings as a profile of
+    load_profiles does. The contents of passthrough files (see
+    read_file_info) are not spooled but copied into the output by finish().
+    """
+
+    _SPOOL_SIZE = 16 << 20
+
+    def __init__(self, root_path: pathlib.Path, included_files: List[pathlib.Path], profile: Dict[str, Any]):
+        self.root_path = root_path
+        self.included_files = included_files
+        self.profile = profile
+        self.options = profile["options"]
+        self.positions = {rel_path: i for i, rel_path in enumerate(included_files)}
+        self.newline = "\n" if self.options.reproducible else None
+        self.body = tempfile.SpooledTemporaryFile(max_size=self._SPOOL_SIZE)
+        self.body_size = 0
+        self.items = 0
+        self.spans: List[Tuple[int, int]] = []  # byte spans of the body items
+        self.leaves: List[str] = []  # hashes of the body items, for the digest
+        self.sections: List[Dict[str, Any]] = []  # with body item indexes
+        self.copies: List[Tuple[int, FileContents]] = []  # (spool offset, passthrough contents to copy there)
+        self.totals = {"lines": 0, "size": 0}
+        self.deduplicator = ContentDeduplicator() if self.options.dedupe else None
+
+    def add(self, rel_path: pathlib.Path, info: Optional[Dict[str, Any]],
+            reference: Optional[Tuple[str, str]] = None) -> None:
+        """
+        Write the section of an included file (read into info, see
+        read_file_info), or of a path rendered as a reference (see
+        format_reference), which has no info. Passthrough contents must not
+        need newline translation.
+        """
+        i = self.positions[rel_path]
+        if info and info["exists"]:
+            if info["lines"] is not None:
+                self.totals["lines"] += info["lines"]
+            self.totals["size"] += info["size"]
+        original = None
+        if self.deduplicator and info and info["error"] is None and info["sha256"] is not None:
+            original = self.deduplicator.original_of(info["sha256"], i, info["size"])
+        lines = []
+        profile = self.profile
+        section = _enhanced_file_section(lines, i, self.included_files, info, original, self.root_path.parent,
+                                         profile["add_toc"], profile["add_dir_structure"],
+                                         profile["combined_toc_dir"], profile["add_file_stats"],
+                                         profile["add_file_contents"], reference)
+        for key in ("start", "end", "content"):
+            if key in section:
+                section[key] += self.items
+        self.sections.append(section)
+        # The section is encoded in one piece, as MarkdownWriter would write its lines.
+        separator = (self.newline or os.linesep).encode("ascii")
+        fast = not self.options.section_index and not self.options.reproducible
+        if fast and not any(isinstance(line, FileContents) for line in lines):
+            data = "\n".join(lines).encode("utf-8")
+            if separator != b"\n":
+                data = data.replace(b"\n", separator)
+            if self.items:
+                data = separator + data
+            self.body.write(data)
+            self.items += len(lines)
+            return
+        parts = []
+        for line in lines:
+            if self.items:
+                parts.append(separator)
+                self.body_size += len(separator)
+            if isinstance(line, FileContents):
+                self.body.write(b"".join(parts))
+                parts = []
+                self.copies.append((self.body.tell(), line))
+                if self.options.reproducible:
+                    self.leaves.append(line.sha256)
+                size = line.size
+            else:
+                data = line.encode("utf-8")
+                if self.options.reproducible:
+                    self.leaves.append(hashlib.sha256(data).hexdigest())
+                if separator != b"\n":
+                    data = data.replace(b"\n", separator)
+                parts.append(data)
+                size = len(data)
+            self.spans.append((self.body_size, self.body_size + size))
+            self.body_size += size
+            self.items += 1
+        self.body.write(b"".join(parts))
+
+    def _copy_body(self, writer: MarkdownWriter) -> None:
+        """Copy the spooled sections into writer's output, with the passthrough contents in their places."""
+        self.body.seek(0)
+        position = 0
+        for offset, contents in self.copies:
+            while position < offset:
+                chunk = self.body.read(min(_READ_CHUNK, offset - position))
+                writer.f.write(chunk)
+                position += len(chunk)
+            writer.write_file(contents)
+        shutil.copyfileobj(self.body, writer.f, _READ_CHUNK)
+
+    def finish(self, output_file: str) -> Optional[str]:
+        """
+        Write the document (header, then the spooled sections) to output_file,
+        with its section index and digest as the profile asks. Returns the
+        digest of a reproducible document that was already up to date, else None.
+        """
+        profile = self.profile
+        tree = build_compact_tree(self.included_files) if profile["compact_tree"] else build_tree(self.included_files)
+        if self.deduplicator:
+            self.totals.update(duplicates=self.deduplicator.duplicates, bytes_saved=self.deduplicator.bytes_saved)
+        md_lines, sections, digest_at = _enhanced_header(self.root_path, self.included_files, tree, self.totals,
+                                                         profile["add_toc"], profile["add_dir_structure"],
+                                                         profile["combined_toc_dir"], profile["add_file_stats"],
+                                                         self.options.dedupe, self.options.reproducible)
+        digest = None
+        if self.options.reproducible:
+            output_digest = OutputDigest()
+            output_digest.add_lines(md_lines, skip=digest_at)
+            for leaf in self.leaves:
+                output_digest.add_hash(leaf)
+            digest = output_digest.hexdigest()
+            md_lines[digest_at] = md_lines[digest_at].format(digest=digest)
+            if output_unchanged(output_file, digest, self.options.section_index):
+                self.body.close()
+                return digest
+        spans = []
+        try:
+            with open_output(output_file) as f:
+                writer = MarkdownWriter(f, self.newline)
+                for i, line in enumerate(md_lines):
+                    if i:
+                        writer.write("\n")
+                    start = writer.offset
+                    writer.write(line)
+                    spans.append((start, writer.offset))
+                writer.write("\n")
+                offset = writer.offset
+                self._copy_body(writer)
+        except Exception as e:
+            raise RuntimeError(f"Error writing to output file '{output_file}': {e}")
+        finally:
+            self.body.close()
+        if self.options.section_index:
+            header_items = len(md_lines)
+            for section in self.sections:
+                for key in ("start", "end", "content"):
+                    if key in section:
+                        section[key] += header_items
+            spans.extend((start + offset, end + offset) for start, end in self.spans)
+            write_section_index(output_file, sections + self.sections, spans)
+        if digest:
+            write_digest(output_file, digest)
+        return None
+
+# The RenderOptions supported by generate_enhanced_markdown (the GUI, --from-config and --profiles).
+ENHANCED_OPTIONS = ("dedupe", "section_index", "reproducible", "io_concurrency", "symlinks")
+
+def generate_enhanced_markdown(
+    root_path: pathlib.Path,
+    output_file: str,
+    selected_paths: Set[str],
+    excluded_paths: Set[str],
+    exclude_patterns: Optional[List[str]] = None,
+    gitignore_spec: Optional[pathspec.PathSpec] = None,
+    add_toc: bool = True,
+    add_dir_structure: bool = True,
+    combined_toc_dir: bool = False,
+    compact_tree: bool = False,
+    add_file_stats: bool = False,
+    index: Optional[WorkspaceIndex] = None,
+    options: Optional[RenderOptions] = None,
+    add_file_contents: bool = True
+) -> None:
+    """
+    Enhanced version of generate_markdown with additional features for AI consumption:
+    - Optional table of contents with anchor links
+    - Optional directory structure representation
+    - Combined TOC and directory structure
+    - Compact tree view (omitting empty directories)
+    - File statistics (lines of code, file size)
+    - Deduplication: files identical to an earlier one link to it instead of repeating it
+    - Byte-offset sidecar index (output_file + ".idx") for random access, see SectionIndex
+    - Reproducible output: no generation time (unless pinned with the
+      SOURCE_DATE_EPOCH environment variable), "\\n" line endings, and a
+      digest in the metadata and in output_file + ".digest"; an existing
+      output with the same digest is not rewritten (see render_markdown)
+    - Without add_file_contents, only the metadata, TOC, tree and file
+      statistics (a stats-only document); files are then only read to
+      count their lines (add_file_stats) or find duplicates (dedupe), so
+      otherwise their sections in the index have no SHA-256
+    - Symbolic links that the index's symlink policy does not read (see
+      SYMLINK_POLICIES) and files already included through another path are
+      rendered as a note (see format_reference)
+
+    Of the RenderOptions in options, dedupe, section_index and reproducible
+    select the features above, io_concurrency reads files ahead concurrently
+    and symlinks is the policy of the scan; the others (stripping, redaction,
+    classification, data summaries, statistics, skeletons and the record
+    formats) are not supported here and raise ValueError.
+
+    If a WorkspaceIndex for root_path is given, its scan and cached filter
+    verdicts are used instead of walking the workspace again; it must have
+    been scanned with the symlinks policy of options.
+
+    File sections are streamed by an _EnhancedWriter as the files are read,
+    so the document is never held in memory.
+    """
+    options = options or RenderOptions()
+    options.require(ENHANCED_OPTIONS, "The enhanced generator")
+    base = root_path.parent
+
+    if index is None:
+        try:
+            index = WorkspaceIndex(root_path, ScanExclusions(symlinks=options.symlinks)).scan()
+        except Exception as e:
+            raise RuntimeError(f"Error scanning directory '{root_path}': {e}")
+    elif index.exclusions.symlinks != options.symlinks:
+        raise ValueError(f"The workspace index was scanned with the symlink policy '{index.exclusions.symlinks}', "
+                         f"not '{options.symlinks}'.")
+    included_files = select_enhanced_files(root_path, index, selected_paths, excluded_paths, exclude_patterns,
+                                           gitignore_spec)
+
+    if not included_files:
+        raise ValueError("No files found matching the criteria.")
+
+    references = {}
+    if index.exclusions.symlinks != "files":
+        rels = {pathlib.PurePath(*rel.parts[1:]).as_posix(): rel for rel in included_files}
+        for rel, (kind, target) in index.references(list(rels)).items():
+            if kind != "link":
+                target = pathlib.PurePosixPath(root_path.name, target).as_posix()
+            references[rels[rel]] = (kind, target)
+
+    writer = _EnhancedWriter(root_path, included_files, {
+        "options": options, "add_toc": add_toc, "add_dir_structure": add_dir_structure,
+        "combined_toc_dir": combined_toc_dir, "compact_tree": compact_tree, "add_file_stats": add_file_stats,
+        "add_file_contents": add_file_contents,
+    })
+    # Files are read (once) only for what the document shows: contents, line counts or duplicates; otherwise
+    # their size is all it needs. Contents are copied into the output unless they need newline translation.
+    read = add_file_contents or add_file_stats or options.dedupe
+    passthrough = options.reproducible or os.linesep == "\n"
+    requests = [(base / rel_path, passthrough) for rel_path in included_files if rel_path not in references]
+    infos = iter_file_infos(requests if read else [],
+                            hash_content=options.dedupe or options.section_index or options.reproducible,
+                            concurrency=options.io_concurrency)
+    for rel_path in included_files:
+        if rel_path in references:
+            writer.add(rel_path, None, references[rel_path])
+        else:
+            writer.add(rel_path, next(infos) if read else unread_file_info(base / rel_path))
+    writer.finish(output_file)
+
+def open_workspace_index(root: pathlib.Path, exclusions: Optional[ScanExclusions] = None) -> WorkspaceIndex:
+    """
+    Return an up-to-date WorkspaceIndex for root: the cached scan revalidated
+    against the disk if there is one, otherwise a fresh scan. Changes are saved back to the cache.
+    """
+    index = WorkspaceIndex.load(root, exclusions)
+    if index is None:
+        index = WorkspaceIndex(root, exclusions).scan()
+        index.save()
+    elif index.revalidate():
+        index.save()
+    return index
+
+def run_saved_configuration(config_file: str) -> str:
+    """
+    Replay a configuration saved by the GUI (basegen_config.json) without Tk:
+    the same workspace, options, exclusion patterns and file selection produce
+    the same output as generating from the GUI. Returns the output file path.
+    Render options in the configuration (see RenderOptions) that
+    generate_enhanced_markdown does not support raise ValueError.
+    """
+    with open(config_file, "r", encoding="utf-8") as f:
+        saved = json.load(f)
+    if not saved.get("workspace"):
+        raise ValueError(f"Configuration '{config_file}' does not specify a workspace.")
+    # Relative workspace and output paths are taken relative to the configuration file.
+    config_dir = os.path.dirname(os.path.abspath(config_file))
+    root = pathlib.Path(config_dir, saved["workspace"])
+    if not root.is_dir():
+        raise ValueError(f"Workspace path '{root}' does not exist.")
+
+    output_file = os.path.join(config_dir, saved.get("output_file") or str(root / "codebase.md"))
+
+    if "exclusion_patterns" in saved:
+        exclude_patterns = saved["exclusion_patterns"]
+    elif saved.get("use_hardcoded_excludes", True):
+        exclude_patterns = config_data.get("HARD_CODED_EXCLUDES", [])
+    else:
+        exclude_patterns = []
+
+    options = RenderOptions(**{name: saved[name] for name in RenderOptions.DEFAULTS if name in saved})
+    options.require(ENHANCED_OPTIONS, f"Configuration '{config_file}'")
+    exclusions = ScanExclusions(
+        saved.get("tree_exclusions", DEFAULT_TREE_EXCLUSIONS),
+        saved.get("file_exclusions", DEFAULT_FILE_EXCLUSIONS),
+        options.symlinks,
+    )
+    index = open_workspace_index(root, exclusions)
+    gitignore_spec = index.gitignore_spec if saved.get("respect_gitignore", True) else None
+
+    # Without a saved selection everything in the workspace is selected, as in a freshly opened tree.
+    selected_paths = set(saved.get("selected_files") or [str(root)])
+    excluded_paths = set(saved.get("excluded_files") or [])
+
+    combined_toc_dir = saved.get("combined_toc_dir", False)
+    generate_enhanced_markdown(
+        root,
+        output_file,
+        selected_paths,
+        excluded_paths,
+        exclude_patterns,
+        gitignore_spec,
+        add_toc=saved.get("add_toc", True) or combined_toc_dir,
+        add_dir_structure=saved.get("add_dir_structure", True) or combined_toc_dir,
+        combined_toc_dir=combined_toc_dir,
+        compact_tree=saved.get("compact_tree", False),
+        add_file_stats=saved.get("add_file_stats", True),
+        index=index,
+        options=options,
+        add_file_contents=saved.get("add_file_contents", True),
+    )
+    return output_file
+
+def run_batch(config_files: List[str], jobs: Optional[int] = None) -> int:
+    """
+    Run several saved GUI configurations, in parallel across a process pool.
+    Errors are reported per configuration; returns the number of failed runs.
+    """
+    failures = 0
+    if jobs == 1 or len(config_files) == 1:
+        results = []
+        for config_file in config_files:
+            try:
+                results.append((config_file, run_saved_configuration(config_file), None))
+            except Exception as e:
+                results.append((config_file, None, e))
+    else:
+        results = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(run_saved_configuration, config_file): config_file for config_file in config_files}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    results.append((futures[future], future.result(), None))
+                except Exception as e:
+                    results.append((futures[future], None, e))
+
+    for config_file, output_file, error in results:
+        if error is None:
+            print(f"Markdown file generated: {output_file} (from {config_file})")
+        else:
+            print(f"Error processing configuration '{config_file}': {error}", file=sys.stderr)
+            failures += 1
+    return failures
+
+# Options of an output profile (see load_profiles), with their defaults. They
+# are those of a saved GUI configuration, plus include patterns and whether
+# file contents are rendered at all.
+PROFILE_OPTIONS = {
+    "output_file": None,
+    "include": [],
+    "exclude": [],
+    "use_hardcoded_excludes": True,
+    "respect_gitignore": True,
+    "add_toc": True,
+    "add_dir_structure": True,
+    "combined_toc_dir": False,
+    "compact_tree": False,
+    "add_file_stats": True,
+    "add_file_contents": True,
+}
+# The RenderOptions a profile may set (as more keys of its object); see ENHANCED_OPTIONS.
+PROFILE_RENDER_OPTIONS = ("dedupe", "section_index", "reproducible")
+
+def load_profiles(profiles_file: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Read output profiles from a JSON file of the form
+    {"profiles": {"<name>": {<PROFILE_OPTIONS>}, ...}} and return them by
+    name with defaults filled in. Render options (see RenderOptions) are
+    collected into a RenderOptions under "options"; only
+    PROFILE_RENDER_OPTIONS are supported. Output files default to
+    "<name>.md"; relative ones are taken relative to the profiles file.
+    Raises ValueError for invalid profiles and unsupported render options.
+    """
+    with open(profiles_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    profiles = data.get("profiles") if isinstance(data, dict) else None
+    if not isinstance(profiles, dict) or not profiles:
+        raise ValueError(f"'{profiles_file}' must hold an object with a non-empty \"profiles\" object.")
+    base_dir = os.path.dirname(os.path.abspath(profiles_file))
+    loaded = {}
+    outputs = {}
+    for name, options in profiles.items():
+        if not isinstance(options, dict):
+            raise ValueError(f"Profile '{name}' must be an object.")
+        unknown = set(options) - set(PROFILE_OPTIONS) - set(RenderOptions.DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown option(s) in profile '{name}': {', '.join(sorted(unknown))}")
+        render_options = RenderOptions(**{key: value for key, value in options.items()
+                                          if key in RenderOptions.DEFAULTS})
+        render_options.require(PROFILE_RENDER_OPTIONS, f"Profile '{name}'")
+        profile = dict(PROFILE_OPTIONS, **{key: value for key, value in options.items() if key in PROFILE_OPTIONS})
+        profile["options"] = render_options
+        for key in ("include", "exclude"):
+            if not isinstance(profile[key], list) or not all(isinstance(p, str) for p in profile[key]):
+                raise ValueError(f"'{key}' in profile '{name}' must be a list of glob patterns.")
+        profile["output_file"] = os.path.join(base_dir, profile["output_file"] or f"{name}.md")
+        if profile["output_file"] in outputs:
+            raise ValueError(f"Profiles '{outputs[profile['output_file']]}' and '{name}' would both write "
+                             f"'{profile['output_file']}'.")
+        outputs[profile["output_file"]] = name
+        if profile["combined_toc_dir"]:
+            profile["add_toc"] = profile["add_dir_structure"] = True
+        loaded[name] = profile
+    return loaded
+
+def generate_profiles(
+    root: pathlib.Path, profiles: Dict[str, Dict[str, Any]], options: Optional[RenderOptions] = None
+) -> int:
+    """
+    Render several output profiles (see load_profiles) of one workspace, each
+    as generate_enhanced_markdown would with the same options. The workspace
+    is scanned once and every file any profile includes is read once; its
+    section is then written to the document of each profile that includes it.
+    options apply to all profiles: with an io_concurrency above 1, files are
+    read ahead concurrently; other RenderOptions raise ValueError (profiles
+    set their own, see load_profiles).
+    Errors are reported per profile; returns the number of failed profiles.
+    """
+    options = options or RenderOptions()
+    options.require(("io_concurrency",), "Profile generation")
+    index = open_workspace_index(root)
+    exclusions = config_data.get("HARD_CODED_EXCLUDES", [])
+    writers = {}
+    failures = 0
+    for name, profile in profiles.items():
+        exclude_patterns = profile["exclude"] + (exclusions if profile["use_hardcoded_excludes"] else [])
+        try:
+            included_files = select_enhanced_files(root, index, None, set(), exclude_patterns,
+                                                   index.gitignore_spec if profile["respect_gitignore"] else None,
+                                                   profile["include"])
+        except RuntimeError as e:
+            print(f"Error generating profile '{name}': {e}", file=sys.stderr)
+            failures += 1
+            continue
+        if not included_files:
+            print(f"Error generating profile '{name}': No files found matching the criteria.", file=sys.stderr)
+            failures += 1
+            continue
+        writers[name] = _EnhancedWriter(root, included_files, profile)
+
+    # Every profile lists its files in index order, so visiting the union in
+    # that order hands each writer its files in its own order.
+    readers: Dict[pathlib.Path, List[_EnhancedWriter]] = {}
+    for writer in writers.values():
+        for rel_path in writer.included_files:
+            readers.setdefault(rel_path, []).append(writer)
+    rel_paths = sorted(readers, key=lambda rel_path: _rel_sort_key(rel_path.as_posix()))
+    hash_content = any(p["options"].dedupe or p["options"].section_index or p["options"].reproducible
+                       for p in profiles.values())
+    infos = iter_file_infos([(root.parent / rel_path, False) for rel_path in rel_paths], hash_content=hash_content,
+                            concurrency=options.io_concurrency)
+    for rel_path, info in zip(rel_paths, infos):
+        for writer in readers[rel_path]:
+            writer.add(rel_path, info)
+
+    for name, writer in writers.items():
+        output_file = profiles[name]["output_file"]
+        try:
+            output_dir = os.path.dirname(output_file)
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            unchanged = writer.finish(output_file)
+        except Exception as e:
+            print(f"Error generating profile '{name}': {e}", file=sys.stderr)
+            failures += 1
+            continue
+        if unchanged:
+            print(f"Markdown file unchanged: {output_file} (profile {name}, {unchanged})")
+        else:
+            print(f"Markdown file generated: {output_file} (profile {name}, {len(writer.included_files)} files)")
+    print(f"Profiles: {len(writers)} rendered from {len(rel_paths)} file(s), each read once")
+    return failures
+
+def _read_package_manifest(manifest: pathlib.Path) -> List[str]:
+    """Read the package globs listed in a manifest file (JSON or one glob per line)."""
+    text = manifest.read_text(encoding="utf-8")
+    if manifest.suffix.lower() != ".json":
+        return [line.strip() for line in text.splitlines() if line.strip() and not line.strip().startswith("#")]
+    data = json.loads(text)
+    if isinstance(data, dict):
+        data = data.get("packages", data.get("workspaces", []))
+        if isinstance(data, dict):
+            data = data.get("packages", [])
+    if not isinstance(data, list) or not all(isinstance(item, str) for item in data):
+        raise ValueError(f"Package manifest '{manifest}' must contain a list of package paths or globs.")
+    return data
+
+def resolve_packages(root: pathlib.Path, specs: List[str]) -> List[str]:
+    """
+    Expand --packages arguments into package directories relative to root
+    (POSIX-style, sorted). Each argument is either a glob relative to root such as
+    "packages/*", or a manifest file: a JSON list of globs, a JSON object with a
+    "packages" or "workspaces" list (package.json / lerna.json style), or a text
+    file with one glob per line. Globs starting with "!" remove matches again.
+    """
+    patterns = []
+    for spec in specs:
+        manifest = pathlib.Path(spec)
+        if manifest.is_file():
+            patterns.extend(_read_package_manifest(manifest))
+        else:
+            patterns.append(spec)
+
+    packages = set()
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        pattern = pattern.lstrip("!").strip("/")
+        if pattern.startswith("./"):
+            pattern = pattern[2:]
+        if not pattern or pattern == ".":
+            continue
+        matches = {
+            str(path.relative_to(root)).replace(os.sep, "/")
+            for path in root.glob(pattern) if path.is_dir()
+        }
+        packages = packages - matches if negate else packages | matches
+    return sorted(packages, key=_rel_sort_key)
+
+def generate_packages(
+    root: pathlib.Path,
+    packages: List[str],
+    output_template: str,
+    include_patterns: Optional[List[str]] = None,
+    exclude_patterns: Optional[List[str]] = None,
+    use_gitignore: bool = True,
+    index_output: Optional[str] = None,
+    options: Optional[RenderOptions] = None,
+) -> int:
+    """
+    Generate one Markdown document per package of a monorepo.
+
+    The repository is walked once and its .gitignore files are compiled into a
+    single spec (evaluated relative to the repository root); every package then
+    takes its files from that shared scan. Include/exclude patterns are matched
+    relative to each package root, as if the package had been passed as input.
+    Rendering is spread across a pool of up to jobs processes. output_template
+    may use {name} (package directory name) and {path} (package path with "/"
+    replaced by "-"). options (a RenderOptions) apply to every package as in
+    generate_markdown, except that with skeleton Python files are outlined
+    once up front for all packages; symlinks is not supported (ValueError).
+    Optionally a combined Markdown index linking all package documents is written.
+    Returns the number of packages that failed.
+    """
+    options = options or RenderOptions()
+    options.require(set(RenderOptions.DEFAULTS) - {"symlinks"}, "Package generation")
+    index = WorkspaceIndex(root).scan()
+    package_set = set(packages)
+    package_files: Dict[str, List[pathlib.Path]] = {package: [] for package in packages}
+    for rel in index.files():
+        if use_gitignore and index.is_ignored(rel):
+            continue
+        # A file belongs to every listed package that contains it (packages may nest).
+        parts = rel.split("/")
+        for depth in range(1, len(parts)):
+            package = "/".join(parts[:depth])
+            if package not in package_set:
+                continue
+            rel_in_package = "/".join(parts[depth:])
+            if include_patterns and not any(fnmatch.fnmatch(rel_in_package, p) for p in include_patterns):
+                continue
+            if exclude_patterns and any(fnmatch.fnmatch(rel_in_package, p) for p in exclude_patterns):
+                continue
+            package_files[package].append(pathlib.Path(parts[depth - 1], *parts[depth:]))
+
+    outputs = {}
+    writers = {}
+    for package in packages:
+        output_file = output_template.format(name=package.rsplit("/", 1)[-1], path=package.replace("/", "-"))
+        if output_file in writers:
+            raise ValueError(f"Packages '{writers[output_file]}' and '{package}' would both write "
+                             f"'{output_file}'; use {{path}} in the output name.")
+        outputs[package] = output_file
+        writers[output_file] = package
+
+    package_collapsed: Dict[str, Optional[Dict[str, str]]] = {package: None for package in packages}
+    if options.classify:
+        classifier = ContentClassifier(config_data.get("CONTENT_CLASSIFIER"))
+        for package in packages:
+            package_files[package], package_collapsed[package] = classifier.select(
+                (root / package).parent, package_files[package], options.classify)
+        print(classifier.summary(options.classify))
+
+    skeletons = None
+    if options.skeleton:
+        python_files = {root / package / pathlib.Path(*rel.parts[1:])
+                        for package in packages for rel in package_files[package] if rel.suffix == ".py"}
+        skeletons = PythonSkeletons(options.jobs).build(sorted(python_files))
+        print(f"Skeletons: {skeletons.summary()}")
+
+    data_summaries = None
+    if options.summarize_data:
+        data_files = {root / package / pathlib.Path(*rel.parts[1:])
+                      for package in packages for rel in package_files[package]
+                      if str((root / package).parent / rel) not in (package_collapsed[package] or {})}
+        data_summaries = DataSummaries(config_data.get("DATA_SUMMARY")).build(sorted(data_files))
+        print(f"Data summaries: {data_summaries.summary()}")
+
+    # Every package is rendered in a single process (chunking included), the pool runs them in parallel.
+    package_options = options.replace(jobs=1)
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=options.jobs) as pool:
+        futures = {}
+        for package in packages:
+            if not package_files[package]:
+                print(f"Warning: No files found matching the criteria in package '{package}'.", file=sys.stderr)
+            output_dir = os.path.dirname(outputs[package])
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+            package_skeletons = None
+            if skeletons:
+                prefix = str(root / package) + os.sep
+                package_skeletons = {path: outline for path, outline in skeletons.outlines.items()
+                                     if path.startswith(prefix)}
+            package_summaries = None
+            if data_summaries:
+                prefix = str(root / package) + os.sep
+                package_summaries = {path: summary for path, summary in data_summaries.summaries.items()
+                                     if path.startswith(prefix)}
+            future = pool.submit(render_output, root / package, package_files[package], outputs[package],
+                                 package_options, skeletons=package_skeletons,
+                                 collapsed=package_collapsed[package], data_summaries=package_summaries)
+            futures[future] = package
+        for future in concurrent.futures.as_completed(futures):
+            package = futures[future]
+            try:
+                summary = future.result()
+                print(f"{OUTPUT_FORMATS[options.output_format][0]} file generated: {outputs[package]}")
+                for line in summary:
+                    print(line)
+            except Exception as e:
+                print(f"Error generating package '{package}': {e}", file=sys.stderr)
+                failures += 1
+
+    if index_output:
+        index_dir = os.path.dirname(os.path.abspath(index_output))
+        lines = [f"# Packages: {root.name}", ""]
+        for package in packages:
+            link = os.path.relpath(os.path.abspath(outputs[package]), index_dir).replace(os.sep, "/")
+            lines.append(f"- [{package}]({link}) ({len(package_files[package])} files)")
+        lines.append("")
+        try:
+            with open(index_output, "w", encoding="utf-8") as f:
+                f.write("\n".join(lines))
+            print(f"Package index generated: {index_output}")
+        except Exception as e:
+            print(f"Error writing to output file '{index_output}': {e}", file=sys.stderr)
+            failures += 1
+    return failures
+
+class SnapshotService:
+    """
+    State shared by the requests of a long-running snapshot server (see
+    serve): one WorkspaceIndex per root, scanned on first use and kept in
+    memory, then only revalidated against the disk (directory mtimes and
+    .gitignore files) before each request. The compiled .gitignore rules and the per-pattern
+    file verdicts cached on each index are reused across requests. At most
+    MAX_INDEXES indexes are kept, the least recently used is dropped first.
+    """
+
+    MAX_INDEXES = 16
+
+    OPTIONS = {"root", "include", "exclude", "gitignore", "format", "dedupe", "strip", "strip_docstrings",
+               "skeleton", "query", "top_k", "max_tokens", "classify", "redact", "summarize_data",
+               "reproducible"}
+    # The request options that are RenderOptions (under the same name, except "format").
+    RENDER_OPTIONS = {"format": "output_format", "dedupe": "dedupe", "strip": "strip",
+                      "strip_docstrings": "strip_docstrings", "skeleton": "skeleton", "classify": "classify",
+                      "redact": "redact", "summarize_data": "summarize_data", "reproducible": "reproducible"}
+
+    def __init__(self, jobs: Optional[int] = None, allowed_roots: Optional[List[str]] = None):
+        self.jobs = jobs
+        # Requests may only snapshot these directories and their subdirectories (all, if None).
+        self.allowed_roots = None if allowed_roots is None else [pathlib.Path(root).resolve() for root in allowed_roots]
+        self.indexes: "collections.OrderedDict[str, WorkspaceIndex]" = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def workspace_index(self, root: pathlib.Path) -> WorkspaceIndex:
+        """The warm index for root, revalidated against the disk."""
+        key = str(root.resolve())
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                index = self.indexes[key] = WorkspaceIndex(root).scan()
+                while len(self.indexes) > self.MAX_INDEXES:
+                    self.indexes.popitem(last=False)
+                return index
+            self.indexes.move_to_end(key)
+        index.revalidate()
+        return index
+
+    def prepare(self, request: Dict[str, Any]) -> Tuple[Dict[str, Any], List[pathlib.Path], List[str]]:
+        """
+        Validate a request (a dict of OPTIONS) and select its files the same way
+        generate_markdown would. Returns the normalised options (with the
+        RenderOptions of the request, and the server's jobs, under "render"),
+        the selected files (relative to the root's parent) and summary lines.
+        Raises ValueError for invalid requests and PermissionError for a root
+        outside the allowed roots.
+        """
+        if not isinstance(request, dict):
+            raise ValueError("The request must be a JSON object.")
+        unknown = set(request) - self.OPTIONS
+        if unknown:
+            raise ValueError(f"Unknown option(s): {', '.join(sorted(unknown))}")
+        options = dict(request)
+        if not options.get("root"):
+            raise ValueError("The request must specify a root directory.")
+        root = pathlib.Path(options["root"])
+        if self.allowed_roots is not None:
+            resolved = root.resolve()
+            if not any(resolved == allowed or allowed in resolved.parents for allowed in self.allowed_roots):
+                raise PermissionError(f"The root path '{root}' is not below an allowed root.")
+        if not root.is_dir():
+            raise ValueError(f"The root path '{root}' is not a valid directory.")
+        options["root"] = root
+        if options.get("format", "markdown") not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown format '{options['format']}'.")
+        if options.get("classify") and options["classify"] not in CLASSIFY_ACTIONS:
+            raise ValueError(f"'classify' must be one of: {', '.join(CLASSIFY_ACTIONS)}.")
+        render = options["render"] = RenderOptions(jobs=self.jobs, **{
+            name: options[key] if key in ("format", "classify") else bool(options[key])
+            for key, name in self.RENDER_OPTIONS.items() if options.get(key)})
+        for name in ("include", "exclude"):
+            patterns = options.get(name) or []
+            if not isinstance(patterns, list) or not all(isinstance(p, str) for p in patterns):
+                raise ValueError(f"'{name}' must be a list of glob patterns.")
+            options[name] = patterns
+        if options.get("query") is not None and not isinstance(options["query"], str):
+            raise ValueError("'query' must be a string.")
+        for name in ("top_k", "max_tokens"):
+            value = options.get(name)
+            if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 1):
+                raise ValueError(f"'{name}' must be a positive integer.")
+        if (options.get("top_k") is not None or options.get("max_tokens") is not None) and not options.get("query"):
+            raise ValueError("top_k and max_tokens require a query.")
+
+        index = self.workspace_index(root)
+        exclude_patterns = options["exclude"] + config_data.get("HARD_CODED_EXCLUDES", [])
+        included = index.matching(options["include"]) if options["include"] else None
+        excluded = index.matching(exclude_patterns)
+        use_gitignore = options.get("gitignore", True)
+        included_files = [
+            pathlib.Path(root.name, rel) for rel in index.files()
+            if not (use_gitignore and index.is_ignored(rel))
+            and (included is None or rel in included) and rel not in excluded
+        ]
+        summary = []
+        options["collapsed"] = None
+        if render.classify:
+            classifier = ContentClassifier(config_data.get("CONTENT_CLASSIFIER"))
+            included_files, options["collapsed"] = classifier.select(root.parent, included_files, render.classify)
+            summary.append(classifier.summary(render.classify))
+        if options.get("query"):
+            included_files, query_summary = select_by_query(root, included_files, options["query"],
+                                                            options.get("top_k"), options.get("max_tokens"),
+                                                            concurrency=render.io_concurrency)
+            summary.append(query_summary)
+        return options, included_files, summary
+
+    def render(self, options: Dict[str, Any], included_files: List[pathlib.Path], output: Any) -> List[str]:
+        """Render the files selected by prepare() to output (a path or binary stream)."""
+        root = options["root"]
+        render = options["render"]
+        summary = []
+        skeletons = None
+        if render.skeleton:
+            collapsed = options["collapsed"] or {}
+            skeletons = PythonSkeletons(render.jobs).build([root.parent / rel for rel in included_files
+                                                           if rel.suffix == ".py"
+                                                           and str(root.parent / rel) not in collapsed])
+            summary.append(f"Skeletons: {skeletons.summary()}")
+        data_summaries = None
+        if render.summarize_data:
+            data_summaries = DataSummaries(config_data.get("DATA_SUMMARY")).build(
+                [root.parent / rel for rel in included_files
+                 if str(root.parent / rel) not in (options["collapsed"] or {})])
+            summary.append(f"Data summaries: {data_summaries.summary()}")
+        summary.extend(render_output(root, included_files, output, render,
+                                     skeletons=skeletons.outlines if skeletons else None,
+                                     collapsed=options["collapsed"],
+                                     data_summaries=data_summaries.summaries if data_summaries else None))
+        return summary
+
+class ChunkedWriter:
+    """
+    Binary stream that sends what is written to it as HTTP/1.1 chunks of up
+    to _READ_CHUNK bytes. close() sends the last chunk; a response whose
+    rendering failed is never closed, so the client sees it as incomplete.
+    raw_frame() lets MarkdownWriter copy a file straight into fileno().
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = bytearray()
+        self.raw = False
+
+    def write(self, data: bytes) -> int:
+        if self.raw:
+            self.f.write(data)
+        else:
+            self.buffer += data
+            if len(self.buffer) >= _READ_CHUNK:
+                self._send()
+        return len(data)
+
+    def _send(self) -> None:
+        if self.buffer:
+            self.f.write(b"%x\r\n" % len(self.buffer) + self.buffer + b"\r\n")
+            self.buffer.clear()
+
+    @contextlib.contextmanager
+    def raw_frame(self, size: int):
+        """Send the next size bytes, written to write() or to fileno(), as one chunk."""
+        if not size:
+            yield
+            return
+        self._send()
+        self.f.write(b"%x\r\n" % size)
+        self.raw = True
+        try:
+            yield
+        finally:
+            self.raw = False
+        self.f.write(b"\r\n")
+
+    def flush(self) -> None:
+        if not self.raw:
+            self._send()
+        self.f.flush()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def close(self) -> None:
+        self._send()
+        self.f.write(b"0\r\n\r\n")
+        self.f.flush()
+
+class _SnapshotRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /snapshot with a JSON object of SnapshotService.OPTIONS; the document
+    is streamed back as the response body, chunked for HTTP/1.1 clients. If
+    rendering fails after the headers were sent, the connection is reset
+    without the last chunk, so a truncated snapshot is never taken for a
+    complete one.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    CONTENT_TYPES = {
+        "markdown": "text/markdown; charset=utf-8",
+        "jsonl": "application/x-ndjson",
+        "msgpack": "application/x-msgpack",
+        "chunks": "application/x-ndjson",
+    }
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else "unix"
+
+    def _send_error(self, status: int, message: str) -> None:
+        body = (message + "\n").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _host_allowed(self, host: Optional[str]) -> bool:
+        """Whether a Host (or Origin host) names the address the server is bound to (see serve)."""
+        allowed = getattr(self.server, "allowed_hosts", None)
+        if allowed is None:
+            return True  # Unix sockets cannot be reached from a browser
+        if not host:
+            return False
+        try:
+            parts = urllib.parse.urlsplit("//" + host)
+            name, port = (parts.hostname or "").lower(), parts.port or 80
+        except ValueError:
+            return False
+        if port != self.server.server_address[1]:
+            return False
+        if name in allowed:
+            return True
+        if "*" in allowed:
+            # Bound to every interface: only IP literals, never a name an attacker's DNS could point here.
+            try:
+                ipaddress.ip_address(name)
+                return True
+            except ValueError:
+                return False
+        return False
+
+    def do_POST(self) -> None:
+        origin = self.headers.get("Origin")
+        if not self._host_allowed(self.headers.get("Host")) or (
+                origin is not None and not self._host_allowed(urllib.parse.urlsplit(origin).netloc)):
+            self._send_error(403, "Host or Origin does not match the server address.")
+            return
+        if self.path.split("?", 1)[0] != "/snapshot":
+            self._send_error(404, f"Unknown endpoint '{self.path}'.")
+            return
+        service = self.server.service
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            request = json.loads(self.rfile.read(length) or b"{}")
+            options, included_files, summary = service.prepare(request)
+        except PermissionError as e:
+            self._send_error(403, str(e))
+            return
+        except ValueError as e:
+            self._send_error(400, str(e))
+            return
+        except Exception as e:
+            self._send_error(500, f"Unexpected error: {e}")
+            return
+
+        chunked = self.request_version != "HTTP/1.0"
+        self.send_response(200)
+        self.send_header("Content-Type", self.CONTENT_TYPES[options["render"].output_format])
+        self.send_header("X-BaseGen-Files", str(len(included_files)))
+        if chunked:
+            self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        try:
+            with self.connection.makefile("wb", buffering=_READ_CHUNK) as out:
+                stream = ChunkedWriter(out) if chunked else out
+                summary.extend(service.render(options, included_files, stream))
+                if chunked:
+                    stream.close()
+        except Exception as e:
+            self.log_error("Error streaming snapshot of '%s', response aborted: %s", options["root"], e)
+            # Reset the connection instead of closing it cleanly, which an HTTP/1.0 client would take as the end.
+            self.close_connection = True
+            try:
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                self.connection.close()
+            except OSError:
+                pass
+            return
+        self.log_message("Snapshot of '%s': %d file(s)%s", options["root"], len(included_files),
+                         "".join(f"; {line}" for line in summary))
+
+class _PooledServerMixIn:
+    """Handle each connection on a bounded thread pool instead of a thread per connection."""
+
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+class _TCPSnapshotServer(_PooledServerMixIn, http.server.HTTPServer):
+    pass
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class _UnixSnapshotServer(_PooledServerMixIn, socketserver.UnixStreamServer):
+        pass
+
+def parse_serve_address(address: str) -> Tuple[str, Any]:
+    """
+    Parse a --serve address: "unix:PATH" or anything containing a path
+    separator is a Unix socket; otherwise "PORT" or "HOST:PORT" (the host
+    defaults to 127.0.0.1). Returns ("unix", path) or ("tcp", (host, port)).
+    Raises ValueError if the address cannot be parsed.
+    """
+    if address.startswith("unix:"):
+        return "unix", address[len("unix:"):]
+    if "/" in address or os.sep in address:
+        return "unix", address
+    host, _, port = address.rpartition(":")
+    try:
+        return "tcp", (host or "127.0.0.1", int(port))
+    except ValueError:
+        raise ValueError(f"Invalid address '{address}': expected PORT, HOST:PORT or unix:PATH.")
+
+def serve(address: str, workers: int = 4, jobs: Optional[int] = None,
+          allowed_roots: Optional[List[str]] = None) -> None:
+    """
+    Run a snapshot server on address (see parse_serve_address) until
+    interrupted. Up to workers requests are rendered concurrently; they share
+    one SnapshotService, so every workspace is scanned only once. Requests
+    may only snapshot directories below allowed_roots. Over HTTP, requests
+    whose Host (or Origin) is not the bound address are refused, so web pages
+    cannot reach the server through DNS rebinding.
+    """
+    kind, bind = parse_serve_address(address)
+    if kind == "unix":
+        if not hasattr(socketserver, "UnixStreamServer"):
+            raise ValueError("Unix sockets are not supported on this platform.")
+        try:
+            mode = os.stat(bind).st_mode
+        except FileNotFoundError:
+            mode = None
+        if mode is not None:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"'{bind}' exists and is not a socket; refusing to replace it.")
+            os.unlink(bind)  # a stale socket from an earlier run
+        server = _UnixSnapshotServer(bind, _SnapshotRequestHandler)
+    else:
+        server = _TCPSnapshotServer(bind, _SnapshotRequestHandler)
+        host = bind[0].strip("[]").lower()
+        if host in ("", "0.0.0.0", "::"):
+            server.allowed_hosts = {"*"}
+        elif host in ("127.0.0.1", "localhost", "::1"):
+            server.allowed_hosts = {"127.0.0.1", "localhost", "::1"}
+        else:
+            server.allowed_hosts = {host}
+    server.service = SnapshotService(jobs, allowed_roots)
+    server.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    if hasattr(signal, "SIGTERM") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, signal.default_int_handler)  # shut down cleanly, like Ctrl+C
+    print(f"Serving snapshots on {address} (POST /snapshot, {workers} workers)", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown(wait=True)
+        if kind == "unix":
+            try:
+                os.unlink(bind)
+            except OSError:
+                pass
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Generate a Markdown document documenting a codebase. "
+            "The document includes a directory tree (as a table of contents) and file contents with syntax highlighting. "
+            "Optionally, you can provide include/exclude glob patterns (relative to the codebase root) to filter files. "
+            "Files matching any .gitignore rules or hardcoded exclusions (from config.json) will be omitted. "
+            "Use --no-gitignore to disable applying .gitignore rules."
+        )
+    )
+    parser.add_argument("input", nargs="?", help="Path to the codebase directory, or an archive of it "
+                                                 "(.zip, .tar, .tar.gz, .tar.bz2, .tar.xz, .tar.zst)")
+    parser.add_argument(
+        "-o", "--output",
+        default=None,
+        help="Output file (default: codebase.md, or codebase.jsonl/codebase.msgpack/codebase.chunks.jsonl with --format). "
+             "With --packages this is a name template that may use {name} and {path} (default: {name}.md)."
+    )
+    parser.add_argument(
+        "--format",
+        choices=list(OUTPUT_FORMATS),
+        default="markdown",
+        help="Output format. 'jsonl' writes one JSON record per file (path, language, size, lines, sha256, "
+             "content) after a header record holding the directory tree; 'msgpack' writes the same records "
+             "as MessagePack (requires the msgpack package); 'chunks' writes JSONL records of bounded-size chunks split "
+             "at function/class boundaries where possible, for retrieval (see CHUNKING in config.json). "
+             "Default: markdown."
+    )
+    parser.add_argument(
+        "--include",
+        nargs="+",
+        help="Glob pattern(s) for files to include (relative to the codebase root). Only files matching at least one pattern will be included."
+    )
+    parser.add_argument(
+        "--exclude",
+        nargs="+",
+        help="Glob pattern(s) for files to exclude (relative to the codebase root). Files matching any of these patterns will be omitted."
+    )
+    parser.add_argument(
+        "--query",
+        help="Include only the files most relevant to this text, ranked with BM25 over identifiers and "
+             "path tokens. The search index is kept in the cache directory and updated incrementally."
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        help="With --query, include at most this many files (default: 20 unless --max-tokens is given)."
+    )
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        help="With --query, include the best files that fit into this many (estimated) tokens."
+    )
+    parser.add_argument(
+        "--skeleton",
+        action="store_true",
+        help="Render Python files as outlines: docstrings, imports, assignments and class/function "
+             "signatures with type hints, with function bodies elided. Files are parsed in parallel "
+             "(see --jobs) and outlines are cached by content hash; files that fail to parse are "
+             "included in full."
+    )
+    parser.add_argument(
+        "--section-index",
+        action="store_true",
+        help="Also write OUTPUT.idx, a sidecar index with the byte offset, length and content hash of "
+             "every file section and of the directory tree, for random access (see SectionIndex). "
+             "Markdown only."
+    )
+    parser.add_argument(
+        "--no-gitignore",
+        action="store_true",
+        help="Disable applying .gitignore file exclusions."
+    )
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help="Emit the contents of identical files only once; later copies refer to the first one."
+    )
+    parser.add_argument(
+        "--strip",
+        action="store_true",
+        help="Remove comments and collapse runs of blank lines in files of supported languages "
+             "(Python, JavaScript/TypeScript, Rust, Go, C-family, shell, YAML, TOML, JSON). "
+             "String literals are left untouched; a per-language savings report is printed."
+    )
+    parser.add_argument(
+        "--strip-docstrings",
+        action="store_true",
+        help="Like --strip, and also remove Python module, class and function docstrings."
+    )
+    parser.add_argument(
+        "--classify",
+        choices=CLASSIFY_ACTIONS,
+        help="Read the first few KB of every selected file to find generated, minified and lock files that "
+             "path globs miss, and exclude them or collapse them (keep them in the tree with a note in place "
+             "of their content). Rules come from CONTENT_CLASSIFIER in config.json; per-category counts are printed."
+    )
+    parser.add_argument(
+        "--redact",
+        action="store_true",
+        help="Replace secrets (private keys, API keys and tokens, passwords in assignments and URLs, "
+             "high-entropy strings) with [REDACTED:<rule>] markers. The rules are read from SECRET_REDACTION "
+             "in config.json; the number of redactions per rule is printed."
+    )
+    parser.add_argument(
+        "--summarize-data",
+        action="store_true",
+        help="Render large data files (CSV/TSV, JSON, NDJSON, YAML at or above DATA_SUMMARY min_bytes in "
+             "config.json) as their record count, inferred schema or top-level keys and first records instead "
+             "of their full content. The files are streamed, never loaded whole."
+    )
+    parser.add_argument(
+        "--reproducible",
+        action="store_true",
+        help="Produce byte-identical output for identical input: files in POSIX path order, '\\n' line "
+             "endings, and a digest of the document in its header and in OUTPUT.digest. An existing output "
+             "with the same digest is not rewritten."
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Compute rollups by language and by directory (files, bytes, lines, blank lines) and the largest "
+             "files while the files are read, print them as tables and write them to OUTPUT.stats.json. "
+             "Limits are read from CODEBASE_STATS in config.json."
+    )
+    parser.add_argument(
+        "--symlinks",
+        choices=SYMLINK_POLICIES,
+        default="files",
+        help="How symbolic links are handled: 'files' reads links to files and lists linked directories "
+             "without descending into them (default), 'skip' leaves links out, 'list' lists them with their "
+             "target without reading them, 'follow' follows links to files and directories. With 'follow', "
+             "a file or directory reached through several paths (same device and inode) is read once and the "
+             "other paths refer to it, which also ends link cycles."
+    )
+    parser.add_argument(
+        "--from-config",
+        nargs="+",
+        metavar="CONFIG",
+        help="Generate headlessly from one or more configuration files saved by the GUI (basegen_config.json). "
+             "Each configuration writes to its own output file; the input argument is not used."
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of worker processes used with --from-config, --packages, --skeleton or --format chunks "
+             "(default: one per CPU)."
+    )
+    parser.add_argument(
+        "--rev",
+        metavar="COMMIT",
+        help="Snapshot the input directory as of this git revision (commit, tag or branch), read directly "
+             "from the repository without a checkout. .gitignore rules are taken from that revision."
+    )
+    parser.add_argument(
+        "--io-concurrency",
+        type=int,
+        metavar="N",
+        help="Scan directories and read files with up to N I/O operations in flight (an asyncio pipeline "
+             "over a thread pool). Speeds up network filesystems such as NFS or SSHFS; the output is unchanged."
+    )
+    parser.add_argument(
+        "--packages",
+        nargs="+",
+        metavar="GLOB_OR_MANIFEST",
+        help="Generate one document per package of a monorepo. Each value is a glob relative to the input "
+             "directory (e.g. 'packages/*') or a manifest file (JSON list, package.json/lerna.json "
+             "'workspaces'/'packages', or one glob per line). The repository is scanned only once."
+    )
+    parser.add_argument(
+        "--profiles",
+        metavar="PROFILES_JSON",
+        help="Render several variants of the input directory in one run: a JSON file with a \"profiles\" object "
+             "mapping names to options (output_file, include, exclude, add_toc, add_dir_structure, "
+             "combined_toc_dir, compact_tree, add_file_stats, add_file_contents, dedupe, section_index, "
+             "reproducible, ...). The directory is scanned once and each file is read once for all profiles."
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="ADDRESS",
+        help="Run a snapshot server instead of generating once: PORT or HOST:PORT for HTTP (host defaults "
+             "to 127.0.0.1), or unix:PATH for a Unix socket. POST /snapshot with a JSON object (root, include, "
+             "exclude, gitignore, format, dedupe, strip, strip_docstrings, skeleton, query, top_k, max_tokens, "
+             "classify, redact, summarize_data, reproducible) "
+             "streams the document back. Workspace scans are kept warm between requests."
+    )
+    parser.add_argument(
+        "--allow-root",
+        nargs="+",
+        metavar="DIR",
+        help="With --serve (required), the directories requests may snapshot: a request's root must be one "
+             "of them or below one."
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="With --serve, the number of requests rendered concurrently (default: 4)."
+    )
+    parser.add_argument(
+        "--index-output",
+        help="With --packages, also write a combined Markdown index linking the per-package documents."
+    )
+    args = parser.parse_args()
+
+    if args.serve:
+        if args.workers < 1:
+            parser.error("--workers must be at least 1.")
+        if not args.allow_root:
+            parser.error("--serve requires --allow-root: the directories requests may snapshot.")
+        try:
+            parse_serve_address(args.serve)
+        except ValueError as e:
+            parser.error(str(e))
+        try:
+            serve(args.serve, args.workers, args.jobs, args.allow_root)
+        except (OSError, ValueError) as e:
+            print(f"Error starting the snapshot server: {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+    if args.from_config:
+        failures = run_batch(args.from_config, args.jobs)
+        sys.exit(1 if failures else 0)
+    if not args.input:
+        parser.error("the following arguments are required: input")
+    if args.section_index and args.format != "markdown":
+        parser.error("--section-index is only supported with --format markdown.")
+    if (args.top_k is not None or args.max_tokens is not None) and not args.query:
+        parser.error("--top-k and --max-tokens require --query.")
+    if args.query and args.packages:
+        parser.error("--query cannot be combined with --packages.")
+    if args.io_concurrency is not None and args.io_concurrency < 1:
+        parser.error("--io-concurrency must be at least 1.")
+    if args.rev and (args.packages or args.io_concurrency):
+        parser.error("--rev cannot be combined with --packages or --io-concurrency.")
+    if args.profiles and (args.query or args.packages or args.rev or args.format != "markdown"):
+        parser.error("--profiles cannot be combined with --query, --packages, --rev or --format.")
+    if args.symlinks != "files" and (args.query or args.packages or args.profiles or args.rev or args.io_concurrency):
+        parser.error("--symlinks cannot be combined with --query, --packages, --profiles, --rev or --io-concurrency.")
+
+    root = pathlib.Path(args.input)
+    archive = is_archive(root)
+    if not archive and not root.is_dir():
+        parser.error(f"The input path '{args.input}' is not a valid directory or archive.")
+    if archive and (args.rev or args.packages or args.io_concurrency):
+        parser.error("Archive input cannot be combined with --rev, --packages or --io-concurrency.")
+    if archive and args.profiles:
+        parser.error("Archive input cannot be combined with --profiles.")
+    if archive and args.symlinks != "files":
+        parser.error("Archive input cannot be combined with --symlinks (links in archives are always skipped).")
+
+    try:
+        options = RenderOptions(
+            output_format=args.format,
+            dedupe=args.dedupe,
+            strip=args.strip,
+            strip_docstrings=args.strip_docstrings,
+            section_index=args.section_index,
+            skeleton=args.skeleton,
+            classify=args.classify,
+            redact=args.redact,
+            summarize_data=args.summarize_data,
+            reproducible=args.reproducible,
+            stats=args.stats,
+            symlinks=args.symlinks,
+            io_concurrency=args.io_concurrency,
+            jobs=args.jobs,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.profiles:
+        # Profiles set their own render options; only how files are read applies to all of them.
+        try:
+            options.require(("io_concurrency",), "--profiles")
+        except ValueError as e:
+            parser.error(f"{e} (set them per profile, see --profiles)")
+        try:
+            profiles = load_profiles(args.profiles)
+        except (OSError, ValueError) as e:
+            parser.error(f"Could not read profiles: {e}")
+        try:
+            failures = generate_profiles(root, profiles, options)
+        except Exception as e:
+            print(f"Unexpected error: {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(1 if failures else 0)
+
+    cli_excludes = args.exclude if args.exclude else []
+    hardcoded_excludes = config_data.get("HARD_CODED_EXCLUDES", [])
+    combined_excludes = cli_excludes + hardcoded_excludes
+
+    if args.packages:
+        try:
+            packages = resolve_packages(root, args.packages)
+        except (OSError, ValueError) as e:
+            parser.error(f"Could not read package list: {e}")
+        if not packages:
+            parser.error("No package directories matched --packages.")
+        output_template = args.output or "{name}" + OUTPUT_FORMATS[args.format][1]
+        if "{name}" not in output_template and "{path}" not in output_template:
+            parser.error("With --packages, --output must contain {name} or {path}.")
+        try:
+            failures = generate_packages(
+                root,
+                packages,
+                output_template,
+                include_patterns=args.include,
+                exclude_patterns=combined_excludes,
+                use_gitignore=not args.no_gitignore,
+                index_output=args.index_output,
+                options=options,
+            )
+        except Exception as e:
+            print(f"Unexpected error: {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(1 if failures else 0)
+
+    scanned_files = gitignore_files = source = None
+    if archive:
+        try:
+            source = ArchiveSource(root, args.include, combined_excludes)
+        except ValueError as e:
+            parser.error(str(e))
+        root = source.root
+        scanned_files = source.files()
+    elif args.rev:
+        try:
+            source = GitRevision(root, args.rev)
+        except ValueError as e:
+            parser.error(str(e))
+        scanned_files = source.files()
+    elif args.io_concurrency and args.io_concurrency > 1:
+        # One concurrent walk finds both the files and the .gitignore files.
+        scanned_files, gitignore_files = scan_tree(root, args.io_concurrency, exclude_patterns=combined_excludes)
+    if args.no_gitignore:
+        gitignore_spec = None
+    elif source:
+        gitignore_spec = source.gitignore_spec()
+    else:
+        gitignore_spec = load_gitignore_specs(root, gitignore_files)
 
     try:
         generate_markdown(
             root_path=root,
-            output_file=args.output,
+            output_file=args.output or "codebase" + OUTPUT_FORMATS[args.format][1],
             include_patterns=args.include,
             exclude_patterns=combined_excludes,
             gitignore_spec=gitignore_spec,
+            options=options,
+            query=args.query,
+            top_k=args.top_k,
+            max_tokens=args.max_tokens,
+            scanned_files=scanned_files,
+            source=source,
         )
     except Exception as e:
         print(f"Unexpected error: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        if source:
+            source.close()
 
 if __name__ == "__main__":
     try:
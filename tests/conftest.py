@@ -0,0 +1,14 @@
+import pathlib
+import sys
+
+import pytest
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """Keep every persistent cache of a test in its own directory."""
+    path = tmp_path / "cache"
+    monkeypatch.setenv("BASEGEN_CACHE_DIR", str(path))
+    return path
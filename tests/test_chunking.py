@@ -0,0 +1,94 @@
+import hashlib
+import json
+import pathlib
+
+import basegen
+
+
+def python_source(functions=40):
+    parts = ['"""Module docstring."""\n\x0c\n', "import os\n\n"]
+    for i in range(functions):
+        parts.append(f"\n# Helper {i}.\ndef helper_{i}(value):\n    total = value + {i}\n    return total * 2\n")
+    return "".join(parts)
+
+
+def chunks_of(content, language, **settings):
+    chunker = basegen.CodeChunker(dict({"max_tokens": 40, "overlap_lines": 2}, **settings), jobs=1)
+    lines, ranges = chunker.submit(content, language)
+    return chunker.chunks(lines, ranges)
+
+
+def test_split_lines_only_at_newlines():
+    assert basegen.split_lines("a\x0cb\n c\r\nd") == ["a\x0cb\n", " c\r\n", "d"]
+    assert basegen.split_lines("a\n") == ["a\n"]
+    assert basegen.split_lines("") == []
+
+
+def test_line_ranges_match_content_with_form_feed():
+    content = python_source()
+    lines = content.split("\n")
+    chunks = chunks_of(content, "python")
+    assert len(chunks) > 1
+    for chunk in chunks:
+        expected = "\n".join(lines[chunk["start_line"] - 1:chunk["end_line"]]) + "\n"
+        assert chunk["content"] == expected
+
+
+def test_python_chunks_start_at_definitions():
+    chunks = chunks_of(python_source(), "python")
+    for chunk in chunks[1:]:
+        first = chunk["content"].split("\n")[chunk["overlap"]]
+        assert first.startswith("# Helper") or first.startswith("def helper_")
+
+
+def test_chunks_cover_content_within_budget():
+    content = python_source()
+    chunks = chunks_of(content, "python")
+    assert "".join("".join(basegen.split_lines(c["content"])[c["overlap"]:]) for c in chunks) == content
+    for chunk in chunks:
+        assert len(chunk["content"].encode("utf-8")) <= 40 * 4
+        assert 0 <= chunk["overlap"] <= 2
+    assert chunks[0]["overlap"] == 0
+
+
+def test_brace_language_keeps_comment_with_function():
+    content = "".join(f"// Adds {i}.\nint add_{i}(int a)\n{{\n    return a + {i};\n}}\n\n" for i in range(20))
+    for chunk in chunks_of(content, "c", overlap_lines=0)[1:]:
+        assert chunk["content"].startswith("// Adds")
+
+
+def test_small_file_is_one_chunk():
+    assert chunks_of("x = 1\n", "python") == [{"start_line": 1, "end_line": 1, "overlap": 0, "content": "x = 1\n"}]
+    assert chunks_of("", "python") == []
+
+
+def test_ranges_are_cached_per_content(cache_dir):
+    content = python_source()
+    first = basegen.CodeChunker({"max_tokens": 40}, jobs=1)
+    expected = first.chunks(*first.submit(content, "python"))
+    assert first.cached == 0
+    second = basegen.CodeChunker({"max_tokens": 40}, jobs=1)
+    assert second.chunks(*second.submit(content, "python")) == expected
+    assert second.cached == 1
+    assert len(list((cache_dir / "chunks").rglob("*.json"))) == 1
+
+
+def test_chunk_records_point_at_file_lines(tmp_path):
+    root = tmp_path / "proj"
+    root.mkdir()
+    files = {"mod.py": python_source(), "page.c": "int x;\r\n" * 200, "doc.rst": "para\x0cgraph\n\n" * 150}
+    for name, content in files.items():
+        (root / name).write_bytes(content.encode("utf-8"))
+    output = tmp_path / "out.chunks.jsonl"
+    basegen.render_records(root, [pathlib.Path("proj", name) for name in sorted(files)], str(output),
+                           basegen.RenderOptions(output_format="chunks", jobs=1))
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert records[0]["type"] == "tree"
+    seen = set()
+    for record in records[1:]:
+        lines = files[record["path"].split("/", 1)[1]].replace("\r\n", "\n").split("\n")
+        expected = "\n".join(lines[record["start_line"] - 1:record["end_line"]]) + "\n"
+        assert record["content"] == expected
+        assert record["sha256"] == hashlib.sha256(expected.encode("utf-8")).hexdigest()
+        seen.add(record["path"])
+    assert seen == {f"proj/{name}" for name in files}
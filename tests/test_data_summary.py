@@ -0,0 +1,57 @@
+import io
+import json
+
+import pytest
+
+import basegen
+
+
+def summarize(document, **settings):
+    return basegen.summarize_data(io.BytesIO(json.dumps(document).encode("utf-8")), "json", **settings)
+
+
+def records(count):
+    return [{"id": i, "score": i * 1.5, "name": f'n"{i}\\', "tags": ["a"] * (i % 3), "extra": None}
+            for i in range(count)]
+
+
+@pytest.mark.parametrize("chunk", [3, 7, 64])
+def test_values_across_chunk_boundaries(monkeypatch, chunk):
+    document = {"meta": {"version": 1.25, "name": "x"}, "items": records(40), "total": -12.5e-3, "ok": True}
+    expected = summarize(document)
+    monkeypatch.setattr(basegen._JsonStream._fill, "__defaults__", (chunk,))
+    summary = summarize(document)
+    assert summary["sample"] == expected["sample"]
+    assert summary["keys"] == expected["keys"] == [
+        ("meta", "object with 2 keys"), ("items", "array of 40 items"), ("total", "number"), ("ok", "boolean")]
+    assert summary["schema"].fields == expected["schema"].fields == {
+        "id": ["integer"], "score": ["number"], "name": ["string"], "tags": ["array"], "extra": ["null"]}
+
+
+def test_large_members_are_tokenized_not_decoded(monkeypatch):
+    monkeypatch.setattr(basegen, "_MAX_JSON_VALUE", 200)
+    monkeypatch.setattr(basegen._JsonStream._fill, "__defaults__", (16,))
+    decoded = []
+    decode = basegen.json.loads
+    monkeypatch.setattr(basegen.json, "loads", lambda text, *a, **k: decoded.append(len(text)) or decode(text))
+    document = {
+        "config": {"big": {"rows": [[i, str(i), {"k": "]}"}] for i in range(50)]}, "small": 1},
+        "items": [records(1)[0], {"blob": ["x" * 10] * 40}] + records(30),
+        "text": "y" * 500,
+    }
+    summary = summarize(document, schema_records=100)
+    assert summary["keys"] == [("config", "object with 2 keys"), ("items", "array of 32 items"), ("text", "string")]
+    assert summary["records"] == 32
+    assert summary["schema"].records == 32
+    assert summary["schema"].fields["blob"] == ["array"]
+    sample = summary["sample"]
+    assert '"big": "... (object with 1 members,' in sample and '"small": 1' in sample
+    assert '"... (object with 1 members,' in sample  # the second record
+    assert '"text": "... (string,' in sample
+    assert max(decoded) <= 200
+
+
+def test_invalid_documents_are_reported():
+    for text in ('{"a": [1, 2}', '[1, 2', '{"a" 1}', '[tru]'):
+        with pytest.raises(ValueError):
+            basegen.summarize_data(io.BytesIO(text.encode("utf-8")), "json")
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tarfile
+import zipfile
+
+import pytest
+
+import basegen
+
+BASEGEN = pathlib.Path(basegen.__file__)
+
+FILES = {
+    "main.py": 'print("héllo")\n',
+    "dup.py": 'print("héllo")\n',
+    "sub/data.csv": "x,y\r\n1,2\r\n",
+    "sub/notes.txt": "no trailing newline",
+    "sub/lib.js": "export const a = 1;\n\n\n",
+    "empty.py": "",
+}
+
+
+def make_project(root, files=FILES):
+    for rel, text in files.items():
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(text.encode("utf-8"))
+    return root
+
+
+def rel_paths(root):
+    return [pathlib.Path(root.name, rel) for rel in sorted(FILES)]
+
+
+def test_passthrough_matches_decoded_reads(tmp_path):
+    root = make_project(tmp_path / "proj")
+    for rel in FILES:
+        scanned = basegen.read_file_info(root / rel, hash_content=True, passthrough=True, count_blank=True)
+        decoded = basegen.read_file_info(root / rel, hash_content=True, count_blank=True)
+        for key in ("lines", "size", "sha256", "blank_lines"):
+            assert scanned[key] == decoded[key], (rel, key)
+    assert basegen.read_file_info(root / "main.py", passthrough=True)["passthrough"]
+    assert not basegen.read_file_info(root / "sub/data.csv", passthrough=True)["passthrough"]
+
+
+def test_passthrough_document_matches_decoded_document(tmp_path):
+    root = make_project(tmp_path / "proj")
+    copied, decoded = tmp_path / "copied.md", tmp_path / "decoded.md"
+    # Stripping reads every file decoded; apart from lib.js (blank lines) there is nothing to strip.
+    files = [rel for rel in rel_paths(root) if rel.name != "lib.js"]
+    basegen.render_markdown(root, files, str(decoded), basegen.RenderOptions(strip=True))
+    basegen.render_markdown(root, files, str(copied))
+    assert copied.read_bytes() == decoded.read_bytes()
+
+
+@pytest.mark.parametrize("method, newline", [
+    ("copy_file_range", "\n"), ("sendfile", "\n"), (None, "\n"), (None, "\r\n"),
+])
+def test_file_that_shrank_after_scanning_is_an_error(tmp_path, method, newline):
+    source = tmp_path / "shrunk.py"
+    source.write_bytes(b"x = 1\n")
+    contents = basegen.FileContents(source, 100)
+    with open(tmp_path / "out.md", "wb") as f:
+        writer = basegen.MarkdownWriter(f, newline)
+        if method and not hasattr(basegen.os, method):
+            pytest.skip(f"{method} is not available")
+        writer._copy = method
+        with pytest.raises(RuntimeError, match="shrank"):
+            writer.write_file(contents)
+    with pytest.raises(RuntimeError, match="shrank"):
+        basegen.write_markdown_lines(str(tmp_path / "out.md"), ["# x", contents])
+
+
+def test_duplicates_are_matched_by_value():
+    deduplicator = basegen.ContentDeduplicator()
+    first, second = hashlib.sha256(b"a").hexdigest(), hashlib.sha256(b"b").hexdigest()
+    # Equal keys from separate reads are the same file, whatever their identity.
+    assert deduplicator.original_of(first, pathlib.Path("proj", "a.py"), 1) is None
+    assert deduplicator.original_of(first, pathlib.Path("proj", "a.py"), 1) is None
+    assert deduplicator.original_of(second, int("1000"), 1) is None
+    assert deduplicator.original_of(second, int("1000"), 1) is None
+    assert deduplicator.original_of(first, pathlib.Path("proj", "b.py"), 1) == pathlib.Path("proj", "a.py")
+    assert deduplicator.original_of(second, 1001, 1) == 1000
+    assert deduplicator.duplicates == 2
+
+
+def test_section_index_offsets(tmp_path):
+    root = make_project(tmp_path / "proj")
+    output = tmp_path / "out.md"
+    basegen.render_markdown(root, rel_paths(root), str(output),
+                            basegen.RenderOptions(section_index=True, dedupe=True))
+    document = output.read_bytes()
+    data = json.loads((tmp_path / "out.md.idx").read_text(encoding="utf-8"))
+    assert data["document_size"] == len(document)
+
+    index = basegen.SectionIndex(str(output))
+    assert index.paths() == [rel.as_posix() for rel in rel_paths(root)]
+    for rel, text in FILES.items():
+        path = f"proj/{rel}"
+        entry = index.files[path]
+        assert entry["sha256"] == hashlib.sha256(text.encode("utf-8")).hexdigest()
+        assert document[entry["offset"]:].startswith(f"### {path}\n".encode("utf-8"))
+        assert index.section(path).startswith(f"### {path}")
+        if text:
+            assert index.file_content(path).rstrip("\n") == text.replace("\r\n", "\n").rstrip("\n")
+    assert index.files["proj/dup.py"].get("duplicate_of") is None
+    assert index.files["proj/main.py"]["duplicate_of"] == "proj/dup.py"
+    assert "sub >" in index.block("tree")
+
+    output.write_bytes(document + b"\n")
+    with pytest.raises(ValueError):
+        basegen.SectionIndex(str(output))
+
+
+@pytest.mark.parametrize("io_concurrency", [1, 4])
+def test_enhanced_sections_are_streamed_in_place(tmp_path, io_concurrency):
+    root = make_project(tmp_path / "proj")
+    output = tmp_path / "out.md"
+    basegen.generate_enhanced_markdown(root, str(output), {str(root)}, set(), add_file_stats=True,
+                                       options=basegen.RenderOptions(section_index=True, dedupe=True,
+                                                                     io_concurrency=io_concurrency))
+    document = output.read_bytes()
+    assert b"- **Total lines of code:** 8" in document
+    index = basegen.SectionIndex(str(output))
+    assert index.paths() == [rel.as_posix() for rel in rel_paths(root)]
+    for rel, text in FILES.items():
+        path = f"proj/{rel}"
+        assert document[index.files[path]["offset"]:].startswith(f"### {path} <a id=".encode("utf-8"))
+        if text and rel != "main.py":
+            assert index.file_content(path).rstrip("\n") == text.replace("\r\n", "\n").rstrip("\n")
+    assert index.files["proj/main.py"]["duplicate_of"] == "proj/dup.py"
+
+
+def test_enhanced_document_without_contents_reads_no_files(tmp_path, monkeypatch):
+    root = make_project(tmp_path / "proj")
+    output = tmp_path / "out.md"
+    monkeypatch.setattr(basegen, "read_file_info", lambda *args: pytest.fail("a file was read"))
+    basegen.generate_enhanced_markdown(root, str(output), {str(root)}, set(), add_file_contents=False,
+                                       options=basegen.RenderOptions(section_index=True))
+    document = output.read_text(encoding="utf-8")
+    assert "héllo" not in document and "### proj/sub/lib.js" in document
+    assert basegen.SectionIndex(str(output)).paths() == [rel.as_posix() for rel in rel_paths(root)]
+
+
+@pytest.mark.parametrize("output_format", ["markdown", "jsonl"])
+def test_reproducible_digest(tmp_path, output_format):
+    options = basegen.RenderOptions(output_format=output_format, reproducible=True)
+    first = make_project(tmp_path / "a" / "proj")
+    second = make_project(tmp_path / "b" / "proj")
+    out_first, out_second = tmp_path / "first.out", tmp_path / "second.out"
+    basegen.render_output(first, rel_paths(first), str(out_first), options)
+    basegen.render_output(second, rel_paths(second), str(out_second), options)
+    assert out_first.read_bytes() == out_second.read_bytes()
+    digest = (tmp_path / "first.out.digest").read_text(encoding="utf-8").strip()
+    assert digest.startswith("sha256:") and digest.encode("ascii") in out_first.read_bytes()
+    assert b"\r\n" not in out_first.read_bytes()
+
+    # An unchanged document is not rewritten.
+    mtime = os.stat(out_first).st_mtime_ns
+    basegen.render_output(first, rel_paths(first), str(out_first), options)
+    assert os.stat(out_first).st_mtime_ns == mtime
+
+    (first / "main.py").write_text('print("changed")\n', encoding="utf-8")
+    basegen.render_output(first, rel_paths(first), str(out_first), options)
+    assert (tmp_path / "first.out.digest").read_text(encoding="utf-8").strip() != digest
+
+
+def run_cli(*args):
+    result = subprocess.run([sys.executable, str(BASEGEN), *map(str, args)], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result
+
+
+def render_cli(tmp_path, name, output_format, *args):
+    output = tmp_path / f"{name}.out"
+    run_cli(*args, "--format", output_format, "--stats", "-o", output)
+    document = output.read_bytes()
+    assert b"build.log" not in document
+    return document
+
+
+IGNORED = {".gitignore": "*.log\n", "build.log": "ignored\n"}
+QUERY = ("--query", "const print", "--top-k", "2")
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+@pytest.mark.parametrize("output_format", ["markdown", "jsonl"])
+@pytest.mark.parametrize("query", [(), QUERY])
+def test_revision_matches_checkout(tmp_path, output_format, query):
+    repo = tmp_path / "repo"
+    project = make_project(repo / "proj", dict(FILES, **IGNORED))
+    git = ["git", "-C", str(repo), "-c", "user.name=t", "-c", "user.email=t@example.com"]
+    subprocess.run(git + ["init", "-q"], check=True)
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "snapshot"], check=True)
+    (project / "main.py").write_text("uncommitted\n", encoding="utf-8")
+
+    revision = render_cli(tmp_path, "rev", output_format, project, "--rev", "HEAD", *query)
+    (project / "main.py").write_bytes(FILES["main.py"].encode("utf-8"))
+    assert revision == render_cli(tmp_path, "checkout", output_format, project, *query)
+
+
+@pytest.mark.parametrize("output_format", ["markdown", "jsonl"])
+@pytest.mark.parametrize("query", [(), QUERY])
+def test_archives_match_checkout(tmp_path, output_format, query):
+    project = make_project(tmp_path / "src" / "proj", dict(FILES, **IGNORED))
+    with tarfile.open(tmp_path / "proj.tar.gz", "w:gz") as tar:
+        tar.add(project, arcname="proj")
+    with zipfile.ZipFile(tmp_path / "proj.zip", "w") as archive:
+        for path in sorted(project.rglob("*")):
+            archive.write(path, pathlib.Path("proj", path.relative_to(project)).as_posix())
+
+    checkout = render_cli(tmp_path, "checkout", output_format, project, *query)
+    assert render_cli(tmp_path, "tar", output_format, tmp_path / "proj.tar.gz", *query) == checkout
+    assert render_cli(tmp_path, "zip", output_format, tmp_path / "proj.zip", *query) == checkout
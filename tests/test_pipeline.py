@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import basegen
+
+
+def make_tree(root, files):
+    for rel, text in files.items():
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+
+
+def test_scan_prunes_excluded_directories(tmp_path, monkeypatch):
+    root = tmp_path / "ws"
+    make_tree(root, {
+        "src/a.py": "a\n", "src/a.pyc": "", "node_modules/x/index.js": "x\n",
+        "vendor/lib/b.py": "b\n", "docs/vendor/c.py": "c\n", ".gitignore": "*.log\n",
+    })
+    listed = []
+    list_directory = basegen._list_directory
+
+    def recording(path, exclusions=None):
+        listed.append(path)
+        return list_directory(path, exclusions)
+
+    monkeypatch.setattr(basegen, "_list_directory", recording)
+    files, gitignores = basegen.scan_tree(root, 4, basegen.ScanExclusions(["node_modules"], ["*.pyc"]), ["vendor/*"])
+    assert files == [root / ".gitignore", root / "docs" / "vendor" / "c.py", root / "src" / "a.py"]
+    assert gitignores == [root / ".gitignore"]
+    assert not any("node_modules" in path or path.startswith(str(root / "vendor")) for path in listed)
+
+    # Pruning leaves exactly the files the exclude patterns would have filtered out afterwards.
+    everything, _ = basegen.scan_tree(root, 4)
+    assert [f for f in everything if basegen.should_include_file(f, root, None, ["vendor/*"])] == \
+        [f for f in basegen.scan_tree(root, 4, exclude_patterns=["vendor/*"])[0]]
+
+
+def test_read_ahead_counts_passthrough_files(tmp_path, monkeypatch):
+    paths = []
+    for i in range(10):
+        path = tmp_path / f"f{i}.py"
+        path.write_text("x" * 999 + "\n", encoding="utf-8")
+        paths.append(path)
+    started = []
+    read_file_info = basegen.read_file_info
+
+    def slow_first(path, *args):
+        started.append(path)
+        if path == paths[0]:
+            time.sleep(0.3)
+        return read_file_info(path, *args)
+
+    monkeypatch.setattr(basegen, "read_file_info", slow_first)
+
+    async def first():
+        infos = basegen.iter_file_infos_async([(path, True) for path in paths], max_open=2, max_buffered=1500)
+        try:
+            info = await infos.__anext__()
+        finally:
+            await infos.aclose()
+        return info
+
+    info = asyncio.run(first())
+    assert info["passthrough"] and info["size"] == 1000
+    # While the first file is slow, the others are read ahead only until 1500 bytes are buffered.
+    assert len(started) <= 4
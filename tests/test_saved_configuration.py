@@ -0,0 +1,24 @@
+import json
+
+import basegen
+
+
+def test_relative_paths_resolve_against_the_configuration(tmp_path, monkeypatch):
+    configs = tmp_path / "configs"
+    (configs / "proj").mkdir(parents=True)
+    (configs / "proj" / "main.py").write_text("x = 1\n", encoding="utf-8")
+    config_file = configs / "saved.json"
+    config_file.write_text(json.dumps({"workspace": "proj"}), encoding="utf-8")
+
+    elsewhere = tmp_path / "elsewhere"
+    elsewhere.mkdir()
+    monkeypatch.chdir(elsewhere)
+    output = basegen.run_saved_configuration("../configs/saved.json")
+    assert output == str(configs / "proj" / "codebase.md")
+    assert "x = 1" in (configs / "proj" / "codebase.md").read_text(encoding="utf-8")
+    assert not list(elsewhere.iterdir())
+
+    config_file.write_text(json.dumps({"workspace": "proj", "output_file": "out/snapshot.md"}), encoding="utf-8")
+    (configs / "out").mkdir()
+    assert basegen.run_saved_configuration(str(config_file)) == str(configs / "out" / "snapshot.md")
+    assert (configs / "out" / "snapshot.md").is_file()
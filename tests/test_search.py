@@ -0,0 +1,79 @@
+import shutil
+import subprocess
+import zipfile
+
+import pytest
+
+import basegen
+
+
+def make_files(root):
+    root.mkdir(parents=True)
+    (root / "retry.py").write_text("def retry_backoff(attempts):\n    return attempts * 2\n", encoding="utf-8")
+    (root / "config.py").write_text("def parse_config(path):\n    return open(path).read()\n", encoding="utf-8")
+    (root / "notes.txt").write_text("nothing to see\n", encoding="utf-8")
+
+
+def update_and_rank(root, source=None, query="retry backoff"):
+    index = basegen.SearchIndex(root, source)
+    try:
+        updated = index.update(["config.py", "notes.txt", "retry.py"])
+        return updated, index.rank(query, ["config.py", "notes.txt", "retry.py"])
+    finally:
+        index.close()
+
+
+def test_only_changed_files_are_read_again(tmp_path, monkeypatch):
+    root = tmp_path / "proj"
+    make_files(root)
+    assert update_and_rank(root)[0] == 3
+    updated, ranked = update_and_rank(root)
+    assert updated == 0 and [rel for rel, _ in ranked] == ["retry.py"]
+
+    read = []
+    iter_file_infos = basegen.iter_file_infos
+    monkeypatch.setattr(basegen, "iter_file_infos",
+                        lambda requests, **kwargs: read.extend(requests) or iter_file_infos(requests, **kwargs))
+    (root / "notes.txt").write_text("retry later\n", encoding="utf-8")
+    (root / "config.py").unlink()
+    updated, ranked = update_and_rank(root)
+    assert updated == 2 and read == [(root / "notes.txt", False)]
+    assert {rel for rel, _ in ranked} == {"retry.py", "notes.txt"}
+
+
+@pytest.mark.skipif(shutil.which("git") is None, reason="git is not installed")
+def test_revisions_are_indexed_by_blob(tmp_path):
+    root = tmp_path / "proj"
+    make_files(root)
+    git = ["git", "-C", str(root), "-c", "user.name=t", "-c", "user.email=t@example.com"]
+    subprocess.run(git + ["init", "-q"], check=True)
+    subprocess.run(git + ["add", "-A"], check=True)
+    subprocess.run(git + ["commit", "-q", "-m", "first"], check=True)
+    (root / "config.py").write_text("def parse_config(path, retry):\n    pass\n", encoding="utf-8")
+    subprocess.run(git + ["commit", "-q", "-a", "-m", "second"], check=True)
+
+    for rev, updated, expected in (("HEAD~1", 3, ["retry.py"]), ("HEAD", 1, ["retry.py", "config.py"]),
+                                   ("HEAD", 0, ["retry.py", "config.py"])):
+        revision = basegen.GitRevision(root, rev)
+        try:
+            result = update_and_rank(root, revision)
+        finally:
+            revision.close()
+        assert result[0] == updated and [rel for rel, _ in result[1]] == expected
+    # The working tree has an index of its own.
+    assert update_and_rank(root)[0] == 3
+
+
+def test_archives_are_indexed_by_member(tmp_path):
+    root = tmp_path / "proj"
+    make_files(root)
+    with zipfile.ZipFile(tmp_path / "proj.zip", "w") as archive:
+        for path in sorted(root.iterdir()):
+            archive.write(path, f"proj/{path.name}")
+    for updated in (3, 0):
+        source = basegen.ArchiveSource(tmp_path / "proj.zip")
+        try:
+            result = update_and_rank(source.root, source)
+        finally:
+            source.close()
+        assert result[0] == updated and [rel for rel, _ in result[1]] == ["retry.py"]
@@ -0,0 +1,57 @@
+import concurrent.futures
+import http.client
+import json
+import threading
+
+import pytest
+
+import basegen
+
+
+@pytest.fixture
+def server(tmp_path):
+    root = tmp_path / "proj"
+    root.mkdir()
+    (root / "main.py").write_text("x = 1\n" * 1000, encoding="utf-8")
+    (root / "empty.py").write_text("", encoding="utf-8")
+    server = basegen._TCPSnapshotServer(("127.0.0.1", 0), basegen._SnapshotRequestHandler)
+    server.allowed_hosts = {"127.0.0.1", "localhost"}
+    server.service = basegen.SnapshotService(1, [str(tmp_path)])
+    server.pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server, root
+    server.shutdown()
+    server.server_close()
+    server.pool.shutdown(wait=True)
+
+
+def post(server, body):
+    connection = http.client.HTTPConnection(*server.server_address, timeout=30)
+    connection.request("POST", "/snapshot", body=json.dumps(body))
+    return connection.getresponse()
+
+
+def test_snapshot_is_sent_chunked(server, tmp_path):
+    server, root = server
+    response = post(server, {"root": str(root)})
+    assert response.status == 200
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    body = response.read()
+    basegen.generate_markdown(root, str(tmp_path / "cli.md"))
+    assert body == (tmp_path / "cli.md").read_bytes()
+
+
+def test_failed_render_is_not_a_complete_response(server, monkeypatch):
+    server, root = server
+
+    def render(options, included_files, output):
+        output.write(b"# partial\n")
+        output.flush()
+        raise RuntimeError("disk went away")
+
+    monkeypatch.setattr(server.service, "render", render)
+    response = post(server, {"root": str(root)})
+    assert response.status == 200
+    with pytest.raises((http.client.IncompleteRead, ConnectionError)):
+        response.read()
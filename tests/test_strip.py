@@ -0,0 +1,72 @@
+import pytest
+
+import basegen
+
+
+def strip(content, language, docstrings=False, ext=""):
+    return basegen.ContentStripper(docstrings=docstrings).strip(content, language, ext)
+
+
+PYTHON = '''"""Module doc."""
+import os  # trailing comment
+# full-line comment
+
+
+
+url = "http://example.com/#anchor"
+text = """
+# not a comment inside a string
+"""
+def f():
+    """Function doc."""
+    return 1
+'''
+
+
+def test_python_comments_and_blank_runs():
+    assert strip(PYTHON, "python") == (
+        '"""Module doc."""\nimport os\n\nurl = "http://example.com/#anchor"\n'
+        'text = """\n# not a comment inside a string\n"""\n'
+        'def f():\n    """Function doc."""\n    return 1\n'
+    )
+
+
+def test_python_docstrings_only_with_flag():
+    stripped = strip(PYTHON, "python", docstrings=True)
+    assert "Module doc." not in stripped and "Function doc." not in stripped
+    assert "# not a comment inside a string" in stripped
+    assert stripped.endswith("def f():\n    return 1\n")
+
+
+def test_unparseable_python_is_left_alone():
+    content = "def broken(:\n    # comment\n"
+    assert strip(content, "python") == content
+
+
+@pytest.mark.parametrize("language, content, expected", [
+    ("javascript",
+     '// line\nconst url = "http://x"; /* block */\nconst re = /\\/\\/ not/;\nlet t = `a // b`;\n',
+     'const url = "http://x";\nconst re = /\\/\\/ not/;\nlet t = `a // b`;\n'),
+    ("rust",
+     'fn main() {\n    // c\n    let s = "// keep"; /* a /* nested */ b */\n    let r = r#"/* raw */"#;\n}\n',
+     'fn main() {\n    let s = "// keep";\n    let r = r#"/* raw */"#;\n}\n'),
+    ("go", 'func f() {\n\t// c\n\ts := `//raw`\n}\n', 'func f() {\n\ts := `//raw`\n}\n'),
+    ("json", '{\n  // c\n  "a": "//b"\n}\n', '{\n  "a": "//b"\n}\n'),
+    ("bash", '#!/bin/sh\n# comment\necho "a # b" $# # trailing\n', '#!/bin/sh\necho "a # b" $#\n'),
+    ("yaml", 'key: "v # x"  # c\n# top\n', 'key: "v # x"\n'),
+])
+def test_comment_lexers_keep_strings(language, content, expected):
+    assert strip(content, language) == expected
+
+
+def test_extension_fallback_and_unknown_languages():
+    assert strip('a = "#x" # c\n', "", ext=".toml") == 'a = "#x"\n'
+    assert strip("# heading\n\n\n\ntext\n", "markdown") == "# heading\n\n\n\ntext\n"
+
+
+def test_savings_are_counted_per_language():
+    stripper = basegen.ContentStripper()
+    stripper.strip("x = 1  # c\n", "python")
+    stripper.strip("plain\n", "plaintext")
+    assert stripper.savings == {"python": [1, 11, 6]}
+    assert stripper.summary_lines()[-1].startswith("  total: 1 file(s)")
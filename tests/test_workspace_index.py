@@ -0,0 +1,135 @@
+import os
+
+import pytest
+
+import basegen
+
+
+def make_tree(root, files):
+    for rel, text in files.items():
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text, encoding="utf-8")
+
+
+def touch_dirs(*paths):
+    # Move directory mtimes forward explicitly, coarse timestamps could hide a change.
+    for path in paths:
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+
+
+def test_revalidate_picks_up_added_and_removed_files(tmp_path):
+    root = tmp_path / "ws"
+    make_tree(root, {"a.py": "a\n", "pkg/b.py": "b\n"})
+    index = basegen.WorkspaceIndex(root).scan()
+    assert index.files() == ["a.py", "pkg/b.py"]
+    assert not index.revalidate()
+
+    (root / "a.py").unlink()
+    make_tree(root, {"pkg/c.py": "c\n", "new/deep/d.py": "d\n"})
+    touch_dirs(root, root / "pkg")
+    assert index.revalidate()
+    assert index.files() == ["new/deep/d.py", "pkg/b.py", "pkg/c.py"]
+    assert index.files() == basegen.WorkspaceIndex(root).scan().files()
+
+
+def test_revalidate_reapplies_changed_gitignore(tmp_path):
+    root = tmp_path / "ws"
+    make_tree(root, {"app.py": "x\n", "debug.log": "log\n", "build/out.py": "y\n"})
+    index = basegen.WorkspaceIndex(root).scan()
+    assert not index.is_ignored("debug.log")
+
+    make_tree(root, {".gitignore": "*.log\nbuild/\n"})
+    touch_dirs(root)
+    assert index.revalidate()
+    assert index.is_ignored("debug.log")
+    assert index.is_ignored("build/out.py")
+    assert not index.is_ignored("app.py")
+
+
+def test_sizes_follow_in_place_edits(tmp_path):
+    root = tmp_path / "ws"
+    make_tree(root, {"pkg/a.py": "a\n"})
+    index = basegen.WorkspaceIndex(root).scan()
+    assert index.size("pkg/a.py") == 2
+
+    mtimes = {path: os.stat(path).st_mtime_ns for path in (root, root / "pkg")}
+    with open(root / "pkg" / "a.py", "a", encoding="utf-8") as f:
+        f.write("more\n")
+    assert {path: os.stat(path).st_mtime_ns for path in mtimes} == mtimes
+    assert not index.revalidate()
+    assert index.size("pkg/a.py") == 7
+    assert index.size("pkg") == 0 and index.size("missing.py") == 0
+
+
+def test_saved_index_is_reloaded_and_revalidated(tmp_path):
+    root = tmp_path / "ws"
+    make_tree(root, {"a.py": "a\n"})
+    basegen.WorkspaceIndex(root).scan().save()
+
+    loaded = basegen.WorkspaceIndex.load(root)
+    assert loaded is not None and loaded.files() == ["a.py"]
+    assert basegen.WorkspaceIndex.load(root, basegen.ScanExclusions(["node_modules"])) is None
+
+    make_tree(root, {"b.py": "b\n"})
+    touch_dirs(root)
+    assert loaded.revalidate()
+    assert loaded.files() == ["a.py", "b.py"]
+
+
+def test_exclusions_prune_while_scanning(tmp_path):
+    root = tmp_path / "ws"
+    make_tree(root, {"src/a.py": "a\n", "node_modules/x/index.js": "x\n", "src/a.pyc": ""})
+    exclusions = basegen.ScanExclusions(["node_modules"], ["*.pyc"])
+    index = basegen.WorkspaceIndex(root, exclusions).scan()
+    assert index.files() == ["src/a.py"]
+    assert "node_modules" not in index.entries
+
+
+@pytest.fixture
+def linked_tree(tmp_path):
+    """A tree with a link cycle (a/loop -> ..), a link to a directory and a link to a file."""
+    root = tmp_path / "ws"
+    make_tree(root, {"a/f.py": "x = 1\n"})
+    try:
+        os.symlink("..", root / "a" / "loop")
+        os.symlink("a", root / "b")
+        os.symlink(os.path.join("a", "f.py"), root / "g.py")
+    except (OSError, NotImplementedError):
+        pytest.skip("symbolic links are not supported here")
+    return root
+
+
+def test_follow_ends_link_cycles(linked_tree):
+    index = basegen.WorkspaceIndex(linked_tree, basegen.ScanExclusions(symlinks="follow")).scan()
+    rels = index.files(links=True)
+    assert rels == ["a/f.py", "a/loop", "b", "g.py"]
+    assert index.references(rels) == {
+        "a/loop": ("same_directory", ""),
+        "b": ("same_directory", "a"),
+        "g.py": ("same_file", "a/f.py"),
+    }
+
+
+def test_link_policies(linked_tree):
+    def scan(policy):
+        return basegen.WorkspaceIndex(linked_tree, basegen.ScanExclusions(symlinks=policy)).scan()
+
+    assert scan("skip").files(links=True) == ["a/f.py"]
+    assert scan("files").files() == ["a/f.py", "g.py"]
+    listed = scan("list")
+    assert listed.references(listed.files(links=True)) == {
+        "a/loop": ("link", ".."),
+        "b": ("link", "a"),
+        "g.py": ("link", os.path.join("a", "f.py")),
+    }
+
+
+def test_followed_links_render_as_references(linked_tree, tmp_path):
+    output = tmp_path / "out.md"
+    basegen.generate_markdown(linked_tree, str(output), options=basegen.RenderOptions(symlinks="follow"))
+    text = output.read_text(encoding="utf-8")
+    assert text.count("x = 1") == 1
+    assert "*Same file as `ws/a/f.py`*" in text
+    assert "*Symbolic link to the directory already included as `ws/a`*" in text